@@ -0,0 +1,270 @@
+import os
+import time
+import hashlib
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from lxml import etree
+from model_registry import ModelRegistry, best_models_dir
+from tagging import prepare_line, crf_marginals, transformer_marginals
+
+# uncertainty sampling of the unannotated letters in master_corpus/ for annotation in Back2TheFuture
+# every line of the letters without any entity label is scored with the best model of each entity: the marginal
+# probabilities of the CRF models and the softmax probabilities of the transformers give a label distribution for the
+# first token of every word, and the entropy of that distribution is the expected information gain of annotating the
+# word (the information an annotation brings about a label is the uncertainty the model has about it)
+# the score of a line is the sum over entities of the entropies of its words, and the score of a letter the sum of
+# the scores of its lines
+
+# the word entropies and most probable labels are cached in <outdir>/cache/, one file per model version (the name,
+# size and modification time of its weights), keyed by letter_id and the hash of the words of the letter
+# after new annotations are imported into master_corpus/ with annotation_reconciler.py, the letters that became
+# annotated leave the pool, and only letters whose text has changed (or that were never scored) are scored again;
+# retraining a best model changes its version and starts a new cache for that entity only
+
+# selections are written to <outdir>/selection.tsv in the format of the Back2TheFuture annotation export read by
+# annotation_reconciler.py: one row per selected letter (or line), spanning its words, with an empty NER tag so that
+# annotation_reconciler.py skips the rows if they are imported as they are; the score and the entities predicted in
+# the span are given in extra columns
+
+# example:
+#   python active_learning.py --select letters -n 20
+#   python active_learning.py --select lines -n 200 --entities NAME LOCATION
+
+targets = ['NAME', 'LOCATION', 'NATION', 'MARKET', 'DATE', 'TIME', 'PRICE', 'GOD']
+
+
+
+def read_letter(path):
+    '''
+    Reads a master corpus letter.
+
+    Returns:
+        tuple: The letter_id, whether any word has an entity label, and the lines of the letter,
+        each a list of (word number in the letter, word) tuples.
+    '''
+    root = etree.parse(path).getroot()
+    letter_id = root.find('letter').get('letter_id')
+    annotated = False
+    lines = []
+    current = None
+    for wn, word in enumerate(root.iter('word')):
+        annotated = annotated or any(tag in word.attrib for tag in targets)
+        line_id = word.get('word_id').rsplit('.', 1)[0]
+        if line_id != current:
+            current = line_id
+            lines.append([])
+        lines[-1].append((wn, word.text or ''))
+    return letter_id, annotated, lines
+
+
+
+def text_hash(lines):
+    return hashlib.sha1('\n'.join(' '.join(w for _, w in line) for line in lines).encode('utf-8')).hexdigest()
+
+
+
+def model_version(entry):
+    '''
+    Returns a version string for a model in the registry, from the name, size and modification time of its weights.
+    '''
+    stat = os.stat(entry.weights_file)
+    return hashlib.sha1(f'{entry.name}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8')).hexdigest()[:12]
+
+
+
+def entropies(probabilities):
+    '''
+    Returns the entropy in nats of each row of an array of label distributions.
+    '''
+    p = np.clip(probabilities, 1e-12, 1.0)
+    return -(p * np.log(p)).sum(axis=1)
+
+
+
+def score_letters(registry, entity, letters, batch_size=512):
+    '''
+    Scores the words of letters with the best model of an entity.
+
+    Parameters:
+        registry (model_registry.ModelRegistry): The registry from which to load the model.
+        entity (str): The entity.
+        letters (dict): letter_id -> lines of (word number, word) tuples, as returned by read_letter().
+        batch_size (int): Number of lines scored at a time.
+
+    Returns:
+        dict: letter_id -> list of (entropies, labels) per line, where entropies is an array with the entropy of
+        each word (0 for empty words) and labels a string with the most probable label of each word.
+    '''
+    model = registry.get(entity)
+    keys = [(letter_id, i) for letter_id, lines in letters.items() for i in range(len(lines))]
+    prepared = [prepare_line(' '.join(w for _, w in letters[letter_id][i])) for letter_id, i in keys]
+    results = {letter_id: [None] * len(lines) for letter_id, lines in letters.items()}
+    for start in range(0, len(keys), batch_size):
+        batch = prepared[start:start + batch_size]
+        token_lines = [tokens for _, tokens, _ in batch]
+        if registry.entries[entity].kind == 'crf':
+            labels, marginals = crf_marginals(model, token_lines)
+        else:
+            labels, marginals = transformer_marginals(model[0], model[1], token_lines)
+        # the labels of a joint model are reduced to the BIO labels of the entity
+        labels = [l.split('-')[-1] if l.startswith(f'{entity}-') else ('O' if '-' in l else l) for l in labels]
+        for (letter_id, i), (_, _, first_token), probabilities in zip(keys[start:start + batch_size], batch, marginals):
+            token_entropies = entropies(probabilities)
+            best = probabilities.argmax(axis=1) if len(probabilities) else []
+            results[letter_id][i] = (
+                np.array([token_entropies[t] if t is not None else 0.0 for t in first_token], dtype=np.float32),
+                ''.join(labels[best[t]][0] if t is not None else 'O' for t in first_token))
+    return results
+
+
+
+def update_scores(registry, entities, pool, cache_dir, batch_size=512):
+    '''
+    Returns the cached scores of the letters in the pool for each entity, scoring the letters that are not cached
+    under the current version of the entity's model or whose text has changed.
+
+    Parameters:
+        registry (model_registry.ModelRegistry): The registry of the best models.
+        entities (list): The entities to score.
+        pool (dict): letter_id -> (text hash, lines) of the unannotated letters.
+        cache_dir (str): Directory of the score caches.
+        batch_size (int): Number of lines scored at a time.
+
+    Returns:
+        dict: entity -> letter_id -> list of (entropies, labels) per line.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    scores = {}
+    for entity in entities:
+        version = model_version(registry.entries[entity])
+        path = os.path.join(cache_dir, f'{entity.lower()}_{version}.pkl')
+        cache = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                cache = pickle.load(f)
+        stale = {letter_id: lines for letter_id, (h, lines) in pool.items() if cache.get(letter_id, (None,))[0] != h}
+        start = time.perf_counter()
+        if stale:
+            for letter_id, lines in score_letters(registry, entity, stale, batch_size).items():
+                cache[letter_id] = (pool[letter_id][0], lines)
+        # letters that have been annotated or removed leave the cache
+        cache = {letter_id: cache[letter_id] for letter_id in pool}
+        with open(path, 'wb') as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        print(f"{entity} ({registry.entries[entity].name}, version {version}): {len(stale)} letters scored "
+              f"in {time.perf_counter() - start:.1f}s, {len(pool) - len(stale)} cached")
+        scores[entity] = {letter_id: lines for letter_id, (_, lines) in cache.items()}
+    return scores
+
+
+
+def predicted_spans(labels, words):
+    '''
+    Returns the spans of the B and I labels of a line as (start, end) word numbers.
+    '''
+    spans = []
+    for (wn, _), label in zip(words, labels):
+        if label == 'B' or (label == 'I' and not spans):
+            spans.append([wn, wn])
+        elif label == 'I':
+            spans[-1][1] = wn
+    return spans
+
+
+
+def rank(scores, pool):
+    '''
+    Ranks the lines and letters of the pool by their expected information gain.
+
+    Returns:
+        tuple: DataFrames of the lines and of the letters, sorted by score, with the span of word numbers
+        ('start', 'end'), the number of words, the score, the score per word and the predicted entity spans.
+    '''
+    rows = []
+    for letter_id, (_, lines) in pool.items():
+        for i, words in enumerate(lines):
+            predicted = []
+            score = 0.0
+            for entity, letters in scores.items():
+                line_entropies, labels = letters[letter_id][i]
+                score += float(line_entropies.sum())
+                predicted += [f'{entity} {s}/{e}' for s, e in predicted_spans(labels, words)]
+            rows.append({'letter_id': letter_id, 'line': i, 'start': words[0][0], 'end': words[-1][0],
+                         'words': len(words), 'score': score, 'predicted': '; '.join(predicted),
+                         'text': ' '.join(w for _, w in words)})
+    lines = pd.DataFrame(rows)
+    letters = lines.groupby('letter_id', sort=False).agg(start=('start', 'min'), end=('end', 'max'),
+                                                         words=('words', 'sum'), score=('score', 'sum'),
+                                                         predicted=('predicted', lambda p: '; '.join(x for x in p if x)))
+    for df in (lines, letters):
+        df['score_per_word'] = df['score'] / df['words'].clip(lower=1)
+    lines = lines.sort_values('score', ascending=False, kind='stable').reset_index(drop=True)
+    letters = letters.sort_values('score', ascending=False, kind='stable').reset_index()
+    return lines, letters
+
+
+
+def export_selection(selection, path):
+    '''
+    Writes selected letters or lines in the format of the Back2TheFuture annotation export.
+    '''
+    spans = selection['start'].astype(str) + '/' + selection['end'].astype(str)
+    pd.DataFrame({'free_annotations._id': 'f.' + selection['letter_id'] + '.' + spans.str.replace('/', '_'),
+                  'free_annotations.annotations.NER': '',
+                  'free_annotations.span': spans,
+                  'letters._id': selection['letter_id'],
+                  'active_learning.rank': range(1, len(selection) + 1),
+                  'active_learning.score': selection['score'].round(4),
+                  'active_learning.predicted': selection['predicted']}).to_csv(path, sep='\t', index=False)
+
+
+
+def main(args):
+    registry = ModelRegistry(args.models_dir)
+    missing = [e for e in (args.entities or targets) if e not in registry.available()]
+    if args.entities and missing:
+        raise ValueError(f"no weights in {args.models_dir} for the requested entities: {' '.join(missing)}")
+    if missing:
+        print(f"no weights in {args.models_dir} for {' '.join(missing)}, these entities are not scored")
+    entities = [e for e in (args.entities or targets) if e not in missing]
+    if not entities:
+        raise ValueError(f"no weights in {args.models_dir} for any entity")
+
+    pool = {}
+    annotated = 0
+    for file in sorted(os.listdir(args.master_corpus)):
+        if file.endswith('.xml'):
+            letter_id, is_annotated, lines = read_letter(os.path.join(args.master_corpus, file))
+            if is_annotated:
+                annotated += 1
+            elif lines:
+                pool[letter_id] = (text_hash(lines), lines)
+    print(f"{annotated} annotated letters, {len(pool)} letters to rank, entities: {' '.join(entities)}")
+
+    scores = update_scores(registry, entities, pool, os.path.join(args.outdir, 'cache'), args.batch_size)
+    lines, letters = rank(scores, pool)
+    selection = (letters if args.select == 'letters' else lines).head(args.n)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    export_selection(selection, os.path.join(args.outdir, 'selection.tsv'))
+    columns = ['letter_id', 'words', 'score', 'score_per_word']
+    shown = selection[columns if args.select == 'letters' else ['line'] + columns].head(20)
+    with pd.option_context('display.float_format', '{:.3f}'.format, 'display.width', 200):
+        print(shown.assign(predicted=selection['predicted'].str.slice(0, 60)).to_string(index=False))
+    print(f"{len(selection)} {args.select} written to {os.path.join(args.outdir, 'selection.tsv')}")
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--master_corpus', type=str, default='master_corpus', help='Directory of the master corpus letters.')
+    p.add_argument('--models_dir', type=str, default=best_models_dir, help='Directory of the best models.')
+    p.add_argument('--entities', type=str, nargs='+', help='Entities to score. Defaults to all entities whose weights are available.')
+    p.add_argument('--select', type=str, default='letters', choices=['letters', 'lines'], help='Select whole letters or single lines.')
+    p.add_argument('-n', type=int, default=20, help='Number of letters or lines to select.')
+    p.add_argument('--batch_size', type=int, default=512, help='Number of lines scored at a time.')
+    p.add_argument('--outdir', type=str, default='active_learning', help='Output directory for the score caches and the selection.')
+    args = p.parse_args()
+    main(args)
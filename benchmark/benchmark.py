@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import argparse
+import shutil
+import subprocess
+import string
+import platform
+from datetime import datetime
+from lxml import etree
+import pandas as pd
+
+# end-to-end benchmark of the corpus pipeline and the models
+
+# fixtures are derived from raw_data/letters.json, raw_data/process_export_keys.csv and master_corpus/ at several scales,
+# replicating every letter (with a new letter_id) to reach 10x, 100x, etc.
+# VARD itself is not run; its output is reconstructed from the VARD attributes recorded in master_corpus/,
+# so that postprocess.py and everything after it can be timed on realistic input
+
+# every stage is run in its own process so that its wall-clock time and peak RSS can be measured in isolation; the
+# stages are started by launcher.py and the fixtures are built in a child process, so that the memory of this process
+# is not counted in the peak RSS of the stages (see launcher.py)
+# a fixture is rebuilt when it was built with another --vard_runs
+# results are appended to benchmark/results.jsonl and compared against benchmark/baseline.json
+
+# timings depend on the machine, so no baseline is kept in the repository: save one on your machine first, at the
+# scales you will compare at, and rerun after a change to flag regressions
+#   python benchmark/benchmark.py --scales 1 10 --save_baseline
+#   python benchmark/benchmark.py --scales 1 10
+# the baseline records the machine it was saved on, and runs on another machine are not compared with it
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+benchmark_dir = os.path.join(repo_dir, 'benchmark')
+scripts_dir = os.path.join(repo_dir, 'create_corpus_vard')
+sys.path.append(repo_dir)
+
+letters_json = os.path.join(repo_dir, 'raw_data', 'letters.json')
+annotations_tsv = os.path.join(repo_dir, 'raw_data', 'process_export_keys.csv')
+master_corpus_dir = os.path.join(repo_dir, 'master_corpus')
+
+stages = ['xml_build', 'vard_postprocess', 'unicity', 'reconciliation', 'csv_export', 'pipeline',
+          'retokenisation', 'pos', 'feature_extraction', 'crf_fit', 'transformer_inference']
+
+
+
+def replica_id(letter_id, r):
+    '''
+    Returns the letter_id of the r-th replica of a letter; the first replica keeps the original letter_id.
+    '''
+    return letter_id if r == 0 else f'{letter_id}_x{r}'
+
+
+
+def punctuation_tail(original, normalised):
+    '''
+    Returns the trailing punctuation shared by the original and normalised forms of a word,
+    which VARD leaves outside of the <normalised> element.
+    '''
+    tail = ''
+    while (len(tail) < len(original) - 1 and len(tail) < len(normalised) - 1
+           and original[-len(tail) - 1] in string.punctuation
+           and original[-len(tail) - 1] == normalised[-len(tail) - 1]):
+        tail = original[-len(tail) - 1] + tail
+    return tail
+
+
+
+def build_fixture(scale, fixture_dir, vard_runs):
+    '''
+    Builds the input files for one scale: letters.json, the annotations export and one
+    VARD output directory per VARD run, each containing a 'Tagged' directory as written by VARD.
+    Returns the VARD runs used and the number of words in the fixture.
+    '''
+    os.makedirs(fixture_dir, exist_ok=True)
+
+    with open(letters_json) as json_file:
+        letters = json.load(json_file)
+    replicated = []
+    for r in range(scale):
+        for letter in letters:
+            replicated.append(dict(letter, _id=replica_id(letter['_id'], r)))
+    with open(os.path.join(fixture_dir, 'letters.json'), 'w') as f:
+        json.dump(replicated, f)
+    words = sum(len(line.split(' ')) for letter in replicated for line in letter['text'])
+
+    df = pd.read_csv(annotations_tsv, sep='\t')
+    replicas = []
+    for r in range(scale):
+        df_r = df.copy()
+        df_r['letters._id'] = df_r['letters._id'].map(lambda f: replica_id(f, r) if isinstance(f, str) else f)
+        replicas.append(df_r)
+    pd.concat(replicas).to_csv(os.path.join(fixture_dir, 'annotations.tsv'), sep='\t', index=False)
+
+    # choose the VARD runs recorded as unique in the master corpus
+    xml_files = sorted(f for f in os.listdir(master_corpus_dir) if f.endswith('.xml'))
+    unicity = etree.parse(os.path.join(master_corpus_dir, xml_files[0])).find('.//VARD_unicity')
+    runs = sorted(k for k, v in unicity.attrib.items() if v == 'Y')[:vard_runs]
+
+    for k, run in enumerate(runs):
+        os.makedirs(os.path.join(fixture_dir, 'vard', run, 'Tagged'), exist_ok=True)
+
+    parser = etree.XMLParser(remove_blank_text=True)
+    for xml_file in xml_files:
+        source = etree.parse(os.path.join(master_corpus_dir, xml_file), parser).getroot()
+        letter_id = os.path.splitext(xml_file)[0]
+        for r in range(scale):
+            new_id = replica_id(letter_id, r)
+            for k, run in enumerate(runs):
+                # VARD is run on the output of the previous run, so earlier runs are carried as attributes
+                root = etree.Element('root')
+                letter_element = etree.SubElement(root, 'letter', letter_id=new_id)
+                for word in source.iter('word'):
+                    word_element = etree.SubElement(letter_element, 'word')
+                    word_element.set('word_id', new_id + word.get('word_id')[len(letter_id):])
+                    for previous in runs[:k]:
+                        if previous in word.attrib:
+                            word_element.set(previous, word.get(previous))
+                    text = word.text or ''
+                    if run in word.attrib and text:
+                        normalised = word.get(run)
+                        tail = punctuation_tail(text, normalised)
+                        child = etree.SubElement(word_element, 'normalised', orig=text[:len(text) - len(tail)])
+                        child.text = normalised[:len(normalised) - len(tail)]
+                        child.tail = tail or None
+                    else:
+                        word_element.text = text
+                with open(os.path.join(fixture_dir, 'vard', run, 'Tagged', f'{new_id}.xml'), 'w', encoding='utf-8') as f:
+                    f.write(etree.tostring(root, encoding='unicode'))
+
+    with open(os.path.join(fixture_dir, 'fixture.json'), 'w') as f:
+        json.dump({'scale': scale, 'requested_vard_runs': vard_runs, 'vard_runs': runs, 'words': words}, f)
+    return runs, words
+
+
+
+def run_timed(commands, cwd, log_file, timeout):
+    '''
+    Runs commands one after the other through launcher.py and measures them together.
+
+    Returns:
+        dict: 'seconds' (wall-clock time), 'peak_rss_mb' (the largest peak RSS of any command),
+        'status' ('ok', 'failed' or 'timeout') and 'output' (the last result line printed by a child stage).
+    '''
+    launcher = subprocess.run([sys.executable, os.path.join(benchmark_dir, 'launcher.py'), '--commands', json.dumps(commands),
+                               '--cwd', cwd, '--log', log_file, '--timeout', str(timeout)],
+                              capture_output=True, text=True, check=True)
+    result = json.loads(launcher.stdout.splitlines()[-1])
+    with open(log_file) as log:
+        lines = [line for line in log.read().splitlines() if line.startswith(('{', 'skipped'))]
+    return dict(result, output=lines[-1] if lines else '')
+
+
+
+def stage_commands(stage, fixture_dir, work_dir, runs):
+    '''
+    Returns the commands that run a stage. Corpus stages run the scripts in create_corpus_vard/ exactly as
+    preprocessing.sh does; the remaining stages are run by this script in child mode.
+    '''
+    python = sys.executable
+    script = lambda f: os.path.join(scripts_dir, f)
+    vard_dir = os.path.join(work_dir, 'v_corpus_full')
+    gs_dir = os.path.join(work_dir, 'v_corpus_gs')
+    master_dir = os.path.join(work_dir, 'master_corpus')
+    tagged_dir = os.path.join(work_dir, 'annotated_corpus')
+    ner_dir = os.path.join(work_dir, 'ner_corpus')
+    fscores = sorted({run.split('fscore_')[1].split('_')[0] for run in runs})
+    thresholds = sorted({run.split('threshold_')[1] for run in runs})
+
+    if stage == 'xml_build':
+        return [[python, script('create_corpus.py'), '--json_file', os.path.join(fixture_dir, 'letters.json'), '--corpus', vard_dir]]
+    if stage == 'vard_postprocess':
+        return [[python, script('postprocess.py'), '--corpus_varded', os.path.join(fixture_dir, 'vard', run),
+                 '--processed_corpus', vard_dir,
+                 '--fscore', run.split('fscore_')[1].split('_')[0], '--threshold', run.split('threshold_')[1]]
+                for run in runs]
+    if stage == 'unicity':
+        return [[python, script('gs.py'), '--fscores', ' '.join(fscores), '--thresholds', ' '.join(thresholds),
+                 '--processed_corpus', vard_dir, '--gs_corpus', gs_dir]]
+    if stage == 'reconciliation':
+        return [[python, script('annotation_reconciler.py'), '--gs_corpus', gs_dir, '--master_corpus', master_dir,
+                 '--annotations', os.path.join(fixture_dir, 'annotations.tsv')]]
+    if stage == 'csv_export':
+        return [[python, script('comp_ner_corpus.py'), '--master_corpus', master_dir, '--tagged_corpus', tagged_dir],
+                [python, script('xml_csv.py'), '--tagged_corpus', tagged_dir, '--ner_corpus', ner_dir]]
+    if stage == 'pipeline':
+        # the same stages as xml_build to csv_export, run in memory by pipeline.py
+        return [[python, script('pipeline.py'), '--json_file', os.path.join(fixture_dir, 'letters.json'),
+                 '--annotations', os.path.join(fixture_dir, 'annotations.tsv'), '--fscores', ' '.join(fscores),
+                 '--thresholds', ' '.join(thresholds), '--varded_dir', os.path.join(fixture_dir, 'vard'),
+                 '--ner_corpus', os.path.join(work_dir, 'ner_corpus_pipeline')]]
+    return [[python, os.path.realpath(__file__), '--run_stage', stage, '--work_dir', work_dir]]
+
+
+
+def lines_from_csv(filepath, entity='NAME'):
+    '''
+    Reads a preprocessed subcorpus into lines of (word, label, POS) tuples, as in the CRF notebooks.
+    '''
+    df = pd.read_csv(filepath).astype(str)
+    return [list(zip(g['word'], g[entity], g['POS'])) for k, g in
+            df.groupby(df['word_id'].str.endswith('.0').cumsum())]
+
+
+
+def run_stage(stage, work_dir):
+    '''
+    Runs one of the model stages in this process and prints the number of items processed as the last line.
+    '''
+    import preprocessing
+    from my_functions import sent2features, sent2labels
+
+    ner_dir = os.path.join(work_dir, 'ner_corpus')
+    retok_dir = os.path.join(work_dir, 'retokenised')
+    data_dir = os.path.join(work_dir, 'data')
+    raw_csv = os.path.join(data_dir, 'raw_ner_corpus.csv')
+
+    if stage == 'retokenisation':
+        os.makedirs(retok_dir, exist_ok=True)
+        items = 0
+        for file in os.listdir(ner_dir):
+            df = preprocessing.retokenize(os.path.join(ner_dir, file))
+            df.to_pickle(os.path.join(retok_dir, file + '.pkl'))
+            items += len(df)
+    elif stage == 'pos':
+        os.makedirs(data_dir, exist_ok=True)
+        items = 0
+        for file in os.listdir(retok_dir):
+            df = preprocessing.add_pos(pd.read_pickle(os.path.join(retok_dir, file)))
+            df.to_csv(os.path.join(data_dir, file[:-len('.pkl')]), index=False)
+            items += len(df)
+    elif stage == 'feature_extraction':
+        lines = lines_from_csv(raw_csv)
+        features = [sent2features(s) for s in lines]
+        items = sum(len(f) for f in features)
+    elif stage == 'crf_fit':
+        import sklearn_crfsuite
+        lines = lines_from_csv(raw_csv)
+        crf = sklearn_crfsuite.CRF(algorithm='lbfgs', c1=0.1, c2=0.1, max_iterations=50, all_possible_transitions=False)
+        crf.fit([sent2features(s) for s in lines], [sent2labels(s) for s in lines])
+        items = sum(len(s) for s in lines)
+    elif stage == 'transformer_inference':
+        from model_registry import ModelRegistry
+        from tagging import transformer_predict
+        registry = ModelRegistry()
+        entity = next((k for k in registry.available() if registry.entries[k].kind == 'transformer'), None)
+        if entity is None:
+            print('skipped: no transformer weights in best_models/')
+            return
+        model, tokenizer = registry.get(entity)
+        token_lines = [[w for w, _, _ in s] for s in lines_from_csv(raw_csv)]
+        transformer_predict(model, tokenizer, token_lines)
+        items = sum(len(s) for s in token_lines)
+    print(json.dumps({'items': items}))
+
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Flags stages that are slower or use more memory than the baseline by more than the tolerance.
+    Returns a list of regression messages.
+    '''
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline or result['status'] != 'ok' or baseline[key]['status'] != 'ok':
+            continue
+        base = baseline[key]
+        if result['seconds'] > base['seconds'] * (1 + tolerance):
+            regressions.append(f"{key}: {result['seconds']:.2f}s vs baseline {base['seconds']:.2f}s")
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{key}: {result['peak_rss_mb']:.0f}MB peak RSS vs baseline {base['peak_rss_mb']:.0f}MB")
+    return regressions
+
+
+
+def machine():
+    '''
+    Returns a description of the machine, stored with the results and the baseline.
+    '''
+    return {'host': platform.node(), 'platform': platform.platform(), 'processor': platform.processor() or platform.machine(),
+            'cpus': os.cpu_count(), 'python': platform.python_version()}
+
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+
+def main(args):
+    results = {}
+    for scale in args.scales:
+        fixture_dir = os.path.join(args.fixtures, f'x{scale}')
+        work_dir = os.path.join(args.work_dir, f'x{scale}')
+        fixture = {}
+        if os.path.exists(os.path.join(fixture_dir, 'fixture.json')):
+            with open(os.path.join(fixture_dir, 'fixture.json')) as f:
+                fixture = json.load(f)
+        if fixture.get('requested_vard_runs') != args.vard_runs:
+            print(f"Building {scale}x fixture")
+            shutil.rmtree(fixture_dir, ignore_errors=True)
+            # in a child process, so that the replicated letters never raise the memory of this process
+            subprocess.run([sys.executable, os.path.realpath(__file__), '--build_fixture', str(scale),
+                            '--fixtures', args.fixtures, '--vard_runs', str(args.vard_runs)], check=True)
+            with open(os.path.join(fixture_dir, 'fixture.json')) as f:
+                fixture = json.load(f)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(os.path.join(work_dir, 'logs'))
+
+        for stage in args.stages:
+            commands = stage_commands(stage, fixture_dir, work_dir, fixture['vard_runs'])
+            result = run_timed(commands, work_dir, os.path.join(work_dir, 'logs', f'{stage}.log'), args.timeout)
+            items = fixture['words']
+            if result['output'].startswith('{'):
+                items = json.loads(result['output'])['items']
+            elif result['output'].startswith('skipped'):
+                result['status'] = 'skipped'
+            result['items'] = items
+            result['items_per_second'] = items / result['seconds'] if result['seconds'] else 0
+            del result['output']
+            results[f'{stage}@{scale}x'] = result
+            print(f"{stage:>22} {scale:>4}x {result['status']:>8} {result['seconds']:9.2f}s "
+                  f"{result['items_per_second']:11.0f} items/s {result['peak_rss_mb']:8.0f}MB")
+            if result['status'] in ('failed', 'timeout'):
+                print(f"{'':>22} later stages at {scale}x depend on this one; see {work_dir}/logs/{stage}.log")
+                break
+
+    run = {'date': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(), 'machine': machine(),
+           'scales': args.scales, 'results': results}
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f"Saved baseline to {args.baseline} ({run['machine']['host']}, scales {' '.join(map(str, args.scales))})")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against; run with --save_baseline first to store one for this machine.")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['machine'] != run['machine']:
+        print(f"The baseline was saved on another machine ({baseline['machine']['host']}, {baseline['machine']['processor']}, "
+              f"{baseline['machine']['cpus']} cpus); run with --save_baseline to store one for this machine.")
+        return 0
+    missing = [scale for scale in args.scales if scale not in baseline['scales']]
+    if missing:
+        print(f"The baseline has no results at {' '.join(f'{scale}x' for scale in missing)}; only the other scales are compared.")
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help='Replication factors of the fixtures.')
+    p.add_argument('--stages', type=str, nargs='+', default=stages, choices=stages, help='Stages to run, in pipeline order.')
+    p.add_argument('--vard_runs', type=int, default=2, help='Number of VARD runs to reconstruct in the fixtures.')
+    p.add_argument('--fixtures', type=str, default=os.path.join(benchmark_dir, 'fixtures'), help='Directory for generated fixtures.')
+    p.add_argument('--work_dir', type=str, default=os.path.join(benchmark_dir, 'work'), help='Directory for stage outputs.')
+    p.add_argument('--results', type=str, default=os.path.join(benchmark_dir, 'results.jsonl'), help='File to append results to.')
+    p.add_argument('--baseline', type=str, default=os.path.join(benchmark_dir, 'baseline.json'), help='Stored baseline results.')
+    p.add_argument('--save_baseline', action='store_true', help='Store the results of this run as the baseline for this machine.')
+    p.add_argument('--tolerance', type=float, default=0.2, help='Relative slowdown or memory increase flagged as a regression.')
+    p.add_argument('--timeout', type=float, default=3600, help='Seconds after which a stage is stopped.')
+    p.add_argument('--run_stage', type=str, help=argparse.SUPPRESS)
+    p.add_argument('--build_fixture', type=int, help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.run_stage:
+        run_stage(args.run_stage, args.work_dir)
+    elif args.build_fixture:
+        build_fixture(args.build_fixture, os.path.join(args.fixtures, f'x{args.build_fixture}'), args.vard_runs)
+    else:
+        sys.exit(main(args))
@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import subprocess
+
+# launcher for the stages of benchmark.py
+
+# on Linux the peak RSS of a child (ru_maxrss) starts at the resident size of the process it was forked from and is
+# carried over exec, so stages started directly by benchmark.py, which imports pandas and lxml, would all report at
+# least the peak of the harness
+# benchmark.py starts this script instead, which only imports the standard library, and it starts the commands of
+# a stage itself, so that the peak RSS of a stage is its own (with a floor of the few MB of this interpreter)
+
+# prints the result of the stage as one json line
+
+
+
+def peak_rss_mb(usage):
+    return usage.ru_maxrss / 1024**2 if sys.platform == 'darwin' else usage.ru_maxrss / 1024 # bytes on macOS, kilobytes on Linux
+
+
+
+def run(commands, cwd, log_file, timeout):
+    '''
+    Runs commands one after the other and measures them together.
+
+    Returns:
+        dict: 'seconds' (wall-clock time), 'peak_rss_mb' (the largest peak RSS of any command)
+        and 'status' ('ok', 'failed' or 'timeout').
+    '''
+    start = time.perf_counter()
+    peak = 0
+    status = 'ok'
+    with open(log_file, 'w') as log:
+        for command in commands:
+            process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+            while True:
+                pid, exit_status, usage = os.wait4(process.pid, os.WNOHANG)
+                if pid:
+                    break
+                if time.perf_counter() - start > timeout:
+                    process.send_signal(signal.SIGKILL)
+                    pid, exit_status, usage = os.wait4(process.pid, 0)
+                    status = 'timeout'
+                    break
+                time.sleep(0.02)
+            process.returncode = os.waitstatus_to_exitcode(exit_status)
+            peak = max(peak, peak_rss_mb(usage))
+            if status == 'ok' and process.returncode != 0:
+                status = 'failed'
+            if status != 'ok':
+                break
+    return {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak, 'status': status}
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--commands', type=str, required=True, help='The commands of the stage, as a json list of argument lists.')
+    p.add_argument('--cwd', type=str, required=True, help='Working directory of the commands.')
+    p.add_argument('--log', type=str, required=True, help='File to which the output of the commands is written.')
+    p.add_argument('--timeout', type=float, default=3600, help='Seconds after which the stage is stopped.')
+    args = p.parse_args()
+    print(json.dumps(run(json.loads(args.commands), args.cwd, args.log, args.timeout)))
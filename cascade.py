@@ -0,0 +1,170 @@
+import math
+import pickle
+import time
+import argparse
+import pandas as pd
+from string import punctuation
+from my_functions import lexi_maker, preprocess_for_lexical, sent2features, sent2labels, O_checker
+from joint_crf import split, new_crf, scores
+from model_registry import ModelRegistry, best_models_dir
+from tagging import transformer_predict
+
+# cascade tagging: most lines of the letters carry no entity at all (see O_checker in my_functions.py),
+# so a cheap model first scores every line and only the lines it flags as possibly holding an entity are tagged
+# by the expensive model from best_models/; all other lines are labelled 'O'
+
+# cheap models:
+#   crf      a CRF trained on the training split with the settings used for selecting the 'best' NER subcorpora;
+#            a line is scored by the highest probability of any of its tokens not being 'O'
+#   lexical  the lexical baseline from baselines.ipynb (lexi_maker); a line scores 1 if any of its words is in the
+#            lexicon of entity words and 0 otherwise, so it has no threshold to tune
+#   a CRF pickle, e.g. a joint model from joint_crf.py
+
+# the threshold is the highest score at which at least --target_recall of the lines with an entity in the
+# evaluation split are flagged; recall loss and speed-up are then measured on the test split
+
+
+
+def line_scores_crf(crf, lines, entity):
+    '''
+    Scores lines with the marginal probabilities of a CRF: the score of a line is the highest probability
+    of any of its tokens being labelled 'B' or 'I' (or '<entity>-B' and '<entity>-I' for a joint model).
+
+    Parameters:
+        crf (sklearn_crfsuite.CRF): A trained CRF model.
+        lines (list): A list of lines, each a list of (word, label, POS) tuples.
+        entity (str): The entity being tagged.
+
+    Returns:
+        list: One score between 0 and 1 per line.
+    '''
+    labels = [l for l in crf.classes_ if l in ('B', 'I') or l.startswith(f'{entity}-')]
+    marginals = crf.predict_marginals([sent2features(s) for s in lines])
+    return [max((sum(token[l] for l in labels) for token in line), default=0.0) for line in marginals]
+
+
+
+def line_scores_lexical(lex_dict, lines):
+    '''
+    Scores lines with the lexical baseline: 1 if any word of the line, lower-cased and without punctuation
+    as in preprocess_for_lexical, is in the lexicon, 0 otherwise. Punctuation-only tokens are skipped: they become '',
+    which is in the lexicon whenever punctuation was inside an entity in the training data.
+    '''
+    table = str.maketrans("", "", punctuation)
+    scores = []
+    for line in lines:
+        words = (t[0].lower().translate(table) for t in line)
+        scores.append(float(any(w and w in lex_dict for w in words)))
+    return scores
+
+
+
+def choose_threshold(line_scores, has_entity, target_recall):
+    '''
+    Returns the highest threshold at which at least target_recall of the lines with an entity score at or above it.
+    '''
+    positive = sorted((s for s, e in zip(line_scores, has_entity) if e), reverse=True)
+    if not positive:
+        return 0.0
+    return positive[max(0, math.ceil(target_recall * len(positive)) - 1)]
+
+
+
+def cascade_predict(lines, line_scores, threshold, predict):
+    '''
+    Tags the lines scoring at or above the threshold with an expensive model and labels all other lines 'O'.
+
+    Parameters:
+        lines (list): A list of lines, each a list of (word, label, POS) tuples.
+        line_scores (list): The score of each line given by the cheap model.
+        threshold (float): The lowest score of a line passed to the expensive model.
+        predict (function): Takes a list of lines and returns a list of lists of BIO labels.
+
+    Returns:
+        tuple: A list of lists of BIO labels, one per token, and the list of indices of the flagged lines.
+    '''
+    flagged = [i for i, s in enumerate(line_scores) if s >= threshold]
+    predictions = [['O'] * len(line) for line in lines]
+    for i, labels in zip(flagged, predict([lines[i] for i in flagged]) if flagged else []):
+        predictions[i] = labels
+    return predictions, flagged
+
+
+
+def expensive_predictor(registry, entity):
+    '''
+    Returns a function tagging lines of (word, label, POS) tuples with the best model for an entity.
+    CRF models use the POS tags of the preprocessed data, transformers only the words.
+    '''
+    model = registry.get(entity)
+    if registry.entries[entity].kind == 'crf':
+        return lambda lines: list(model.predict([sent2features(s) for s in lines]))
+    return lambda lines: transformer_predict(model[0], model[1], [[t[0] for t in s] for s in lines])
+
+
+
+def main(args):
+    df = pd.read_csv(args.data).astype(str)
+    data = [list(zip(g['word'], g[args.entity], g['POS'])) for k, g in
+            df.groupby(df['word_id'].str.endswith('.0').cumsum())]
+    train_bin, eval_bin, test_bin = split(data)
+    O_checker(test_bin)
+
+    # cheap model
+    start = time.perf_counter()
+    if args.cheap == 'lexical':
+        lex_dict = lexi_maker(preprocess_for_lexical([[t[:2] for t in s] for s in train_bin]))
+        score = lambda lines: line_scores_lexical(lex_dict, lines)
+    else:
+        if args.cheap == 'crf':
+            crf = new_crf()
+            crf.fit([sent2features(s) for s in train_bin], [sent2labels(s) for s in train_bin])
+        else:
+            with open(args.cheap, 'rb') as f:
+                crf = pickle.load(f)
+        score = lambda lines: line_scores_crf(crf, lines, args.entity)
+    print(f"cheap model ({args.cheap}) ready in {time.perf_counter() - start:.1f}s")
+
+    has_entity = lambda lines: [any(t[1] != 'O' for t in s) for s in lines]
+    threshold = choose_threshold(score(eval_bin), has_entity(eval_bin), args.target_recall)
+    print(f"threshold for {args.target_recall:.1%} line recall on the evaluation split: {threshold:.4f}")
+
+    predict = expensive_predictor(ModelRegistry(args.models_dir), args.entity)
+    predict(test_bin[:1]) # warm up
+
+    start = time.perf_counter()
+    full = predict(test_bin)
+    full_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    test_scores = score(test_bin)
+    cascade, flagged = cascade_predict(test_bin, test_scores, threshold, predict)
+    cascade_seconds = time.perf_counter() - start
+
+    true = [t[1] for s in test_bin for t in s]
+    positives = has_entity(test_bin)
+    flagged_set = set(flagged)
+    line_recall = sum(1 for i, e in enumerate(positives) if e and i in flagged_set) / max(1, sum(positives))
+    entity_tokens = sum(1 for label in true if label != 'O')
+    missed_tokens = sum(1 for i, s in enumerate(test_bin) if i not in flagged_set for t in s if t[1] != 'O')
+    full_scores = scores(true, [l for line in full for l in line])
+    cascade_scores = scores(true, [l for line in cascade for l in line])
+
+    print(f"lines passed to the expensive model: {len(flagged)}/{len(test_bin)} ({len(flagged) / len(test_bin):.1%})")
+    print(f"line recall: {line_recall:.4f}, entity tokens in skipped lines: {missed_tokens}/{entity_tokens}")
+    print(f"f1 average: full {full_scores['f1_avg']:.4f}, cascade {cascade_scores['f1_avg']:.4f} "
+          f"(recall loss B {full_scores['recall_B'] - cascade_scores['recall_B']:.4f}, "
+          f"I {full_scores['recall_I'] - cascade_scores['recall_I']:.4f})")
+    print(f"time: full {full_seconds:.2f}s, cascade {cascade_seconds:.2f}s, speed-up {full_seconds / cascade_seconds:.2f}x")
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--entity', type=str, required=True, help="Entity to tag, e.g. 'NAME'.")
+    p.add_argument('--data', type=str, default='data/raw_ner_corpus.csv', help='Preprocessed NER subcorpus in csv.')
+    p.add_argument('--cheap', type=str, default='crf', help="Cheap model: 'crf', 'lexical' or the path to a CRF pickle.")
+    p.add_argument('--target_recall', type=float, default=0.99, help='Share of the lines with an entity that must be passed to the expensive model.')
+    p.add_argument('--models_dir', type=str, default=best_models_dir, help='Directory of the expensive models.')
+    args = p.parse_args()
+    main(args)
@@ -0,0 +1,343 @@
+import os
+import sys
+import re
+import time
+import json
+import pickle
+import argparse
+from collections import Counter, defaultdict
+from string import punctuation
+import pandas as pd
+from lxml import etree
+
+# inverted index over the master corpus, the letter texts and the letter metadata
+# postings map keys to the words (letter_id -> [position of the word in the letter]) they occur at, for three fields:
+#   word     the normalised word (lower case, no punctuation, as in preprocess_for_lexical), e.g. 'calleis'
+#   entity   (entity, normalised surface form of the whole span), e.g. ('LOCATION', 'calleis')
+#   vard     (VARD run, normalised original word, replacement), e.g. ('VARD_fscore_1.0_threshold_50', 'lettre', 'letter')
+# the metadata of process_export_keys_letters_people.csv is kept as a DataFrame indexed by letter_id, and the lines of
+# raw_data/letters.json are kept to show the context of a posting
+
+# positions keep the saved index small; hits() turns them back into word_ids
+# the index is saved as a pickle of its attributes; update() re-reads only the letters whose xml file has changed since the last build,
+# removing their old postings first, and reloads the metadata and texts when their files have changed
+
+# examples:
+#   python corpus_index.py --update
+#   python corpus_index.py --entity LOCATION Calais --departure_place London --year 1545
+#   python corpus_index.py --vard_top 1.0 50
+
+targets = ['NAME', 'LOCATION', 'NATION', 'MARKET', 'DATE', 'TIME', 'PRICE', 'GOD']
+
+fields = ['word', 'entity', 'vard']
+
+# metadata columns kept from process_export_keys_letters_people.csv
+metadata_columns = {'letters.dates.of_writing': 'date_of_writing',
+                    'letters.departure.place': 'departure_place', 'letters.departure.country': 'departure_country',
+                    'letters.destination.place': 'destination_place', 'letters.destination.country': 'destination_country'}
+
+_table = str.maketrans("", "", punctuation)
+
+
+
+def normalise(word):
+    '''
+    Lower-cases a word and removes punctuation, as preprocess_for_lexical does.
+    '''
+    return word.lower().translate(_table)
+
+
+
+def vard_run(fscore, threshold):
+    '''
+    Returns the attribute name of a VARD run, e.g. vard_run(1.0, 50) -> 'VARD_fscore_1.0_threshold_50'.
+    '''
+    return f'VARD_fscore_{float(fscore)}_threshold_{int(threshold)}'
+
+
+
+def signature(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+
+def letter_postings(path):
+    '''
+    Reads a master corpus letter. Returns its letter_id, the list of its word_ids and its postings as a list of
+    (field, key, position) tuples, where position is the index of the word in the list of word_ids.
+    '''
+    root = etree.parse(path).getroot()
+    letter_id = sys.intern(root.find('letter').get('letter_id'))
+    postings = []
+    word_ids = []
+    spans = {} # entity -> [position of the first word, words]
+    for i, word in enumerate(root.iter('word')):
+        word_ids.append(word.get('word_id'))
+        text = word.text or ''
+        normalised = sys.intern(normalise(text))
+        if normalised:
+            postings.append(('word', normalised, i))
+        for entity in targets:
+            label = word.get(entity)
+            if entity in spans and label != 'I':
+                start, words = spans.pop(entity)
+                postings.append(('entity', (entity, ' '.join(w for w in words if w)), start))
+            if label in ('B', 'I'):
+                spans.setdefault(entity, [i, []])[1].append(normalised)
+        for run, replacement in word.attrib.items():
+            if run.startswith('VARD_'):
+                postings.append(('vard', (sys.intern(run), normalised, sys.intern(replacement)), i))
+    for entity, (start, words) in spans.items():
+        postings.append(('entity', (entity, ' '.join(w for w in words if w)), start))
+    return letter_id, word_ids, postings
+
+
+
+def read_metadata(people_csv):
+    '''
+    Reads the letter metadata into a DataFrame indexed by letter_id, with the sender and addressee names,
+    the date of writing and its year, and the places and countries of departure and destination.
+    '''
+    df = pd.read_csv(people_csv, sep='\t', dtype=str).set_index('letters._id')
+    metadata = df[list(metadata_columns)].rename(columns=metadata_columns)
+    for p in ('sender', 'addressee'):
+        names = df[[f'{p}.first_name', f'{p}.middle_names', f'{p}.last_name']].fillna('')
+        metadata[p] = names.agg(' '.join, axis=1).str.split().str.join(' ')
+    metadata['year'] = pd.to_numeric(metadata['date_of_writing'].str.extract(r'(\d{4})$')[0], errors='coerce').astype('Int64')
+    metadata.index.name = 'letter_id'
+    return metadata
+
+
+
+def read_texts(json_file):
+    '''
+    Reads the lines of every letter in letters.json. Returns a dict of letter_id -> list of lines.
+    '''
+    with open(json_file) as f:
+        return {letter['_id']: letter['text'] for letter in json.load(f)}
+
+
+
+class CorpusIndex:
+    '''
+    An inverted index over the words, entity spans and VARD replacements of the master corpus letters,
+    with the letter metadata and texts.
+
+    Parameters:
+        master_dir (str): Directory of the master corpus letters.
+        json_file (str): Path to letters.json.
+        people_csv (str): Path to process_export_keys_letters_people.csv.
+
+    Example:
+        index = CorpusIndex.open('corpus_index.pkl')
+        index.query(entity=('LOCATION', 'Calais'), departure_place='London', year=1545)
+        index.vard_top(vard_run(1.0, 50))
+    '''
+    def __init__(self, master_dir='master_corpus', json_file='raw_data/letters.json',
+                 people_csv='raw_data/process_export_keys_letters_people.csv'):
+        self.master_dir = master_dir
+        self.json_file = json_file
+        self.people_csv = people_csv
+        self.postings = {f: defaultdict(dict) for f in fields} # field -> key -> letter_id -> [position]
+        self.word_ids = {} # letter_id -> [word_id]
+        self.letter_keys = {} # letter_id -> [(field, key)], to remove the postings of a letter
+        self.files = {} # xml file -> (signature, letter_id)
+        self.sources = {} # json or csv file -> signature
+        self.metadata = None
+        self.texts = {}
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        '''
+        Loads a saved index, or creates an empty one if there is none at path. The paths given in kwargs are kept
+        over the saved ones, and if master_dir is not the one the index was built from, an empty index is returned,
+        so that update() builds it again.
+        '''
+        index = cls(**kwargs)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            if os.path.abspath(state['master_dir']) != os.path.abspath(index.master_dir):
+                return index
+            state['postings'] = {f: defaultdict(dict, p) for f, p in state['postings'].items()}
+            paths = {k: getattr(index, k) for k in ('master_dir', 'json_file', 'people_csv')}
+            index.__dict__.update(state)
+            index.__dict__.update(paths)
+        return index
+
+    def save(self, path):
+        # the attributes are pickled rather than the index itself, so that it loads outside of this module
+        state = self.__dict__.copy()
+        state['postings'] = {f: dict(p) for f, p in self.postings.items()}
+        with open(path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def remove_letter(self, letter_id):
+        for field, key in self.letter_keys.pop(letter_id, []):
+            letters = self.postings[field][key]
+            letters.pop(letter_id, None)
+            if not letters:
+                del self.postings[field][key]
+        self.word_ids.pop(letter_id, None)
+
+    def add_letter(self, letter_id, word_ids, postings):
+        self.remove_letter(letter_id)
+        keys = {}
+        for field, key, position in postings:
+            self.postings[field][key].setdefault(letter_id, []).append(position)
+            keys[(field, key)] = None
+        self.letter_keys[letter_id] = list(keys)
+        self.word_ids[letter_id] = word_ids
+
+    def update(self):
+        '''
+        Re-indexes the letters whose xml file is new or has changed, removes the letters whose file is gone,
+        and reloads the metadata and texts if their files have changed.
+
+        Returns:
+            dict: The number of letters added, updated and removed.
+        '''
+        counts = Counter()
+        current = {os.path.join(self.master_dir, f) for f in os.listdir(self.master_dir) if f.endswith('.xml')}
+        for path in set(self.files) - current:
+            self.remove_letter(self.files.pop(path)[1])
+            counts['removed'] += 1
+        for path in sorted(current):
+            sig = signature(path)
+            if path in self.files and self.files[path][0] == sig:
+                continue
+            letter_id, word_ids, postings = letter_postings(path)
+            counts['updated' if path in self.files else 'added'] += 1
+            self.add_letter(letter_id, word_ids, postings)
+            self.files[path] = (sig, letter_id)
+
+        if self.sources.get(self.people_csv) != signature(self.people_csv):
+            self.metadata = read_metadata(self.people_csv)
+            self.sources[self.people_csv] = signature(self.people_csv)
+            counts['metadata'] += 1
+        if self.sources.get(self.json_file) != signature(self.json_file):
+            self.texts = read_texts(self.json_file)
+            self.sources[self.json_file] = signature(self.json_file)
+            counts['texts'] += 1
+        return dict(counts)
+
+    def hits(self, field, key):
+        '''
+        Returns the postings of a key as a dict of letter_id -> [word_id]. Words and entity surface forms
+        are normalised, so key may be given as it is written, e.g. hits('entity', ('LOCATION', 'Calais')).
+        '''
+        if field == 'word':
+            key = normalise(key)
+        elif field == 'entity':
+            key = (key[0], ' '.join(normalise(w) for w in key[1].split()))
+        return {letter_id: [self.word_ids[letter_id][i] for i in positions]
+                for letter_id, positions in self.postings[field].get(key, {}).items()}
+
+    def query(self, word=None, entity=None, **metadata):
+        '''
+        Returns the sorted letter_ids of the letters matching all of the conditions given.
+
+        Parameters:
+            word (str): A word the letter contains.
+            entity (tuple): An (entity, surface form) pair the letter contains, e.g. ('LOCATION', 'Calais').
+            metadata: Values of metadata columns, e.g. departure_place='London', year=1545; strings are
+            compared case-insensitively, and a (first, last) tuple selects a range, e.g. year=(1545, 1547).
+        '''
+        letters = None
+        for field, key in (('word', word), ('entity', entity)):
+            if key is not None:
+                found = set(self.hits(field, key))
+                letters = found if letters is None else letters & found
+        if metadata:
+            mask = pd.Series(True, index=self.metadata.index)
+            for column, value in metadata.items():
+                values = self.metadata[column]
+                if isinstance(value, tuple):
+                    mask &= values.between(*value).fillna(False).astype(bool)
+                elif isinstance(value, str):
+                    mask &= values.str.lower().eq(value.lower()).fillna(False).astype(bool)
+                else:
+                    mask &= values.eq(value).fillna(False).astype(bool)
+            found = set(self.metadata.index[mask])
+            letters = found if letters is None else letters & found
+        return sorted(letters if letters is not None else self.letter_keys)
+
+    def vard_top(self, run, n=20):
+        '''
+        Returns the n (original, replacement) pairs a VARD run makes most often, with their counts.
+        '''
+        counts = Counter()
+        for (r, original, replacement), letters in self.postings['vard'].items():
+            if r == run:
+                counts[(original, replacement)] += sum(len(w) for w in letters.values())
+        return counts.most_common(n)
+
+    def entity_forms(self, entity, n=20):
+        '''
+        Returns the n most frequent surface forms of an entity, with their counts.
+        '''
+        counts = Counter({form: sum(len(w) for w in letters.values())
+                          for (e, form), letters in self.postings['entity'].items() if e == entity})
+        return counts.most_common(n)
+
+    def context(self, word_id, width=8):
+        '''
+        Returns the words of letters.json around a word_id, up to width words on either side.
+        '''
+        letter_id, line, word = word_id.split('.')[:3]
+        words = self.texts[letter_id][int(line)].split(' ')
+        word = int(word)
+        return ' '.join(words[max(0, word - width):word + width + 1])
+
+
+
+def main(args):
+    start = time.perf_counter()
+    index = CorpusIndex.open(args.index, master_dir=args.master_corpus, json_file=args.json_file,
+                             people_csv=args.people)
+    print(f"index loaded in {(time.perf_counter() - start) * 1000:.0f}ms")
+    if args.update or not index.files:
+        start = time.perf_counter()
+        counts = index.update()
+        index.save(args.index)
+        print(f"index updated in {time.perf_counter() - start:.2f}s: {counts}")
+
+    metadata = {c: getattr(args, c) for c in ['sender', 'addressee', 'departure_place', 'destination_place'] if getattr(args, c)}
+    if args.year:
+        metadata['year'] = args.year[0] if len(args.year) == 1 else tuple(args.year)
+    if args.word or args.entity or metadata:
+        start = time.perf_counter()
+        letters = index.query(word=args.word, entity=tuple(args.entity) if args.entity else None, **metadata)
+        print(f"{len(letters)} letters in {(time.perf_counter() - start) * 1000:.2f}ms: {' '.join(letters)}")
+        if args.entity:
+            for letter_id in letters[:args.n]:
+                for word_id in index.hits('entity', tuple(args.entity))[letter_id]:
+                    print(f"  {word_id}: {index.context(word_id)}")
+    if args.vard_top:
+        start = time.perf_counter()
+        top = index.vard_top(vard_run(*args.vard_top), args.n)
+        print(f"{vard_run(*args.vard_top)} in {(time.perf_counter() - start) * 1000:.2f}ms")
+        for (original, replacement), count in top:
+            print(f"  {original} -> {replacement}: {count}")
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--index', type=str, default='corpus_index.pkl', help='Path of the saved index.')
+    p.add_argument('--master_corpus', type=str, default='master_corpus', help='Directory of the master corpus letters.')
+    p.add_argument('--json_file', type=str, default='raw_data/letters.json', help='Letters in json.')
+    p.add_argument('--people', type=str, default='raw_data/process_export_keys_letters_people.csv', help='Letters and people metadata in tsv.')
+    p.add_argument('--update', action='store_true', help='Re-index the letters that have changed since the index was saved.')
+    p.add_argument('--word', type=str, help='Letters containing a word.')
+    p.add_argument('--entity', type=str, nargs=2, metavar=('ENTITY', 'FORM'), help="Letters containing an entity span, e.g. LOCATION Calais.")
+    p.add_argument('--sender', type=str, help='Letters by a sender, e.g. "Otwell Johnson".')
+    p.add_argument('--addressee', type=str, help='Letters to an addressee.')
+    p.add_argument('--departure_place', type=str, help='Letters sent from a place.')
+    p.add_argument('--destination_place', type=str, help='Letters sent to a place.')
+    p.add_argument('--year', type=int, nargs='+', help='Letters written in a year, or in a range of years (first last).')
+    p.add_argument('--vard_top', type=str, nargs=2, metavar=('FSCORE', 'THRESHOLD'), help='Most frequent replacements of a VARD run, e.g. 1.0 50.')
+    p.add_argument('-n', type=int, default=20, help='Number of results to show.')
+    args = p.parse_args()
+    main(args)
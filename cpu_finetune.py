@@ -0,0 +1,283 @@
+import os
+import time
+import argparse
+import numpy as np
+import torch
+import evaluate
+from datasets import Dataset
+from transformers import AutoModelForTokenClassification, AutoTokenizer, TrainingArguments, Trainer
+from transformers import DataCollatorForTokenClassification, EarlyStoppingCallback
+from neural_datasets import load_entity_dataset, label2id, id2label
+from sampling import LineSampler, line_statistics, strategies
+
+# CPU fine-tuning of the token classification models in the neural notebooks
+
+# on CPU the cost of a step is proportional to the number of positions in the batch, so padding every line of a batch
+# to its longest line wastes most of the compute on the short lines of the letters
+# instead, the training lines are packed into sequences of up to --pack_length subtokens, longest lines first, so that
+# packed sequences are close to the same length and carry almost no padding
+# every line keeps its own [CLS] and [SEP] tokens and its position ids restart at 0, and a block-diagonal attention mask
+# stops the lines of a packed sequence from attending to each other, so each line is encoded as it would be on its own
+
+# evaluation is run on the unpacked lines, sorted by length, so that compute_metrics and the seqeval scores are computed
+# on exactly the same sequences as in the notebooks
+
+# the training lines can be resampled with --sampling (see sampling.py): the train dataloader draws the line indices of
+# every epoch from the LineSampler, so each epoch sees a new seeded resample and repeated lines are never copied;
+# a packed sequence holds several lines, so sampling is done on unpacked lines (--no_packing)
+
+# example:
+#   python cpu_finetune.py --entity NAME --data data/raw_ner_corpus.csv --model dslim/bert-base-NER --threads 8
+
+label_list = ["O", "B", "I"]
+
+# the seqeval framework, loaded on the first evaluation so that the module can be imported and trained from elsewhere
+seqeval = None
+
+
+
+def pack_lines(dataset, pack_length):
+    '''
+    Packs lines into sequences of at most pack_length subtokens, first-fit with the longest lines first.
+
+    Parameters:
+        dataset (datasets.Dataset): Tokenized lines with 'input_ids' and 'labels' columns.
+        pack_length (int): Maximum number of subtokens per packed sequence; raised to the longest line if shorter.
+
+    Returns:
+        datasets.Dataset: One row per packed sequence with the columns input_ids, labels, position_ids and
+        seq_lens (the number of subtokens of each line in the sequence).
+    '''
+    input_ids = dataset['input_ids']
+    labels = dataset['labels']
+    lengths = [len(ids) for ids in input_ids]
+    pack_length = max([pack_length] + lengths)
+
+    bins = [] # [free positions, row indices]
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for b in bins:
+            if b[0] >= lengths[i]:
+                b[0] -= lengths[i]
+                b[1].append(i)
+                break
+        else:
+            bins.append([pack_length - lengths[i], [i]])
+
+    packed = {'input_ids': [], 'labels': [], 'position_ids': [], 'seq_lens': []}
+    for _, rows in bins:
+        packed['input_ids'].append([t for i in rows for t in input_ids[i]])
+        packed['labels'].append([l for i in rows for l in labels[i]])
+        packed['position_ids'].append([p for i in rows for p in range(lengths[i])])
+        packed['seq_lens'].append([lengths[i] for i in rows])
+    return Dataset.from_dict(packed)
+
+
+
+class PackedCollator:
+    '''
+    Pads packed sequences to the longest sequence in the batch and builds their block-diagonal attention masks.
+    Batches of unpacked lines (without 'seq_lens') are passed to DataCollatorForTokenClassification.
+    '''
+    def __init__(self, tokenizer):
+        self.pad_token_id = tokenizer.pad_token_id
+        self.token_classification = DataCollatorForTokenClassification(tokenizer=tokenizer)
+
+    def __call__(self, features):
+        if 'seq_lens' not in features[0]:
+            keys = ['input_ids', 'attention_mask', 'token_type_ids', 'labels']
+            return self.token_classification([{k: f[k] for k in keys if k in f} for f in features])
+
+        length = max(len(f['input_ids']) for f in features)
+        input_ids = torch.full((len(features), length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(features), length), -100, dtype=torch.long)
+        position_ids = torch.zeros((len(features), length), dtype=torch.long)
+        # [batch, head, query, key]; True where attention is allowed, broadcast over the heads
+        attention_mask = torch.zeros((len(features), 1, length, length), dtype=torch.bool)
+        for b, f in enumerate(features):
+            n = len(f['input_ids'])
+            input_ids[b, :n] = torch.tensor(f['input_ids'])
+            labels[b, :n] = torch.tensor(f['labels'])
+            position_ids[b, :n] = torch.tensor(f['position_ids'])
+            start = 0
+            for seq_len in f['seq_lens']:
+                attention_mask[b, 0, start:start + seq_len, start:start + seq_len] = True
+                start += seq_len
+            # padding positions only attend to themselves, so that no row of the mask is empty
+            padding = torch.arange(n, length)
+            attention_mask[b, 0, padding, padding] = True
+        return {'input_ids': input_ids, 'attention_mask': attention_mask, 'position_ids': position_ids, 'labels': labels}
+
+
+
+def sort_by_length(dataset):
+    '''
+    Sorts unpacked lines by length so that evaluation batches are padded to similar lengths.
+    '''
+    return dataset.select(np.argsort([len(ids) for ids in dataset['input_ids']], kind='stable'))
+
+
+
+def compute_metrics(p):
+    global seqeval
+    if seqeval is None:
+        seqeval = evaluate.load("seqeval")
+
+    predictions, labels = p
+    predictions = np.argmax(predictions, axis=2)
+    true_predictions = [
+        [label_list[p] for (p, l) in zip(prediction, label) if l != -100]
+        for prediction, label in zip(predictions, labels)
+    ]
+
+    true_labels = [
+        [label_list[l] for (p, l) in zip(prediction, label) if l != -100]
+        for prediction, label in zip(predictions, labels)
+    ]
+
+    results = seqeval.compute(predictions=true_predictions, references=true_labels)
+
+    return {
+        "precision": results["overall_precision"],
+        "recall": results["overall_recall"],
+        "f1": results["overall_f1"],
+        "accuracy": results["overall_accuracy"],
+    }
+
+
+
+class EpochSampler(torch.utils.data.Sampler):
+    '''
+    Yields the line indices drawn by a LineSampler for the current epoch; the Trainer calls set_epoch at the start
+    of every epoch through the dataloader.
+    '''
+    def __init__(self, line_sampler):
+        self.line_sampler = line_sampler
+        self.epoch = 0
+        self.length = len(line_sampler.indices(0)) # the same for every epoch
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        return iter(self.line_sampler.indices(self.epoch).tolist())
+
+    def __len__(self):
+        return self.length
+
+
+
+class SampledTrainer(Trainer):
+    '''
+    A Trainer that reads the training lines in the order drawn by an EpochSampler.
+    '''
+    def __init__(self, *args, train_sampler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_sampler = train_sampler
+
+    def _get_train_sampler(self, *args, **kwargs):
+        if self.train_sampler is not None:
+            return self.train_sampler
+        return super()._get_train_sampler(*args, **kwargs)
+
+
+
+class EpochTimer(EarlyStoppingCallback):
+    '''
+    Early stopping with a patience of 3, as in the notebooks, that also prints the wall-clock time of every epoch.
+    '''
+    def __init__(self):
+        super().__init__(early_stopping_patience=3)
+        self.start = None
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        print(f"epoch {state.epoch:.0f}: {time.perf_counter() - self.start:.1f}s")
+
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer or args.model)
+    splits = load_entity_dataset(args.data, args.tokenizer or args.model, args.entity, max_length=args.max_length)
+    columns = [c for c in ['input_ids', 'attention_mask', 'token_type_ids', 'labels'] if c in splits['train'].column_names]
+    train_dataset = splits['train'].select_columns(columns)
+    train_sampler = None
+    if args.sampling != 'none':
+        lines = [[(id2label[tag], id2label[tag]) for tag in tags] for tags in splits['train']['ner_tags']]
+        sampler = LineSampler(*line_statistics(lines), args.sampling, args.negative_keep, args.oversample, args.seed)
+        train_sampler = EpochSampler(sampler)
+        print(f"{args.sampling} sampling, epoch 0: {sampler.summary()}")
+    if args.packing:
+        train_dataset = pack_lines(train_dataset, args.pack_length)
+    eval_dataset = sort_by_length(splits['eval'].select_columns(columns))
+    print(f"training data: {splits['train'].num_rows} lines in {train_dataset.num_rows} sequences, "
+          f"{sum(len(ids) for ids in train_dataset['input_ids'])} subtokens")
+
+    model = AutoModelForTokenClassification.from_pretrained(
+        args.model, num_labels=3, id2label=id2label, label2id=label2id, ignore_mismatched_sizes=True
+    )
+
+    training_args = TrainingArguments(
+        output_dir=args.output_dir,
+        learning_rate=2e-5,
+        per_device_train_batch_size=args.batch_size,
+        per_device_eval_batch_size=16,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        num_train_epochs=args.epochs,
+        weight_decay=0.01,
+        eval_strategy="epoch",
+        save_strategy="epoch",
+        load_best_model_at_end=True,
+        logging_strategy="steps",
+        logging_steps=100,
+        use_cpu=True,
+        dataloader_num_workers=args.dataloader_workers,
+        remove_unused_columns=False, # seq_lens is read by the collator, not the model
+    )
+
+    trainer = SampledTrainer(
+        model=model,
+        args=training_args,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        processing_class=tokenizer,
+        data_collator=PackedCollator(tokenizer),
+        compute_metrics=compute_metrics,
+        callbacks=[EpochTimer()],
+        train_sampler=train_sampler,
+    )
+
+    trainer.train()
+    trainer.save_model(args.save_dir)
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--entity', type=str, required=True, help="Entity to fine-tune on, e.g. 'NAME'.")
+    p.add_argument('--data', type=str, default='data/raw_ner_corpus.csv', help='Preprocessed NER subcorpus in csv.')
+    p.add_argument('--model', type=str, default='dslim/bert-base-NER', help='Pretrained model to fine-tune.')
+    p.add_argument('--tokenizer', type=str, help='Tokenizer, if different from the model.')
+    p.add_argument('--save_dir', type=str, help='Directory in which to store the fine-tuned model.')
+    p.add_argument('--output_dir', type=str, default='cpu_finetune', help='Directory for Trainer checkpoints.')
+    p.add_argument('--threads', type=int, default=os.cpu_count(), help='Number of CPU threads used by torch.')
+    p.add_argument('--batch_size', type=int, default=4, help='Packed sequences (or lines, without packing) per step.')
+    p.add_argument('--gradient_accumulation_steps', type=int, default=1, help='Steps per optimizer update.')
+    p.add_argument('--pack_length', type=int, default=512, help='Maximum number of subtokens per packed sequence.')
+    p.add_argument('--no_packing', dest='packing', action='store_false', help='Train on unpacked lines padded per batch, as in the notebooks, for comparison.')
+    p.add_argument('--epochs', type=int, default=10, help='Maximum number of epochs.')
+    p.add_argument('--max_length', type=int, default=512, help='Maximum number of subtokens per line.')
+    p.add_argument('--sampling', type=str, default='none', choices=strategies, help='Resampling of the training lines in every epoch, see sampling.py. Requires --no_packing.')
+    p.add_argument('--negative_keep', type=float, default=0.0, help='Share of the lines without an entity kept when undersampling.')
+    p.add_argument('--oversample', type=float, default=2.0, help='Average number of times a positive line is used when oversampling.')
+    p.add_argument('--seed', type=int, default=42, help='Seed of the sampling draws.')
+    p.add_argument('--dataloader_workers', type=int, default=0, help='Worker processes for collating batches.')
+    args = p.parse_args()
+    if args.sampling != 'none' and args.packing:
+        p.error('--sampling resamples unpacked lines, use it with --no_packing')
+    args.save_dir = args.save_dir or os.path.join(args.output_dir, f'{args.entity.lower()}_cpu')
+
+    main(args)
@@ -2,6 +2,7 @@ from lxml import etree
 import pandas as pd
 import os
 import argparse
+from instrumentation import span, count, log
 
 # MUST BE RUN INSIDE VARD WORKING FOLDER
 
@@ -25,10 +26,10 @@ else:
 df = pd.read_csv(annotations, sep='\t')
 df = df.dropna()
 
-for xml_file in os.listdir(gs_corpus):
-    if not xml_file.endswith(".xml"):
-        continue
-    letter_id = os.path.splitext(xml_file)[0]
+def reconcile(xml_file, letter_id):
+    '''
+    Writes a letter to the master corpus with the B and I labels of its annotations as word attributes.
+    '''
     input_file = open(os.path.join(gs_corpus, xml_file),"r",encoding="utf-8")
     output_file = os.path.join(master_corpus, xml_file)
     parser = etree.XMLParser(remove_blank_text=True)
@@ -36,24 +37,36 @@ for xml_file in os.listdir(gs_corpus):
     root = tree.getroot()
 
     for wn,word in enumerate(root.findall('.//word')):
-        for id,span,tag in zip(df['letters._id'],df['free_annotations.span'],df['free_annotations.annotations.NER']):
-            f = span.split('/')
+        count('words processed')
+        for id,annotation_span,tag in zip(df['letters._id'],df['free_annotations.span'],df['free_annotations.annotations.NER']):
+            f = annotation_span.split('/')
             start,end = f
             start = int(start)
             end = int(end)
             if letter_id == id:
                 if wn == start:
                     word.attrib[f'{tag}'] = 'B'
-                    print(f"Reconciling a {tag} tag in letter {letter_id}")
+                    log(f"Reconciling a {tag} tag in letter {letter_id}")
+                    count('tags reconciled')
                 if wn != start and wn == end:
                     word.attrib[f'{tag}'] = 'I'
-                    print(f"Reconciling a {tag} tag in letter {letter_id}")
+                    log(f"Reconciling a {tag} tag in letter {letter_id}")
+                    count('tags reconciled')
                 else:
                     if wn in range(start+1,end):
                         word.attrib[f'{tag}'] = 'I'
-                        print(f"Reconciling a {tag} tag in letter {letter_id}")
+                        log(f"Reconciling a {tag} tag in letter {letter_id}")
+                        count('tags reconciled')
                     else:
                         continue
 
     with open(output_file,"w",encoding="utf-8") as g:
         g.write(etree.tostring(tree, pretty_print=True, encoding="unicode"))
+
+for xml_file in os.listdir(gs_corpus):
+    if not xml_file.endswith(".xml"):
+        continue
+    letter_id = os.path.splitext(xml_file)[0]
+    with span('letter', letter_id=letter_id):
+        reconcile(xml_file, letter_id)
+    count('letters')
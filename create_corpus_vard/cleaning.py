@@ -0,0 +1,23 @@
+# cleaning of the text of the letters, shared by the corpus scripts (letter_store.py) and, through my_functions.py,
+# by the tagging of new letters, so that new text is split into the same words as the master corpus
+
+# the text is cleaned with one precompiled translation table instead of a str.replace per character
+
+_table = str.maketrans('', '', '_/[]')
+
+
+
+def replacer(word):
+    '''
+    Replaces extraneous characters present in a word with specified replacements.
+
+    Parameters:
+        word (str): The input word (or line) that may contain extraneous characters.
+
+    Returns:
+        str: The word with extraneous characters replaced as follows:
+            - Replaces '_', '/', '[', and ']' with an empty string ''.
+            - Replaces '&amp;' with '&' (replaces HTML-encoded ampersand).
+    '''
+    word = word.translate(_table)
+    return word.replace('&amp;', '&') if '&' in word else word
@@ -2,6 +2,7 @@ import argparse
 import os
 import shutil
 import pandas as pd
+from instrumentation import span, count, log
 
 # MUST BE RUN INSIDE VARD WORKING FOLDER
 
@@ -24,8 +25,11 @@ targets = ['NAME', 'LOCATION', 'NATION', 'MARKET', 'DATE', 'TIME', 'PRICE', 'GOD
 for xml_file in os.listdir(master_corpus):
     if xml_file.endswith(".xml"):
         input_path = os.path.join(master_corpus, xml_file)
-        shared_attrs = pd.read_xml(input_path, xpath="./*/*").columns.intersection(targets)
+        with span('letter', letter_id=os.path.splitext(xml_file)[0]):
+            shared_attrs = pd.read_xml(input_path, xpath="./*/*").columns.intersection(targets)
+        count('letters')
         if shared_attrs.size >= 1:
             output_file = os.path.join(tagged_corpus, xml_file)
             shutil.copy(input_path, output_file)
-            print(f'Copying letter {xml_file} to annotated letters directory')
+            log(f'Copying letter {xml_file} to annotated letters directory')
+            count('annotated letters')
@@ -2,6 +2,7 @@ from lxml import etree
 import os
 import argparse
 from collections import Counter
+from instrumentation import span, count, log
 
 # MUST BE RUN INSIDE VARD WORKING FOLDER
 
@@ -29,10 +30,11 @@ for f in args.fscores.split():
         attributes.append(f'VARD_fscore_{f}_threshold_{t}')
 
 # check unicity of VARD runs at the corpus level
-full_corpus_word_list = {}
-for attribute in attributes:
+def read_vard_run(attribute):
+    '''
+    Returns the words of the corpus as normalised by a VARD run, with the original word where the run made no change.
+    '''
     vard_run_word_list = []
-    print(f"Checking unicity of {attribute} at corpus level.")
     for xml_file in os.listdir(processed_corpus):
         if not xml_file.endswith(".xml"):
             continue
@@ -45,7 +47,14 @@ for attribute in attributes:
                 vard_run_word_list.append(word.attrib[f'{attribute}'])
             else:
                 vard_run_word_list.append(word.text)
-    full_corpus_word_list[f'{attribute}'] = vard_run_word_list
+    return vard_run_word_list
+
+full_corpus_word_list = {}
+for attribute in attributes:
+    print(f"Checking unicity of {attribute} at corpus level.")
+    with span('unicity', attribute=attribute):
+        full_corpus_word_list[f'{attribute}'] = read_vard_run(attribute)
+    count('VARD runs')
 
 # create dictionary with unique VARD runs as keys
 r = {}
@@ -53,11 +62,13 @@ for k,v in full_corpus_word_list.items():
     if not tuple(v) in r.values():
        r[k] = tuple(v)
 {k: list(v) for k, v in r.items()}
+count('unique VARD runs', len(r))
 
-for xml_file in os.listdir(processed_corpus):
-    if not xml_file.endswith(".xml"):
-        continue
-    letter_id = os.path.splitext(xml_file)[0]
+def write_unique_runs(xml_file, letter_id):
+    '''
+    Writes a letter with the unique VARD runs only, and records the number of words normalised by each run
+    and the unicity of each run in a <VARD> element.
+    '''
     input_file = open(os.path.join(processed_corpus, xml_file),"r",encoding="utf-8")
     output_file = os.path.join(gs_corpus, xml_file)
     parser = etree.XMLParser(remove_blank_text=True)
@@ -66,8 +77,9 @@ for xml_file in os.listdir(processed_corpus):
     VARD_count = Counter()
 
     # count instances of words normalised by VARD
-    print(f"Counting instances of word tokens normalised by VARD in letter {letter_id}")
+    log(f"Counting instances of word tokens normalised by VARD in letter {letter_id}")
     for word in root.findall('.//word'):
+        count('words processed')
         for attr in attributes:
             if attr in word.attrib:
                 VARD_count[f'{attr}'] += 1
@@ -91,6 +103,7 @@ for xml_file in os.listdir(processed_corpus):
                 continue
             if not attr in r.keys():
                 del word.attrib[f'{attr}']
+                count('attributes removed')
             else:
                 continue
 
@@ -110,3 +123,11 @@ for xml_file in os.listdir(processed_corpus):
 
     with open(output_file,"w",encoding="utf-8") as g:
         g.write(etree.tostring(tree, pretty_print=True, encoding="unicode"))
+
+for xml_file in os.listdir(processed_corpus):
+    if not xml_file.endswith(".xml"):
+        continue
+    letter_id = os.path.splitext(xml_file)[0]
+    with span('letter', letter_id=letter_id):
+        write_unique_runs(xml_file, letter_id)
+    count('letters')
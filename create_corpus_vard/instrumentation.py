@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+import traceback
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+# lightweight instrumentation for the corpus pipeline scripts and preprocessing.py
+
+# every stage reports into this module through span() (timed sections, e.g. per stage and per letter),
+# count() (counters such as words processed or tags reconciled) and log() (messages that used to be printed for every hit)
+# nothing needs to be edited in the scripts to use it; it is configured with environment variables:
+
+#   PIPELINE_TRACE=trace.jsonl   append one json line per span, plus a summary per script, to this file
+#   PIPELINE_PROFILE=cprofile    profile the whole script with cProfile, written to <script>.prof
+#   PIPELINE_PROFILE=sample      sample the main thread's stack every PIPELINE_SAMPLE_MS (default 5) milliseconds,
+#                                written to <script>.samples.txt in collapsed-stack format (for flame graphs)
+#   PIPELINE_VERBOSE=1           print the messages passed to log()
+
+# to summarise a trace file: python instrumentation.py trace.jsonl
+
+trace_file = os.environ.get('PIPELINE_TRACE')
+profile_mode = os.environ.get('PIPELINE_PROFILE')
+verbose = os.environ.get('PIPELINE_VERBOSE', '') not in ('', '0')
+script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'interactive'
+
+counters = Counter()
+totals = defaultdict(lambda: [0, 0.0]) # span name -> [calls, seconds]
+_local = threading.local() # the open spans of each thread, so that a span's parent is in its own thread
+_trace = None
+_start = time.perf_counter()
+
+
+
+def peak_rss_mb():
+    '''
+    Returns the memory high-water mark (peak resident set size) of the process in MB.
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024 # bytes on macOS, kilobytes on Linux
+
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+
+def _emit(event):
+    global _trace
+    if trace_file is None:
+        return
+    if _trace is None:
+        _trace = open(trace_file, 'a', encoding='utf-8')
+    _trace.write(json.dumps(event) + '\n')
+
+
+
+@contextmanager
+def span(name, **attrs):
+    '''
+    Times a section of a stage, e.g. with span('postprocess', letter_id=letter_id): ...
+
+    Parameters:
+        name (str): The name of the section. Sections with the same name are aggregated in the summary.
+        **attrs: Attributes recorded with the span in the trace file, e.g. the letter_id.
+    '''
+    stack = _stack()
+    stack.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        stack.pop()
+        total = totals[name]
+        total[0] += 1
+        total[1] += duration
+        if trace_file is not None:
+            _emit({'type': 'span', 'script': script, 'name': name, 'parent': stack[-1] if stack else None,
+                   'ts': round(start - _start, 6), 'dur': round(duration, 6), 'peak_rss_mb': round(peak_rss_mb(), 1),
+                   'pid': os.getpid(), 'args': attrs})
+
+
+
+def count(name, n=1):
+    '''
+    Increments a counter, e.g. count('words processed', len(words)).
+    '''
+    counters[name] += n
+
+
+
+def log(message):
+    '''
+    Prints a message only when PIPELINE_VERBOSE is set, for messages that would otherwise be printed for every hit.
+    '''
+    if verbose:
+        print(message)
+
+
+
+def _summary():
+    elapsed = time.perf_counter() - _start
+    top_level = {k: {'calls': v[0], 'seconds': round(v[1], 3)} for k, v in totals.items()}
+    _emit({'type': 'summary', 'script': script, 'seconds': round(elapsed, 3), 'peak_rss_mb': round(peak_rss_mb(), 1),
+           'pid': os.getpid(), 'spans': top_level, 'counters': dict(counters)})
+    if _trace is not None:
+        _trace.close()
+    if totals or counters:
+        counts = ', '.join(f'{k}: {v}' for k, v in counters.items())
+        print(f"[{script}] {elapsed:.1f}s, peak RSS {peak_rss_mb():.0f}MB" + (f", {counts}" if counts else ''))
+
+
+
+class _Sampler(threading.Thread):
+    '''
+    Samples the stack of the main thread at a fixed interval and aggregates the samples as collapsed stacks.
+    '''
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = Counter()
+        self.main_id = threading.main_thread().ident
+        self.running = True
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.main_id)
+            if frame is not None:
+                stack = traceback.extract_stack(frame)
+                self.samples[';'.join(f'{os.path.basename(f.filename)}:{f.name}:{f.lineno}' for f in stack)] += 1
+            time.sleep(self.interval)
+
+    def write(self, path):
+        self.running = False
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, n in self.samples.most_common():
+                f.write(f'{stack} {n}\n')
+
+
+
+if profile_mode == 'cprofile':
+    import cProfile
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+    atexit.register(lambda: (_profiler.disable(), _profiler.dump_stats(f'{script}.prof')))
+elif profile_mode == 'sample':
+    _sampler = _Sampler(float(os.environ.get('PIPELINE_SAMPLE_MS', 5)) / 1000)
+    _sampler.start()
+    atexit.register(lambda: _sampler.write(f'{script}.samples.txt'))
+
+atexit.register(_summary)
+
+
+
+def summarise(path):
+    '''
+    Prints the time, calls and memory high-water mark of every span name in a trace file,
+    and the counters of every script, in the order the scripts were run.
+    '''
+    with open(path, encoding='utf-8') as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    for event in events:
+        if event['type'] != 'summary':
+            continue
+        print(f"{event['script']}: {event['seconds']:.2f}s, peak RSS {event['peak_rss_mb']:.0f}MB")
+        for name, total in sorted(event['spans'].items(), key=lambda kv: -kv[1]['seconds']):
+            print(f"    {name:<30} {total['seconds']:>10.2f}s {total['calls']:>8} calls")
+        for name, n in event['counters'].items():
+            print(f"    {name:<30} {n:>10}")
+
+
+
+if __name__ == '__main__':
+    summarise(sys.argv[1])
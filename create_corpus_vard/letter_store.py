@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+from array import array
+from lxml import etree
+from instrumentation import span, count, peak_rss_mb
+from cleaning import replacer
+
+# streaming ingestion of letters.json into a compact representation of the letters
+# the json file is decoded one letter at a time (iter_letters), so a full archive never has to be held in memory as
+# python objects, and each letter is stored as
+#   tokens   an array of ids into a vocabulary shared by all letters, one per word as create_corpus.py splits them
+#   offsets  an array of the index of the first token of every line, plus the number of tokens
+# in a Letter record with __slots__; word_ids are not stored, as they follow from the letter_id and the offsets
+
+# the text is cleaned a line at a time with replacer (cleaning.py)
+
+# create_corpus.py and pipeline.py stream the letters with iter_letters and build the xml of each letter directly
+# with letter_xml: create_corpus.py writes and drops one letter at a time, while pipeline.py keeps the elements of every
+# letter, as its stages update them in memory
+# the xml of a letter in the store is built on demand with Letter.to_xml
+
+# to compare the memory of the store with one lxml element per word (as pipeline.py keeps them):
+#   python letter_store.py --json_file ../raw_data/letters.json --compare --repeat 10
+
+
+
+def iter_letters(json_file, chunk_size=1 << 20):
+    '''
+    Yields the letters of a json file one at a time, reading it in chunks.
+    The file may hold a json list of letters, as letters.json does, or one letter per line.
+
+    Parameters:
+        json_file (str): Path to json file containing letters.
+        chunk_size (int): Number of characters read at a time.
+
+    Yields:
+        dict: A letter, with at least '_id' and 'text' (a list of lines).
+    '''
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    with open(json_file, encoding='utf-8') as f:
+        eof = False
+        while True:
+            # skip whitespace and the list delimiters between letters
+            while position < len(buffer) and buffer[position] in ' \t\r\n[],':
+                position += 1
+            if position == len(buffer):
+                if eof:
+                    return
+                buffer, position = f.read(chunk_size), 0
+                eof = not buffer
+                continue
+            try:
+                letter, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the letter continues in the next chunk
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            position = end
+            yield letter
+
+
+
+def letter_xml(letter_id, lines):
+    '''
+    Builds the xml representation of a letter, as create_corpus.py writes it. Returns the <root> element.
+
+    Parameters:
+        letter_id (str): The letter_id.
+        lines (iterable): The lines of the letter, each a list of words.
+    '''
+    root = etree.Element("root")
+    letter_element = etree.SubElement(root, "letter")
+    letter_element.attrib['letter_id'] = letter_id
+    for ln, words in enumerate(lines):
+        for wn, word in enumerate(words):
+            word_element = etree.SubElement(letter_element, "word")
+            word_element.text = word
+            word_element.attrib['word_id'] = f'{letter_id}.{ln}.{wn}'
+    return root
+
+
+
+def split_text(text):
+    '''
+    Cleans the lines of a letter with replacer and splits them into words, as create_corpus.py does.
+    '''
+    return [replacer(line).split(' ') for line in text]
+
+
+
+class Vocabulary:
+    '''
+    Interns words as consecutive integer ids.
+    '''
+    __slots__ = ('ids', 'words')
+
+    def __init__(self):
+        self.ids = {}
+        self.words = []
+
+    def __len__(self):
+        return len(self.words)
+
+    def encode(self, words):
+        '''
+        Returns the ids of a list of words, adding the words not seen before.
+        '''
+        ids = self.ids
+        encoded = []
+        for word in words:
+            i = ids.get(word)
+            if i is None:
+                i = ids[word] = len(self.words)
+                self.words.append(word)
+            encoded.append(i)
+        return encoded
+
+    def decode(self, ids):
+        words = self.words
+        return [words[i] for i in ids]
+
+
+
+class Letter:
+    '''
+    A letter as an array of vocabulary ids, with the offset of the first token of each line.
+    '''
+    __slots__ = ('letter_id', 'tokens', 'offsets')
+
+    def __init__(self, letter_id, tokens, offsets):
+        self.letter_id = letter_id
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def lines(self, vocab):
+        '''
+        Returns the words of the letter as a list of lines.
+        '''
+        words = vocab.decode(self.tokens)
+        return [words[start:end] for start, end in zip(self.offsets, self.offsets[1:])]
+
+    def to_xml(self, vocab):
+        '''
+        Builds the xml representation of the letter, as create_corpus.py writes it. Returns the <root> element.
+        '''
+        return letter_xml(self.letter_id, self.lines(vocab))
+
+
+
+class LetterStore:
+    '''
+    The letters of a corpus in a compact representation, with a shared vocabulary.
+
+    Example:
+        store = LetterStore().ingest('raw_data/letters.json')
+        store['SB_J_1'].lines(store.vocab)
+    '''
+    __slots__ = ('vocab', 'letters')
+
+    def __init__(self):
+        self.vocab = Vocabulary()
+        self.letters = {}
+
+    def __len__(self):
+        return len(self.letters)
+
+    def __iter__(self):
+        return iter(self.letters.values())
+
+    def __getitem__(self, letter_id):
+        return self.letters[letter_id]
+
+    def add(self, letter_id, text):
+        '''
+        Adds a letter from its list of lines. Returns its Letter record.
+        '''
+        tokens = array('I')
+        offsets = array('I', [0])
+        for words in split_text(text):
+            tokens.extend(self.vocab.encode(words))
+            offsets.append(len(tokens))
+        letter = self.letters[letter_id] = Letter(sys.intern(letter_id), tokens, offsets)
+        return letter
+
+    def ingest(self, json_file):
+        '''
+        Adds the letters of a json file, streaming it one letter at a time. Returns the store.
+        '''
+        with span('ingest', json_file=json_file):
+            for letter in iter_letters(json_file):
+                count('words processed', len(self.add(letter['_id'], letter['text'])))
+                count('letters')
+        return self
+
+    def tokens(self):
+        return sum(len(letter) for letter in self)
+
+    def nbytes(self):
+        '''
+        Returns an estimate of the memory used by the store in bytes: the token and offset arrays,
+        the letter records and the vocabulary.
+        '''
+        arrays = sum(sys.getsizeof(letter.tokens) + sys.getsizeof(letter.offsets) + sys.getsizeof(letter)
+                     for letter in self)
+        vocab = (sys.getsizeof(self.vocab.ids) + sys.getsizeof(self.vocab.words)
+                 + sum(sys.getsizeof(word) for word in self.vocab.words))
+        return arrays + vocab + sys.getsizeof(self.letters)
+
+
+
+def measure(json_file, mode, repeat):
+    '''
+    Loads the letters of a json file repeat times, as one lxml element per word ('dom') or into a LetterStore
+    ('store'), and returns the number of tokens and the growth of the peak memory of the process in MB.
+    '''
+    before = peak_rss_mb()
+    store = LetterStore()
+    letters = {}
+    for r in range(repeat):
+        for letter in iter_letters(json_file):
+            letter_id = f"{letter['_id']}_{r}" if r else letter['_id']
+            if mode == 'store':
+                store.add(letter_id, letter['text'])
+            else:
+                # keep the elements of every letter, as pipeline.build_letters does
+                letters[letter_id] = letter_xml(letter_id, split_text(letter['text']))
+    tokens = sum(len(root[0]) for root in letters.values()) if mode == 'dom' else store.tokens()
+    return tokens, peak_rss_mb() - before
+
+
+
+def main(args):
+    if args.measure:
+        tokens, mb = measure(args.json_file, args.measure, args.repeat)
+        print(json.dumps({'tokens': tokens, 'mb': mb}))
+        return
+
+    store = LetterStore().ingest(args.json_file)
+    print(f"{len(store)} letters, {store.tokens()} tokens, {len(store.vocab)} distinct words, "
+          f"{store.nbytes() / 2 ** 20:.1f}MB")
+    if args.compare:
+        # each representation is measured in a fresh process, so that the peak memory of one does not hide the other
+        for mode in ['dom', 'store']:
+            result = subprocess.run([sys.executable, os.path.abspath(__file__), '--json_file', args.json_file,
+                                     '--measure', mode, '--repeat', str(args.repeat)],
+                                    capture_output=True, text=True, check=True)
+            result = json.loads(next(l for l in result.stdout.splitlines() if l.startswith('{')))
+            print(f"{mode}: {result['tokens']} tokens, {result['mb']:.1f}MB, "
+                  f"{result['mb'] / result['tokens'] * 1e6:.1f}MB per million tokens")
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--json_file', type=str, help='Path to json file containing letters.')
+    p.add_argument('--compare', action='store_true', help='Compare the memory of the store with one lxml element per word.')
+    p.add_argument('--repeat', type=int, default=1, help='Number of times the letters are loaded for --compare, to simulate a larger archive.')
+    p.add_argument('--measure', type=str, choices=['dom', 'store'], help=argparse.SUPPRESS)
+    args = p.parse_args()
+    main(args)
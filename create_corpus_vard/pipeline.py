@@ -0,0 +1,295 @@
+import os
+import shutil
+import argparse
+import subprocess
+from collections import Counter, defaultdict
+from lxml import etree
+import pandas as pd
+from natsort import natsort_key
+from instrumentation import span, count
+from letter_store import iter_letters, letter_xml, split_text
+
+# MUST BE RUN INSIDE VARD WORKING FOLDER
+
+# single-process runner for the whole of preprocessing.sh
+# the stages of create_corpus.py, postprocess.py, gs.py, annotation_reconciler.py, comp_ner_corpus.py and xml_csv.py
+# are run as in-memory transforms on one dict of letters (letter_id -> lxml <root> element), so every letter is
+# parsed and serialised once instead of once per stage and per VARD run
+# the letters are only written to disk where VARD needs them, and after any stage passed to --checkpoint
+
+# the stand-alone scripts are kept for running or debugging single stages
+
+targets = ['NAME', 'LOCATION', 'NATION', 'MARKET', 'DATE', 'TIME', 'PRICE', 'GOD']
+
+# names of the checkpoint directories, as in preprocessing.sh
+checkpoints = {'full': 'v_corpus_full', 'gs': 'v_corpus_gs', 'master': 'master_corpus', 'annotated': 'annotated_corpus'}
+
+
+
+def build_letters(json_file):
+    '''
+    Builds the xml representation of every letter in a json file of letters, as create_corpus.py does.
+    Returns a dict of letter_id -> <root> element.
+    '''
+    letters = {}
+    with span('create_corpus'):
+        for letter in iter_letters(json_file):
+            letter_id = letter['_id']
+            letters[letter_id] = letter_xml(letter_id, split_text(letter['text']))
+            count('words processed', len(letters[letter_id][0]))
+    return letters
+
+
+
+def read_letters(directory):
+    '''
+    Reads a directory of xml-formatted letters. Returns a dict of letter_id -> <root> element.
+    '''
+    letters = {}
+    parser = etree.XMLParser(remove_blank_text=True)
+    for xml_file in sorted(os.listdir(directory)):
+        if xml_file.endswith(".xml"):
+            letters[os.path.splitext(xml_file)[0]] = etree.parse(os.path.join(directory, xml_file), parser).getroot()
+    return letters
+
+
+
+def write_letters(letters, directory):
+    '''
+    Writes letters to a directory, one pretty-printed xml file per letter.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    with span('write', directory=directory):
+        for letter_id, root in letters.items():
+            with open(os.path.join(directory, f'{letter_id}.xml'), "w", encoding="utf-8") as g:
+                g.write(etree.tostring(root, pretty_print=True, encoding="unicode"))
+
+
+
+def run_vard(vard_jar, corpus_dir, working_dir, fscore, threshold):
+    '''
+    Runs VARD on a directory of xml-formatted letters with the same arguments as preprocessing.sh.
+    Returns the directory of VARD's tagged output.
+    '''
+    with span('vard', fscore=fscore, threshold=threshold):
+        subprocess.run(['java', '-Xms256M', '-Xmx512M', '-jar', vard_jar, working_dir, threshold, fscore,
+                        corpus_dir, 'true', working_dir, 'false'], check=True)
+    shutil.rmtree(os.path.join(working_dir, f'varded({threshold}%) - Changes Unmarked'), ignore_errors=True)
+    return os.path.join(working_dir, f'varded({threshold}%) - Changes Tagged')
+
+
+
+def merge_vard(letters, tagged_dir, attribute):
+    '''
+    Records the normalisations of one VARD run as an attribute on each word, as postprocess.py does,
+    reading VARD's tagged output but updating the letters in memory.
+    '''
+    with span('postprocess', attribute=attribute):
+        for xml_file in os.listdir(tagged_dir):
+            if not xml_file.endswith(".xml"):
+                continue
+            letter_id = os.path.splitext(xml_file)[0]
+            tagged = etree.parse(os.path.join(tagged_dir, xml_file)).getroot()
+            words = letters[letter_id].iter('word')
+            for word, tagged_word in zip(words, tagged.iter('word')):
+                children = tagged_word.getchildren() # the <normalised> element, if any
+                if len(children) > 0:
+                    child = children[0]
+                    tail = child.tail if child.tail is not None else ''
+                    corrected = child.text if child.text is not None else ''
+                    word.text = child.get('orig') + tail
+                    word.set(attribute, corrected + tail)
+                    count('words normalised')
+
+
+
+def unicity(letters, attributes):
+    '''
+    Keeps only the VARD runs that are unique at the corpus level and records the VARD counts and unicity
+    of each letter, as gs.py does. Returns the list of unique VARD runs.
+    '''
+    with span('unicity'):
+        # compare the full corpus word list of each VARD run in one pass over the corpus
+        runs = {attribute: [] for attribute in attributes}
+        for root in letters.values():
+            for word in root.iter('word'):
+                for attribute in attributes:
+                    runs[attribute].append(word.get(attribute, word.text))
+        unique = {}
+        for attribute, words in runs.items():
+            words = tuple(words)
+            if words not in unique.values():
+                unique[attribute] = words
+        unique = list(unique)
+        del runs
+
+        for root in letters.values():
+            VARD_count = Counter()
+            r_all = set()
+            for word in root.iter('word'):
+                for attr in word.keys():
+                    if attr == 'word_id':
+                        continue
+                    if attr in attributes:
+                        VARD_count[attr] += 1
+                    r_all.add(attr)
+                    if attr not in unique:
+                        del word.attrib[attr]
+
+            VARD_element = etree.SubElement(root, "VARD")
+            VARD_1 = etree.SubElement(VARD_element, "VARD_count")
+            for k, v in VARD_count.most_common():
+                VARD_1.attrib[k] = str(v)
+            VARD_2 = etree.SubElement(VARD_element, "VARD_unicity")
+            for f in r_all:
+                VARD_2.attrib[f] = "Y" if f in unique else "N"
+    count('unique VARD runs', len(unique))
+    return unique
+
+
+
+def read_annotations(annotations):
+    '''
+    Reads the annotations exported from Back2TheFuture.
+    Returns a dict of letter_id -> list of (start, end, tag), in the order of the export.
+    '''
+    df = pd.read_csv(annotations, sep='\t').dropna()
+    by_letter = defaultdict(list)
+    for letter_id, annotation_span, tag in zip(df['letters._id'], df['free_annotations.span'], df['free_annotations.annotations.NER']):
+        start, end = annotation_span.split('/')
+        by_letter[letter_id].append((int(start), int(end), tag))
+    return by_letter
+
+
+
+def reconcile(letters, annotations):
+    '''
+    Adds the BIO labels of the annotations to the words of each letter, as annotation_reconciler.py does:
+    the word at the start of a span is labelled 'B' and the following words up to and including the end are labelled 'I'.
+    '''
+    with span('reconcile'):
+        for letter_id, root in letters.items():
+            spans = annotations.get(letter_id)
+            if not spans:
+                continue
+            words = root.findall('.//word')
+            for start, end, tag in spans:
+                if start < len(words):
+                    words[start].attrib[tag] = 'B'
+                for wn in range(start + 1, min(end + 1, len(words))):
+                    words[wn].attrib[tag] = 'I'
+                count('tags reconciled')
+
+
+
+def annotated(letters):
+    '''
+    Returns the letters with at least one entity label, as comp_ner_corpus.py selects them.
+    '''
+    return {k: root for k, root in letters.items()
+            if any(tag in word.attrib for word in root.iter('word') for tag in targets)}
+
+
+
+def ner_corpora(letters):
+    '''
+    Builds the NER corpus with the original data and one NER corpus per VARD run, as xml_csv.py does.
+    Returns a dict of corpus name -> DataFrame.
+    '''
+    runs = sorted({attr for root in letters.values() for attr in root.find('.//VARD_unicity').keys()})
+    rows = [word for root in letters.values() for word in root.iter('word')]
+
+    word_id = [word.get('word_id') for word in rows]
+    original = [word.text if word.text is not None else '' for word in rows]
+    columns = {tag: [word.get(tag, 'O') for word in rows] for tag in targets}
+    labels = []
+    for row in zip(*columns.values()):
+        label = next((col + '-B' for col, f in zip(targets, row) if f == 'B'),
+                     next((col + '-I' for col, f in zip(targets, row) if f == 'I'), 'O'))
+        labels.append(label)
+
+    # every corpus has the same word_ids, so the natural sort order is computed once
+    order = pd.Series(word_id).sort_values(key=natsort_key).index
+
+    corpora = {}
+    for name in ['raw_ner_corpus'] + runs:
+        if name == 'raw_ner_corpus':
+            words = original
+        else:
+            words = [word.get(name, text) for word, text in zip(rows, original)]
+        df = pd.DataFrame({'word_id': word_id, 'word': words, **columns, 'labels': labels})
+        corpora[name] = df.reindex(order)
+    return corpora
+
+
+
+def export_csv(letters, ner_corpus):
+    '''
+    Writes the NER corpora of the annotated letters to csv, one file per VARD run plus the original data.
+    '''
+    os.makedirs(ner_corpus, exist_ok=True)
+    with span('csv'):
+        for name, df in ner_corpora(letters).items():
+            print(f'Constructing NER corpus for {name}')
+            df.to_csv(os.path.join(ner_corpus, f'{name}.csv'), index=False, encoding='utf-8')
+            count('rows written', len(df))
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--json_file', type=str, help='Path to json file containing letters.')
+    p.add_argument('--annotations', type=str, help="CSV file exported from Back2TheFuture containing annotations. Must minimally include: 'letters._id', 'free_annotations.annotations.NER', 'free_annotations.span'")
+    p.add_argument('--fscores', type=str, default='0.1 0.5 1.0 1.5 1.9 2.0', help='f-score weights for calculating replacement scores.')
+    p.add_argument('--thresholds', type=str, default='0 25 50 75 100', help='The normalisation thresholds.')
+    p.add_argument('--vard_jar', type=str, default='clui.jar', help='Path to the VARD command line jar.')
+    p.add_argument('--working_dir', type=str, default='v_working_dir/', help='VARD working directory; the letters are written here for VARD.')
+    p.add_argument('--varded_dir', type=str, help='Directory of existing VARD output, with one sub-directory per VARD run named VARD_fscore_<f>_threshold_<t> containing a Tagged directory. VARD is not run when given.')
+    p.add_argument('--master_corpus', type=str, help='Start from an existing master corpus directory instead of letters.json, skipping the VARD and reconciliation stages.')
+    p.add_argument('--ner_corpus', type=str, default='ner_corpus/', help='Output directory for csv files.')
+    p.add_argument('--checkpoint', type=str, nargs='*', default=[], choices=list(checkpoints), help='Stages after which to write the letters to disk as xml.')
+    p.add_argument('--checkpoint_dir', type=str, default='.', help='Directory in which to write checkpoints.')
+    args = p.parse_args()
+
+    def checkpoint(stage, letters):
+        if stage in args.checkpoint:
+            write_letters(letters, os.path.join(args.checkpoint_dir, checkpoints[stage]))
+
+    if args.master_corpus:
+        letters = read_letters(os.path.realpath(args.master_corpus))
+    else:
+        letters = build_letters(args.json_file)
+
+        attributes = [f'VARD_fscore_{f}_threshold_{t}' for f in args.fscores.split() for t in args.thresholds.split()]
+        vard_input = None
+        for attribute in attributes:
+            fscore = attribute.split('fscore_')[1].split('_')[0]
+            threshold = attribute.split('threshold_')[1]
+            if args.varded_dir:
+                tagged_dir = os.path.join(args.varded_dir, attribute, 'Tagged')
+                if not os.path.isdir(tagged_dir):
+                    print(f"No VARD output for {attribute}")
+                    continue
+            else:
+                if vard_input is None:
+                    # VARD reads the letters from disk; they only need to be written once
+                    vard_input = os.path.realpath(os.path.join(args.working_dir, 'corpus'))
+                    write_letters(letters, vard_input)
+                tagged_dir = run_vard(args.vard_jar, vard_input, args.working_dir, fscore, threshold)
+            print(f"VARD f-score weight: {fscore}, threshold: {threshold}")
+            merge_vard(letters, tagged_dir, attribute)
+            if not args.varded_dir:
+                shutil.rmtree(tagged_dir)
+        checkpoint('full', letters)
+
+        unicity(letters, attributes)
+        checkpoint('gs', letters)
+
+        reconcile(letters, read_annotations(args.annotations))
+        checkpoint('master', letters)
+
+    letters = annotated(letters)
+    count('annotated letters', len(letters))
+    checkpoint('annotated', letters)
+
+    export_csv(letters, os.path.realpath(args.ner_corpus))
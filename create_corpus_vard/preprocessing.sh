@@ -1,6 +1,16 @@
 #!/bin/bash
 
 # MUST BE RUN INSIDE VARD WORKING FOLDER
+# copy every .py file of create_corpus_vard/ to the VARD working folder, not only the scripts called below:
+# the scripts import instrumentation.py, letter_store.py and cleaning.py from the folder they are run from
+
+for module in instrumentation.py letter_store.py cleaning.py
+do
+	if [ ! -f "$module" ]; then
+		echo "$module is missing from the VARD working folder; copy every .py file of create_corpus_vard/ here."
+		exit 1
+	fi
+done
 
 raw_corpus="/Users/pfq/Dropbox/DTA/Thesis_Internship/preprocessing_and_text_normalisation/letters.json"
 annotations="/Users/pfq/Dropbox/DTA/Thesis_Internship/preprocessing_and_text_normalisation/process_export_keys.csv"
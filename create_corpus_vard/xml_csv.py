@@ -2,6 +2,7 @@ import pandas as pd
 import os
 from natsort import natsort_key
 import argparse
+from instrumentation import span, count
 
 # MUST BE RUN INSIDE VARD WORKING FOLDER
 
@@ -31,6 +32,31 @@ def tag_writer(tag_dict, df):
             for f in range(0,len(df)):
                 v.append('O')
 
+def read_letter(file):
+    '''
+    Reads the words of an annotated letter into a DataFrame.
+    '''
+    xml_file = open(os.path.join(tagged_corpus, file),"r",encoding="utf-8")
+    df = pd.read_xml(xml_file, xpath=".//word")
+    df = df.fillna(value={'word':''}).fillna('O').reset_index(drop=True)
+    # NOTE: nan word values are left as nan, all other nan values filled with 'O' as per BIO
+    return df
+
+def write_corpus(df_values, df_index, fullname):
+    '''
+    Writes the words and tags of a NER corpus to csv, with a single column of combined labels. Returns the DataFrame.
+    '''
+    # create df of corpus and tags
+    df = pd.DataFrame(df_values, index=df_index).transpose().sort_values(by="word_id", key=natsort_key, ignore_index=False)
+
+    # create single column with annotations
+    df['labels'] = df[targets].apply(lambda row: next((col + '-B' for col in targets if row[col] == 'B'),
+                                                      next((col + '-I' for col in targets if row[col] == 'I'), 'O')), axis=1)
+
+    # save to csv
+    df.to_csv(fullname, index=False, encoding='utf-8')
+    return df
+
 unic = open(os.path.join(tagged_corpus, xml_list[0]),"r",encoding="utf-8")
 df_unic = pd.read_xml(unic, xpath=".//VARD_unicity")
 unicity_list = df_unic.columns
@@ -45,10 +71,8 @@ fullname = os.path.join(ner_corpus, outname)
 
 # NER corpus with original data
 for file in xml_list:
-    xml_file = open(os.path.join(tagged_corpus, file),"r",encoding="utf-8")
-    df = pd.read_xml(xml_file, xpath=".//word")
-    df = df.fillna(value={'word':''}).fillna('O').reset_index(drop=True)
-    # NOTE: nan word values are left as nan, all other nan values filled with 'O' as per BIO
+    with span('letter', corpus='raw_ner_corpus', letter_id=os.path.splitext(file)[0]):
+        df = read_letter(file)
 
     for f in df['word_id']:
         word_id.append(f)
@@ -62,15 +86,9 @@ for k,v in tag_dict.items():
 
 print(f'Constructing NER corpus with original data')
 
-# create df of corpus and tags
-df = pd.DataFrame(df_values, index=df_index).transpose().sort_values(by="word_id", key=natsort_key, ignore_index=False)
-
-# create single column with annotations
-df['labels'] = df[targets].apply(lambda row: next((col + '-B' for col in targets if row[col] == 'B'),
-                                                  next((col + '-I' for col in targets if row[col] == 'I'), 'O')), axis=1)
-
-# save to csv
-df.to_csv(fullname, index=False, encoding='utf-8')
+with span('write csv', corpus='raw_ner_corpus'):
+    df = write_corpus(df_values, df_index, fullname)
+count('rows written', len(df))
 
 # NER corpus with VARD processed data
 for i in unicity_list:
@@ -83,10 +101,8 @@ for i in unicity_list:
     fullname = os.path.join(ner_corpus, outname)
 
     for file in xml_list:
-        xml_file = open(os.path.join(tagged_corpus, file),"r",encoding="utf-8")
-        df = pd.read_xml(xml_file, xpath=".//word")
-        df = df.fillna(value={'word':''}).fillna('O').reset_index(drop=True)
-        # NOTE: nan word values are left as nan, all other nan values filled with 'O' as per BIO
+        with span('letter', corpus=i, letter_id=os.path.splitext(file)[0]):
+            df = read_letter(file)
 
         for f in df['word_id']:
             word_id.append(f)
@@ -107,13 +123,6 @@ for i in unicity_list:
     
     print(f'Constructing NER corpus for {i}')
 
-    # create df of corpus and tags
-    df = pd.DataFrame(df_values, index=df_index).transpose().sort_values(by="word_id", key=natsort_key, ignore_index=False)
-
-    # create single column with annotations
-    df['labels'] = df[targets].apply(lambda row: next((col + '-B' for col in targets if row[col] == 'B'),
-                                                      next((col + '-I' for col in targets if row[col] == 'I'), 'O')), axis=1)
-    
-    # save to csv
-    df.to_csv(fullname, index=False, encoding='utf-8')
-    
\ No newline at end of file
+    with span('write csv', corpus=i):
+        df = write_corpus(df_values, df_index, fullname)
+    count('rows written', len(df))
@@ -0,0 +1,328 @@
+import os
+import time
+import struct
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from my_functions import word2features, sent2features
+from tagging import get_pos_tags, corpus_lines
+from model_registry import best_models_dir
+
+# batched Viterbi decoding of the pickled sklearn_crfsuite models with NumPy
+# crfsuite decodes one line at a time from the feature dicts of every token, looking each attribute up by its string
+# here the weights of a trained CRF are exported to a state weight matrix (one row per attribute, one column per label)
+# and a transition matrix, and every attribute string is hashed to its row once per distinct (word, POS) pair
+# a batch of lines is then scored and decoded as array operations over padded [line, token] arrays
+
+# the weights are read from the crfsuite model file rather than from state_features_, which crfsuite rounds to
+# six decimals, and the state scores are summed in the order of the attributes of each token as in crfsuite,
+# so that the predictions are exactly those of crf.predict()
+
+# word2features() builds the features of a token from the token itself, then from the previous token (or 'BOS'),
+# then from the next token (or 'EOS'); the three blocks are cached separately for each distinct token, the first one
+# as its state scores
+
+# example, exporting the CRF best models and checking them against crfsuite on the NER subcorpus:
+#   python crf_viterbi.py --models best_models/*_combined_samp/*.pkl --data data/raw_ner_corpus.csv
+# or on the whole master corpus:
+#   python crf_viterbi.py --models best_models/*_combined_samp/*.pkl --master_corpus master_corpus
+
+
+
+def read_crfsuite_model(filename):
+    '''
+    Reads the labels, attributes and weights of a crfsuite (crf1d) model file.
+
+    Parameters:
+        filename (str): Path to a model file, e.g. crf.modelfile.name of a trained sklearn_crfsuite.CRF.
+
+    Returns:
+        tuple: (labels, attributes, state, transition), where labels and attributes are lists of strings,
+        state is an array of shape (attributes, labels) and transition an array of shape (labels, labels).
+    '''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, _, _, _, _, num_labels, num_attrs, off_features, off_labels, off_attrs, _, _ = \
+        struct.unpack_from('<4sI4sIIIIIIIII', data, 0)
+    if magic != b'lCRF':
+        raise ValueError(f"{filename} is not a crfsuite model file.")
+
+    def strings(offset, n):
+        # the backward array of a CQDB database holds the offset of the record of every id
+        _, _, _, _, _, bwd_offset = struct.unpack_from('<4sIIIII', data, offset)
+        result = []
+        for i in range(n):
+            record = offset + struct.unpack_from('<I', data, offset + bwd_offset + 4 * i)[0]
+            _, size = struct.unpack_from('<II', data, record)
+            result.append(data[record + 8:record + 8 + size - 1].decode('utf-8'))
+        return result
+
+    labels = strings(off_labels, num_labels)
+    attributes = strings(off_attrs, num_attrs)
+    state = np.zeros((num_attrs, num_labels))
+    transition = np.zeros((num_labels, num_labels))
+    _, _, num_features = struct.unpack_from('<4sII', data, off_features)
+    for kind, src, dst, weight in struct.iter_unpack('<IIId', data[off_features + 12:off_features + 12 + 20 * num_features]):
+        if kind == 0:
+            state[src, dst] = weight
+        else:
+            transition[src, dst] = weight
+    return labels, attributes, state, transition
+
+
+
+class ViterbiCRF:
+    '''
+    A linear-chain CRF decoded in batches with NumPy, exported from a trained sklearn_crfsuite.CRF.
+
+    Parameters:
+        labels (list): The labels, in the order of the matrix columns.
+        attributes (list): The attribute strings, in the order of the rows of state.
+        state (numpy.ndarray): State weights of shape (attributes, labels).
+        transition (numpy.ndarray): Transition weights of shape (labels, labels), from row label to column label.
+
+    Example:
+        viterbi = ViterbiCRF.from_crf(crf)
+        viterbi.save('combined_samp.npz')
+        predictions = ViterbiCRF.load('combined_samp.npz').predict(sents) # == crf.predict([sent2features(s) for s in sents])
+    '''
+    def __init__(self, labels, attributes, state, transition):
+        self.labels = list(labels)
+        # row 0 is kept at zero for attributes the model has no weights for, row i + 1 holds attribute i
+        self.attributes = pd.Index(attributes)
+        self.state = np.vstack([np.zeros((1, len(self.labels))), state])
+        self.transition = np.asarray(transition, dtype=np.float64)
+
+        # per distinct (word, POS) pair: the state scores of its own attributes, summed in order from zero, and the
+        # (rows, values) of the '-1:' attributes it gives the token after it and the '+1:' attributes it gives the one before
+        self._token_ids = {}
+        self._own = np.zeros((0, len(self.labels)))
+        self._as_previous = (np.zeros((0, 0), dtype=np.int64), np.zeros((0, 0)))
+        self._as_next = (np.zeros((0, 0), dtype=np.int64), np.zeros((0, 0)))
+        # the BOS and EOS attributes do not depend on the token
+        alone = word2features([('', 'O', '')], 0)
+        self._bos = self._rows([{'BOS': alone['BOS']}])
+        self._eos = self._rows([{'EOS': alone['EOS']}])
+
+    @classmethod
+    def from_crf(cls, crf):
+        '''
+        Exports a trained sklearn_crfsuite.CRF with the exact weights of its crfsuite model file.
+        '''
+        labels, attributes, state, transition = read_crfsuite_model(crf.modelfile.name)
+        return cls(labels, attributes, state, transition)
+
+    def save(self, path):
+        np.savez(path, labels=np.array(self.labels), attributes=np.array(self.attributes, dtype=object),
+                 state=self.state[1:], transition=self.transition)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=True)
+        return cls(data['labels'].tolist(), data['attributes'].tolist(), data['state'], data['transition'])
+
+    def _rows(self, blocks):
+        '''
+        Hashes the attributes of a list of feature dicts with the same keys to (rows, values) arrays.
+        Features are converted to crfsuite attributes as python-crfsuite does: string values become the
+        attribute 'key:value' with value 1, other values the attribute 'key' with the value as a float.
+        '''
+        frame = pd.DataFrame(blocks, columns=list(blocks[0]) if blocks else [])
+        rows = np.zeros(frame.shape, dtype=np.int64)
+        values = np.zeros(frame.shape)
+        for j, (key, column) in enumerate(frame.items()):
+            if pd.api.types.is_numeric_dtype(column):
+                rows[:, j] = self.attributes.get_indexer([key])[0] + 1
+                values[:, j] = column.astype(float)
+            else:
+                rows[:, j] = self.attributes.get_indexer(key + ':' + column) + 1
+                values[:, j] = 1.0
+        return rows, values
+
+    def _add_tokens(self, keys):
+        '''
+        Adds (word, POS) pairs to the vocabulary, hashing the attributes of their feature blocks.
+        '''
+        own, as_previous, as_next = [], [], []
+        blocks = {'-1:': as_previous, '+1:': as_next}
+        for word, pos in keys:
+            self._token_ids[(word, pos)] = len(self._token_ids)
+            for block in (own, as_previous, as_next):
+                block.append({})
+            # the middle token of a line of three copies of the token has all three blocks
+            for k, v in word2features([(word, 'O', pos)] * 3, 1).items():
+                blocks.get(k[:3], own)[-1][k] = v
+        rows, values = self._rows(own)
+        scores = np.zeros((len(keys), len(self.labels)))
+        for f in range(rows.shape[1]):
+            scores += self.state[rows[:, f]] * values[:, f, None]
+        self._own = np.concatenate([self._own, scores])
+        self._as_previous = extend(self._as_previous, self._rows(as_previous))
+        self._as_next = extend(self._as_next, self._rows(as_next))
+
+    def token_ids(self, keys):
+        '''
+        Returns the vocabulary ids of a list of (word, POS) pairs as an array, adding unseen pairs first.
+        '''
+        get = self._token_ids.get
+        ids = [get(k, -1) for k in keys]
+        if -1 in ids:
+            self._add_tokens(list(dict.fromkeys(k for k, i in zip(keys, ids) if i == -1)))
+            ids = [get(k) for k in keys]
+        return np.array(ids, dtype=np.int64)
+
+    def state_scores(self, token_ids, lengths):
+        '''
+        Returns the state scores of the tokens of consecutive lines, shape (tokens, labels).
+
+        Parameters:
+            token_ids (numpy.ndarray): The token ids of all lines, one after the other.
+            lengths (numpy.ndarray): The number of tokens of each line.
+        '''
+        ends = np.cumsum(lengths)
+        first = np.zeros(len(token_ids), dtype=bool)
+        first[(ends - lengths)[lengths > 0]] = True
+        last = np.zeros(len(token_ids), dtype=bool)
+        last[ends[lengths > 0] - 1] = True
+        before = [np.where(first[:, None], pad(bos, block.shape[1]), block[np.roll(token_ids, 1)])
+                  for block, bos in zip(self._as_previous, self._bos)]
+        after = [np.where(last[:, None], pad(eos, block.shape[1]), block[np.roll(token_ids, -1)])
+                 for block, eos in zip(self._as_next, self._eos)]
+
+        # the attributes of each token in the order of word2features(): own, then previous or BOS, then next or EOS,
+        # summed one at a time from zero as crfsuite does, so that the scores are bitwise identical
+        scores = self._own[token_ids]
+        for rows, values in (before, after):
+            for f in range(rows.shape[1]):
+                scores += self.state[rows[:, f]] * values[:, f, None]
+        return scores
+
+    def viterbi(self, scores, lengths):
+        '''
+        Returns the best label index sequence of each line of a batch of state scores, padded with 0.
+        Ties are resolved to the lowest label index, as in crfsuite.
+        '''
+        # with the lines sorted by length, the lines still running at position t are a suffix of the batch
+        order = np.argsort(lengths, kind='stable')
+        scores = scores[order]
+        lengths = lengths[order]
+        n, length, _ = scores.shape
+        alpha = scores[:, 0].copy()
+        back = np.zeros((n, length, len(self.labels)), dtype=np.int64)
+        for t in range(1, length):
+            k = np.searchsorted(lengths, t, side='right')
+            candidates = alpha[k:, :, None] + self.transition
+            best = candidates.argmax(axis=1)
+            back[k:, t] = best
+            alpha[k:] = np.take_along_axis(candidates, best[:, None, :], axis=1)[:, 0] + scores[k:, t]
+
+        paths = np.zeros((n, length), dtype=np.int64)
+        current = alpha.argmax(axis=1)
+        for t in range(length - 1, -1, -1):
+            k = np.searchsorted(lengths, t, side='right')
+            paths[k:, t] = current[k:]
+            current[k:] = back[np.arange(k, n), t, current[k:]]
+        result = np.zeros_like(paths)
+        result[order] = paths
+        return result
+
+    def predict(self, sents, batch_size=512):
+        '''
+        Predicts the labels of lines of (word, label, POS) tuples, as crf.predict() does for their sent2features().
+
+        Parameters:
+            sents (list): A list of lines, each a list of (word, label, POS) tuples.
+            batch_size (int): The number of lines decoded together; lines are sorted by length first.
+
+        Returns:
+            list: A list of lists of labels, one per token.
+        '''
+        lengths = np.array([len(s) for s in sents], dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        scores = self.state_scores(self.token_ids([(t[0], t[2]) for s in sents for t in s]), lengths)
+
+        # the lines are decoded in batches of similar length, padded to the longest line of the batch
+        predictions = np.zeros(len(scores), dtype=np.int64)
+        order = np.argsort(lengths, kind='stable')
+        order = order[lengths[order] > 0]
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            positions = starts[batch, None] + np.arange(lengths[batch].max())
+            mask = positions < (starts + lengths)[batch, None]
+            paths = self.viterbi(scores[np.where(mask, positions, 0)], lengths[batch])
+            predictions[positions[mask]] = paths[mask]
+
+        labels = np.array(self.labels, dtype=object)[predictions].tolist()
+        return [labels[i:i + n] for i, n in zip(starts.tolist(), lengths.tolist())]
+
+
+
+def extend(block, new):
+    '''
+    Appends the (rows, values) arrays of new tokens to those of a feature block, padding both to the same width.
+    '''
+    width = max(block[0].shape[1], new[0].shape[1])
+    return tuple(np.concatenate([pad(old, width), pad(added, width)]) for old, added in zip(block, new))
+
+
+
+def pad(array, width):
+    '''
+    Pads the last axis of an array with zeros up to width.
+    '''
+    if array.shape[-1] >= width:
+        return array
+    return np.concatenate([array, np.zeros(array.shape[:-1] + (width - array.shape[-1],), dtype=array.dtype)], axis=-1)
+
+
+
+def main(args):
+    if args.master_corpus:
+        # POS tags are generated with spaCy at the token level, as in preprocessing.py
+        lines = corpus_lines(args.master_corpus)
+        pos = iter(get_pos_tags([token for line in lines for _, token in line]))
+        sents = [[(token, 'O', next(pos)) for _, token in line] for line in lines]
+    else:
+        df = pd.read_csv(args.data).astype(str)
+        sents = [list(zip(g['word'], g['labels'], g['POS'])) for k, g in
+                 df.groupby(df['word_id'].str.endswith('.0').cumsum())]
+    sents = sents * args.repeat
+    print(f"{len(sents)} lines, {sum(len(s) for s in sents)} tokens")
+
+    os.makedirs(args.outdir, exist_ok=True)
+    for model in args.models:
+        with open(model, 'rb') as f:
+            crf = pickle.load(f)
+        viterbi = ViterbiCRF.from_crf(crf)
+        # the pickles in best_models/ are named after their sampling only, so those exports are named after the directory
+        directory = os.path.dirname(os.path.abspath(model))
+        name = os.path.basename(directory) if os.path.dirname(directory) == os.path.abspath(best_models_dir) else \
+            os.path.splitext(os.path.basename(model))[0]
+        path = os.path.join(args.outdir, f'{name}.npz')
+        viterbi.save(path)
+        viterbi = ViterbiCRF.load(path)
+
+        start = time.perf_counter()
+        expected = crf.predict([sent2features(s) for s in sents])
+        crfsuite_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        predictions = viterbi.predict(sents, args.batch_size)
+        viterbi_seconds = time.perf_counter() - start
+        mismatches = sum(a != b for a, b in zip(expected, predictions))
+
+        print(f"{model} -> {path}: crfsuite {crfsuite_seconds:.2f}s, numpy {viterbi_seconds:.2f}s "
+              f"(speed-up {crfsuite_seconds / viterbi_seconds:.1f}x), lines differing: {mismatches}")
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--models', type=str, nargs='+', required=True, help='Pickled sklearn_crfsuite models to export.')
+    p.add_argument('--outdir', type=str, default='crf_viterbi', help='Output directory for the exported models, one <model directory>.npz per model.')
+    p.add_argument('--data', type=str, default='data/raw_ner_corpus.csv', help='Preprocessed NER subcorpus in csv to compare the predictions on.')
+    p.add_argument('--master_corpus', type=str, help='Compare on all letters of the master corpus instead, tagged with spaCy POS tags.')
+    p.add_argument('--batch_size', type=int, default=512, help='Lines decoded together.')
+    p.add_argument('--repeat', type=int, default=1, help='Repeat the lines, to time larger corpora.')
+    args = p.parse_args()
+    main(args)
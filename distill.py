@@ -0,0 +1,146 @@
+import os
+import time
+import pickle
+import argparse
+import pandas as pd
+from my_functions import sent2features
+from joint_crf import split, new_crf, scores
+from model_registry import ModelRegistry, best_models_dir
+from tagging import get_pos_tags, corpus_lines
+from cascade import expensive_predictor
+
+# distillation of the best models into CRF students
+# the transformer best models (teachers) tag the letters in master_corpus/ that have no annotations, and a CRF with
+# the features and settings of the CRF notebooks (student) is trained on these silver labels, together with the
+# gold training split of the entity unless --silver_only is given
+
+# the silver data is written to <outdir>/silver_<entity>.csv in the format of the preprocessed NER subcorpora
+# (word_id, word, POS and the entity column), and is reused by later runs unless --rebuild is given
+# words are tokenized as in preprocessing.py and POS tags are generated with spaCy at the token level
+
+# teacher and student are both evaluated on the gold test split of the entity, split as in the CRF notebooks,
+# and the report gives their scores, the agreement of the student with the teacher and their inference times
+
+# example:
+#   python distill.py --entities NAME LOCATION --data data/raw_ner_corpus.csv
+
+targets = ['NAME', 'LOCATION', 'NATION', 'MARKET', 'DATE', 'TIME', 'PRICE', 'GOD']
+
+
+
+def silver_data(master_dir, entity, predict, path, rebuild=False):
+    '''
+    Returns the unannotated lines of the master corpus labelled by a teacher, tagging them on first use
+    and caching them in a csv file.
+
+    Parameters:
+        master_dir (str): Path to the master_corpus directory.
+        entity (str): The entity the teacher tags.
+        predict (function): Takes a list of lines of (word, label, POS) tuples and returns a list of lists of BIO labels.
+        path (str): Path of the csv file with the silver data.
+        rebuild (bool): Tag the letters again even if the csv file exists.
+
+    Returns:
+        tuple: A list of lines of (word, label, POS) tuples, and the time in seconds the teacher took (0 if cached).
+    '''
+    if not rebuild and os.path.exists(path):
+        df = pd.read_csv(path, keep_default_na=False, dtype=str)
+        groups = df.groupby(df['word_id'].str.split('.').str[:2].str.join('.'), sort=False)
+        return [list(zip(g['word'], g[entity], g['POS'])) for k, g in groups], 0.0
+
+    lines = corpus_lines(master_dir, skip_annotated=True)
+    pos = iter(get_pos_tags([token for line in lines for _, token in line]))
+    sents = [[(token, 'O', next(pos)) for _, token in line] for line in lines]
+    start = time.perf_counter()
+    labels = predict(sents)
+    seconds = time.perf_counter() - start
+
+    silver = [[(t[0], label, t[2]) for t, label in zip(s, line_labels)] for s, line_labels in zip(sents, labels)]
+    pd.DataFrame({'word_id': [word_id for line in lines for word_id, _ in line],
+                  'word': [t[0] for s in silver for t in s],
+                  'POS': [t[2] for s in silver for t in s],
+                  entity: [t[1] for s in silver for t in s]}).to_csv(path, index=False)
+    return silver, seconds
+
+
+
+def distill(entity, args, registry):
+    '''
+    Trains a CRF student on the silver data of a teacher and compares both on the gold test split.
+    Returns the report row of the entity.
+    '''
+    df = pd.read_csv(args.data).astype(str)
+    gold = [list(zip(g['word'], g[entity], g['POS'])) for k, g in
+            df.groupby(df['word_id'].str.endswith('.0').cumsum())]
+    train_bin, _, test_bin = split(gold)
+
+    predict = expensive_predictor(registry, entity)
+    silver, silver_seconds = silver_data(args.master_corpus, entity, predict,
+                                         os.path.join(args.outdir, f'silver_{entity.lower()}.csv'), args.rebuild)
+    training = silver if args.silver_only else silver + train_bin
+    print(f"{entity}: {len(silver)} silver lines" + (f" tagged in {silver_seconds:.1f}s" if silver_seconds else '') +
+          f", training on {len(training)} lines")
+
+    student = new_crf()
+    start = time.perf_counter()
+    student.fit([sent2features(s) for s in training], [[t[1] for t in s] for s in training])
+    train_seconds = time.perf_counter() - start
+
+    predict(test_bin[:1]) # warm up
+    start = time.perf_counter()
+    teacher_preds = [l for line in predict(test_bin) for l in line]
+    teacher_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    student_preds = [l for line in student.predict([sent2features(s) for s in test_bin]) for l in line]
+    student_seconds = time.perf_counter() - start
+
+    true = [t[1] for s in test_bin for t in s]
+    teacher_scores = scores(true, teacher_preds)
+    student_scores = scores(true, student_preds)
+    row = {'entity': entity, 'teacher': registry.entries[entity].name, 'silver_lines': len(silver),
+           **{f'teacher_{k}': v for k, v in teacher_scores.items()},
+           **{f'student_{k}': v for k, v in student_scores.items()},
+           'agreement': sum(a == b for a, b in zip(teacher_preds, student_preds)) / len(true),
+           'agreement_f1_avg': scores(teacher_preds, student_preds)['f1_avg'],
+           'student_train_seconds': train_seconds,
+           'teacher_seconds': teacher_seconds, 'student_seconds': student_seconds,
+           'speed_up': teacher_seconds / student_seconds}
+
+    with open(os.path.join(args.outdir, f'student_{entity.lower()}.pkl'), 'wb') as f:
+        pickle.dump(student, f)
+    return row
+
+
+
+def main(args):
+    os.makedirs(args.outdir, exist_ok=True)
+    registry = ModelRegistry(args.models_dir)
+    entities = args.entities or [e for e in targets if e in registry and registry.entries[e].kind == 'transformer']
+
+    missing = [e for e in entities if e not in registry.available()]
+    if missing:
+        print(f"no teacher weights in {args.models_dir} for {' '.join(missing)}, these entities are skipped")
+    rows = [distill(entity, args, registry) for entity in entities if entity not in missing]
+    if not rows:
+        raise ValueError(f"no teacher weights in {args.models_dir} for any of the entities: {' '.join(entities)} "
+                         f"(the pytorch_model.bin files are available separately)")
+
+    df = pd.DataFrame(rows)
+    df.to_csv(os.path.join(args.outdir, 'distill_report.csv'), index=False)
+    with pd.option_context('display.float_format', '{:.4f}'.format, 'display.width', 200):
+        print(df[['entity', 'teacher_f1_avg', 'student_f1_avg', 'agreement_f1_avg',
+                  'teacher_seconds', 'student_seconds', 'speed_up']].to_string(index=False))
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--entities', type=str, nargs='+', help='Entities to distil. Defaults to all entities with a transformer best model.')
+    p.add_argument('--data', type=str, default='data/raw_ner_corpus.csv', help='Preprocessed NER subcorpus in csv, for the gold splits.')
+    p.add_argument('--master_corpus', type=str, default='master_corpus', help='Directory of the master corpus letters.')
+    p.add_argument('--models_dir', type=str, default=best_models_dir, help='Directory of the teacher models.')
+    p.add_argument('--outdir', type=str, default='distill', help='Output directory for the silver data, students and report.')
+    p.add_argument('--silver_only', action='store_true', help='Train the students on the silver data only.')
+    p.add_argument('--rebuild', action='store_true', help='Tag the unannotated letters again even if silver data is cached.')
+    args = p.parse_args()
+    main(args)
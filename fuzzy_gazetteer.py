@@ -0,0 +1,438 @@
+import os
+import re
+import json
+import time
+import argparse
+from collections import Counter, defaultdict
+from string import punctuation
+import numpy as np
+import pandas as pd
+from lxml import etree
+from my_functions import sent2features
+from joint_crf import load_sentences, split, new_crf, scores
+
+# fuzzy gazetteer of named entities for historical spellings ('Calleis', 'Caileis', 'Calais'; 'Wedde', 'Wedd')
+# entries are the annotated entity spans of the master corpus and the names and places in the letters' metadata
+# (process_export_keys_letters_people.csv), normalised as in preprocess_for_lexical (lower case, no punctuation)
+
+# words are matched with a symmetric delete index (SymSpell): every term is stored under each string obtained by
+# deleting up to two of its characters, so a query only generates its own deletes and looks them up, instead of
+# comparing against the whole vocabulary, and only the few candidates found are checked with the edit distance
+# short words allow fewer edits: 0 up to 3 characters, 1 up to 5, 2 beyond, so that 'to' does not match 'de'
+
+# the gazetteer can be used
+#   as a tagger: the longest entry matching at each position of a line is labelled, one set of BIO labels per entity
+#   as CRF features: sent2features_gazetteer() adds the labels of the tagger and a fuzzy membership feature
+
+# examples:
+#   python fuzzy_gazetteer.py --build --gazetteer fuzzy_gazetteer.json
+#   python fuzzy_gazetteer.py --evaluate --entity NAME --data data/raw_ner_corpus.csv
+
+targets = ['NAME', 'LOCATION', 'NATION', 'MARKET', 'DATE', 'TIME', 'PRICE', 'GOD']
+
+# the entities of proper names and places; numbers and dates are left to the models
+gazetteer_entities = ['NAME', 'LOCATION', 'NATION', 'MARKET', 'GOD']
+
+# metadata annotation keys and columns in process_export_keys_letters_people.csv
+annotation_entities = {'name': 'NAME', 'place': 'LOCATION', 'nation': 'NATION'}
+name_columns = [f'{p}.{c}' for p in ('sender', 'addressee') for c in ('first_name', 'middle_names', 'last_name')]
+place_columns = ['letters.departure.place', 'letters.destination.place']
+
+_table = str.maketrans("", "", punctuation)
+
+
+
+def normalise(word):
+    '''
+    Lower-cases a word and removes punctuation, as preprocess_for_lexical does.
+    '''
+    return word.lower().translate(_table)
+
+
+
+def allowed_distance(word, max_distance=2):
+    '''
+    Returns the number of edits allowed for a word of a given length.
+    '''
+    return min(max_distance, 0 if len(word) <= 3 else 1 if len(word) <= 5 else 2)
+
+
+
+def deletes(word, distance):
+    '''
+    Returns the set of strings obtained by deleting up to distance characters from a word, including the word.
+    '''
+    result = {word}
+    edge = {word}
+    for _ in range(distance):
+        edge = {w[:i] + w[i + 1:] for w in edge for i in range(len(w))} - result
+        result |= edge
+    return result
+
+
+
+def edit_distance(a, b, limit):
+    '''
+    Returns the optimal string alignment distance (Levenshtein with transpositions) between two words,
+    or limit + 1 as soon as it is certain to exceed limit.
+    '''
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+
+class SymSpell:
+    '''
+    Symmetric delete index over a vocabulary of words for approximate lookup.
+
+    Parameters:
+        max_distance (int): The largest number of edits a lookup may allow.
+    '''
+    def __init__(self, max_distance=2):
+        self.max_distance = max_distance
+        self.words = set()
+        self._deletes = defaultdict(set)
+
+    def add(self, word):
+        if word and word not in self.words:
+            self.words.add(word)
+            for d in deletes(word, self.max_distance):
+                self._deletes[d].add(word)
+
+    def lookup(self, word, max_distance=None):
+        '''
+        Returns the words of the vocabulary within max_distance edits of a word, as (word, distance) tuples
+        sorted by distance. max_distance defaults to allowed_distance() of the word.
+        '''
+        if not word:
+            return []
+        if max_distance is None:
+            max_distance = allowed_distance(word, self.max_distance)
+        if max_distance == 0:
+            return [(word, 0)] if word in self.words else []
+        candidates = set()
+        for d in deletes(word, max_distance):
+            candidates |= self._deletes.get(d, set())
+        matches = [(c, edit_distance(word, c, max_distance)) for c in candidates]
+        return sorted([m for m in matches if m[1] <= max_distance], key=lambda m: (m[1], m[0]))
+
+
+
+class FuzzyGazetteer:
+    '''
+    A gazetteer of entity phrases (tuples of normalised words) with approximate word matching.
+
+    Parameters:
+        max_distance (int): The largest number of edits allowed per word.
+        min_ratio (float): A single-word entry is only used if the word was seen in the entity at least this share
+        of the times it was seen in the annotated letters, so that frequent words such as 'may' are left out.
+
+    Example:
+        gazetteer = FuzzyGazetteer()
+        gazetteer.add(['william', 'wedde'], 'NAME')
+        gazetteer.tag(['This', 'bringer', ',', 'William', 'Wedd']) # {'NAME': ['O', 'O', 'O', 'B', 'I']}
+    '''
+    def __init__(self, max_distance=2, min_ratio=0.5):
+        self.max_distance = max_distance
+        self.min_ratio = min_ratio
+        self.phrases = Counter() # (words, entity) -> count
+        self.other = Counter() # (word, entity) -> count of the word outside of the entity
+        self.index = SymSpell(max_distance)
+        self._by_first = defaultdict(set) # first word -> phrases
+        self._lookups = {}
+
+    def add(self, words, entity, count=1):
+        words = tuple(w for w in (normalise(w) for w in words) if w)
+        if not words:
+            return
+        self.phrases[(words, entity)] += count
+        self._by_first[words[0]].add((words, entity))
+        for w in words:
+            self.index.add(w)
+        self._lookups = {}
+
+    def add_other(self, word, entity, count=1):
+        '''
+        Counts an occurrence of a word outside of an entity, for min_ratio.
+        '''
+        self.other[(normalise(word), entity)] += count
+
+    def usable(self, words, entity):
+        if len(words) > 1:
+            return True
+        count = self.phrases[(words, entity)]
+        return count >= self.min_ratio * (count + self.other[(words[0], entity)])
+
+    def lookup(self, word):
+        '''
+        Returns the vocabulary words within the allowed distance of a word, as (word, distance) tuples.
+        '''
+        word = normalise(word)
+        if word not in self._lookups:
+            self._lookups[word] = self.index.lookup(word)
+        return self._lookups[word]
+
+    def matches(self, tokens, entities=None):
+        '''
+        Returns the entries matching a line, as (start, end, entity, distance, count) tuples.
+        '''
+        entities = set(entities or gazetteer_entities)
+        words = [normalise(t) for t in tokens]
+        found = []
+        for i, word in enumerate(words):
+            for first, distance in self.lookup(word):
+                for phrase, entity in self._by_first[first]:
+                    end = i + len(phrase)
+                    if entity not in entities or end > len(words) or not self.usable(phrase, entity):
+                        continue
+                    if distance and not self.spelling_variant(tokens[i], word, entity):
+                        continue
+                    total = distance
+                    for token, w, p in zip(tokens[i + 1:end], words[i + 1:end], phrase[1:]):
+                        limit = allowed_distance(w, self.max_distance)
+                        d = edit_distance(w, p, limit)
+                        if d > limit or (d and not self.spelling_variant(token, w, entity)):
+                            break
+                        total += d
+                    else:
+                        found.append((i, end, entity, total, self.phrases[(phrase, entity)]))
+        return found
+
+    def spelling_variant(self, token, word, entity):
+        '''
+        Returns whether an inexact match of a token may be taken as a spelling variant of an entry: the token is
+        capitalised, as names and places are in the letters, and its normalised form was never seen outside of
+        the entity, so that common words one or two edits away from an entry ('will', 'wil') are not matched.
+        '''
+        return token[:1].isupper() and not self.other[(word, entity)]
+
+    def tag(self, tokens, entities=None, matches=None):
+        '''
+        Labels a line of tokens with the longest matching entries, left to right, separately for each entity.
+
+        Parameters:
+            tokens (list): The tokens of a line.
+            entities (list): The entities to tag. Defaults to gazetteer_entities.
+            matches (list): The matches of the line for these entities, if already computed with matches().
+
+        Returns:
+            dict: For each entity, a list of BIO labels, one per token.
+        '''
+        entities = entities or gazetteer_entities
+        labels = {e: ['O'] * len(tokens) for e in entities}
+        # longest first, then fewest edits, then most frequent
+        if matches is None:
+            matches = self.matches(tokens, entities)
+        for start, end, entity, _, _ in sorted(matches, key=lambda m: (m[0], m[0] - m[1], m[3], -m[4])):
+            if all(l == 'O' for l in labels[entity][start:end]):
+                labels[entity][start:end] = ['B'] + ['I'] * (end - start - 1)
+        return labels
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'max_distance': self.max_distance, 'min_ratio': self.min_ratio,
+                       'phrases': [[list(w), e, c] for (w, e), c in self.phrases.items()],
+                       'other': [[w, e, c] for (w, e), c in self.other.items()]}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        gazetteer = cls(data['max_distance'], data['min_ratio'])
+        for words, entity, count in data['phrases']:
+            gazetteer.add(words, entity, count)
+        for word, entity, count in data['other']:
+            gazetteer.add_other(word, entity, count)
+        return gazetteer
+
+
+
+def add_lines(gazetteer, lines, entities=gazetteer_entities):
+    '''
+    Adds the entity spans of labelled lines to a gazetteer, and counts the words outside of them.
+
+    Parameters:
+        gazetteer (FuzzyGazetteer): The gazetteer to add to.
+        lines (list): A list of lines, each a list of (word, {entity: BIO label}) tuples.
+        entities (list): The entities to add.
+    '''
+    for line in lines:
+        for entity in entities:
+            span = []
+            for word, labels in line + [('', {})]:
+                label = labels.get(entity, 'O')
+                if span and label != 'I':
+                    gazetteer.add(span, entity)
+                    span = []
+                if label == 'O':
+                    if word:
+                        gazetteer.add_other(word, entity)
+                else:
+                    span.append(word)
+
+
+
+def master_corpus_lines(master_dir):
+    '''
+    Reads the annotated letters of the master corpus into lines of (word, {entity: BIO label}) tuples.
+    '''
+    lines = []
+    for file in sorted(os.listdir(master_dir)):
+        if not file.endswith('.xml'):
+            continue
+        words = etree.parse(os.path.join(master_dir, file)).getroot().findall('.//word')
+        if not any(tag in word.attrib for word in words for tag in targets):
+            continue
+        current = None
+        for word in words:
+            line_id = word.get('word_id').rsplit('.', 1)[0]
+            if line_id != current:
+                current = line_id
+                lines.append([])
+            lines[-1].append((word.text or '', {t: word.get(t) for t in targets if t in word.attrib}))
+    return lines
+
+
+
+def add_metadata(gazetteer, people_csv, annotations=True):
+    '''
+    Adds the sender and addressee names and the departure and destination places of the letters to a gazetteer,
+    and with annotations, the names, places and nations of their free annotations.
+    '''
+    df = pd.read_csv(people_csv, sep='\t', dtype=str)
+    for column, entity in [(c, 'NAME') for c in name_columns] + [(c, 'LOCATION') for c in place_columns]:
+        for value in df[column].dropna():
+            gazetteer.add(value.split(), entity)
+    # full names of senders and addressees, e.g. 'Otwell Johnson'
+    for p in ('sender', 'addressee'):
+        for first, last in df[[f'{p}.first_name', f'{p}.last_name']].dropna().itertuples(index=False):
+            gazetteer.add(f'{first} {last}'.split(), 'NAME')
+    if annotations:
+        pattern = re.compile(r"""'annotations': \{'(\w+)': (?:'([^']*)'|"([^"]*)")\}""")
+        for text in df['letters.free_annotations'].dropna():
+            for key, value, quoted in pattern.findall(text):
+                if key in annotation_entities:
+                    gazetteer.add((value or quoted).split(), annotation_entities[key])
+
+
+
+def sent2features_gazetteer(sent, gazetteer, entities=None):
+    '''
+    Constructs the CRF features of a line of (word, label, POS) tuples with sent2features, adding for each token
+    the label the gazetteer tags it with for each entity ('gazetteer.NAME': 'B') and whether it is part of any
+    match of the gazetteer ('in_gazetteer'). Both go through matches(), so that the entries left out by min_ratio
+    and the inexact matches that are not spelling variants set neither.
+    '''
+    features = sent2features(sent)
+    tokens = [t[0] for t in sent]
+    matches = gazetteer.matches(tokens, entities)
+    for entity, labels in gazetteer.tag(tokens, entities, matches).items():
+        for f, label in zip(features, labels):
+            if label != 'O':
+                f[f'gazetteer.{entity}'] = label
+    matched = {i for start, end, _, _, _ in matches for i in range(start, end)}
+    for i, f in enumerate(features):
+        f['in_gazetteer'] = i in matched
+    return features
+
+
+
+def evaluate(args):
+    '''
+    Compares exact and fuzzy gazetteer tagging, and a CRF with and without the gazetteer features,
+    on the evaluation split; the gazetteer is built from the training split and the letters' metadata only.
+    '''
+    train_bin, eval_bin, _ = split(load_sentences(args.data))
+    labelled = lambda lines: [[(t[0], dict(zip(targets, t[4:]))) for t in s] for s in lines]
+
+    results = {}
+    for name, max_distance in [('exact', 0), ('fuzzy', args.max_distance)]:
+        gazetteer = FuzzyGazetteer(max_distance, args.min_ratio)
+        add_lines(gazetteer, labelled(train_bin))
+        add_metadata(gazetteer, args.people, annotations=False)
+        results[name] = gazetteer
+
+        start = time.perf_counter()
+        tagged = [gazetteer.tag([t[0] for t in s]) for s in eval_bin]
+        seconds = time.perf_counter() - start
+        for j, entity in enumerate(targets):
+            if entity not in gazetteer_entities:
+                continue
+            true = [t[4 + j] for s in eval_bin for t in s]
+            preds = [l for line in tagged for l in line[entity]]
+            s = scores(true, preds)
+            print(f"{name} gazetteer, {entity}: f1 B {s['f1_B']:.4f}, I {s['f1_I']:.4f}, average {s['f1_avg']:.4f}")
+        print(f"{name} gazetteer: {len(gazetteer.index.words)} words, tagged {len(eval_bin)} lines in {seconds:.2f}s")
+
+    # lookup time over every distinct word of the evaluation split, without the lookup cache
+    gazetteer = results['fuzzy']
+    words = list({normalise(t[0]) for s in eval_bin for t in s} - {''})
+    timings = []
+    for w in words:
+        start = time.perf_counter()
+        gazetteer.index.lookup(w)
+        timings.append(time.perf_counter() - start)
+    print(f"lookup of {len(words)} words: mean {np.mean(timings) * 1e6:.0f}us, "
+          f"99th percentile {np.percentile(timings, 99) * 1e6:.0f}us, max {max(timings) * 1e6:.0f}us")
+
+    # CRF with and without the gazetteer features
+    # the features of the training lines come from gazetteers built without them (5 folds), since a gazetteer holding
+    # every training entity would make the features far more reliable in training than on new text
+    j = targets.index(args.entity)
+    sents = lambda lines: [[(t[0], t[4 + j], t[2]) for t in s] for s in lines]
+    folds = [train_bin[k::5] for k in range(5)]
+    jackknife = []
+    for k, fold in enumerate(folds):
+        fold_gazetteer = FuzzyGazetteer(args.max_distance, args.min_ratio)
+        add_lines(fold_gazetteer, labelled([s for m, f in enumerate(folds) if m != k for s in f]))
+        add_metadata(fold_gazetteer, args.people, annotations=False)
+        jackknife += [sent2features_gazetteer(s, fold_gazetteer) for s in sents(fold)]
+    y_train = [[t[1] for t in s] for fold in folds for s in sents(fold)]
+    true = [t[1] for s in sents(eval_bin) for t in s]
+
+    for name, X_train, X_eval in [('CRF', [sent2features(s) for fold in folds for s in sents(fold)],
+                                   [sent2features(s) for s in sents(eval_bin)]),
+                                  ('CRF + fuzzy gazetteer', jackknife,
+                                   [sent2features_gazetteer(s, gazetteer) for s in sents(eval_bin)])]:
+        crf = new_crf()
+        crf.fit(X_train, y_train)
+        preds = [l for line in crf.predict(X_eval) for l in line]
+        s = scores(true, preds)
+        print(f"{name}, {args.entity}: f1 B {s['f1_B']:.4f}, I {s['f1_I']:.4f}, average {s['f1_avg']:.4f}")
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--build', action='store_true', help='Build the gazetteer from the master corpus and the metadata and save it.')
+    p.add_argument('--evaluate', action='store_true', help='Evaluate the gazetteer as a tagger and as CRF features on the evaluation split.')
+    p.add_argument('--gazetteer', type=str, default='fuzzy_gazetteer.json', help='Path of the saved gazetteer.')
+    p.add_argument('--master_corpus', type=str, default='master_corpus', help='Directory of the master corpus letters.')
+    p.add_argument('--people', type=str, default='raw_data/process_export_keys_letters_people.csv', help='Letters and people metadata in tsv.')
+    p.add_argument('--data', type=str, default='data/raw_ner_corpus.csv', help='Preprocessed NER subcorpus in csv, for --evaluate.')
+    p.add_argument('--entity', type=str, default='NAME', help='Entity of the CRF comparison in --evaluate.')
+    p.add_argument('--max_distance', type=int, default=2, help='Largest number of edits allowed per word.')
+    p.add_argument('--min_ratio', type=float, default=0.5, help='Least share of occurrences in the entity for single-word entries.')
+    args = p.parse_args()
+
+    if args.build:
+        gazetteer = FuzzyGazetteer(args.max_distance, args.min_ratio)
+        add_lines(gazetteer, master_corpus_lines(args.master_corpus))
+        add_metadata(gazetteer, args.people)
+        gazetteer.save(args.gazetteer)
+        print(f"{len(gazetteer.phrases)} entries, {len(gazetteer.index.words)} words saved to {args.gazetteer}")
+    if args.evaluate:
+        evaluate(args)
@@ -0,0 +1,158 @@
+import os
+import time
+import json
+import random
+import pickle
+import argparse
+import pandas as pd
+import sklearn_crfsuite
+from sklearn.metrics import f1_score, precision_score, recall_score
+from my_functions import get_distribution, splitter, sent2features, entity_labels
+
+# joint multi-entity CRF over the combined 'labels' column produced by preprocessing.py
+# one model is trained for all entities instead of one model per entity, and its predictions are projected
+# back onto each entity's BIO labels so that they can be compared with the per-entity models in crf/
+
+# the split and the CRF settings are those used for selecting the 'best' NER subcorpora in the CRF notebooks:
+# train on train, test on eval
+# note that the combined labels keep only one entity per word, so words with overlapping entities
+# can only be labelled correctly for one of them; they are evaluated against the per-entity columns regardless
+
+targets = ['NAME', 'LOCATION', 'NATION', 'MARKET', 'DATE', 'TIME', 'PRICE', 'GOD']
+
+
+
+def load_sentences(filepath):
+    '''
+    Reads a preprocessed NER subcorpus into a list of lines.
+
+    Parameters:
+        filepath (str): Path to a csv file written by preprocessing.py.
+
+    Returns:
+        list: A list of lists of tuples, one per line, each tuple holding
+        (word, BIO label of any entity, POS, combined label, label of each entity in targets).
+        The second element lets get_distribution stratify the split on entities of all types.
+    '''
+    df = pd.read_csv(filepath).astype(str)
+    return [list(zip(g['word'], g['labels'].str[-1], g['POS'], g['labels'],
+                     *[g[t] for t in targets]))
+            for k, g in df.groupby(df['word_id'].str.endswith('.0').cumsum())]
+
+
+
+def split(data):
+    '''
+    Shuffles and splits the lines into 80% training, 10% evaluation and 10% testing data as in the CRF notebooks.
+
+    Returns:
+        tuple: (train_bin, eval_bin, test_bin)
+    '''
+    data = list(data)
+    random.seed(42)
+    random.shuffle(data)
+    train_bin, test = splitter(data, 0.8, get_distribution(data))
+    test_bin, eval_bin = splitter(test, 0.5, get_distribution(test))
+    return train_bin, eval_bin, test_bin
+
+
+
+def new_crf():
+    '''
+    Returns an untrained CRF with the settings used for selecting the 'best' NER subcorpora.
+    '''
+    return sklearn_crfsuite.CRF(algorithm='lbfgs', c1=0.1, c2=0.1, max_iterations=100, delta=1e-4, period=10,
+                                all_possible_transitions=False)
+
+
+
+def scores(true, preds):
+    '''
+    Returns the precision, recall and f1 scores of the B and I labels and the macro-averaged f1 score,
+    as recorded for each model in the CRF notebooks.
+    '''
+    labels = ['B', 'I', 'O']
+    precision = precision_score(true, preds, labels=labels, average=None, zero_division=0)
+    recall = recall_score(true, preds, labels=labels, average=None, zero_division=0)
+    f1 = f1_score(true, preds, labels=labels, average=None, zero_division=0)
+    return {'precision_B': precision[0], 'recall_B': recall[0], 'f1_B': f1[0],
+            'precision_I': precision[1], 'recall_I': recall[1], 'f1_I': f1[1],
+            'f1_avg': f1_score(true, preds, labels=labels, average='macro', zero_division=0)}
+
+
+
+def fit_timed(X, y):
+    '''
+    Trains a new CRF and returns it with the training time in seconds.
+    '''
+    crf = new_crf()
+    start = time.perf_counter()
+    crf.fit(X, y)
+    return crf, time.perf_counter() - start
+
+
+
+def predict_timed(crf, X):
+    '''
+    Returns the predictions of a CRF with the inference time in seconds.
+    '''
+    start = time.perf_counter()
+    predictions = crf.predict(X)
+    return predictions, time.perf_counter() - start
+
+
+
+def main(args):
+    train_bin, eval_bin, _ = split(load_sentences(args.data))
+    X_train = [sent2features(s) for s in train_bin]
+    X_eval = [sent2features(s) for s in eval_bin]
+    print(f"training data: {len(train_bin)}, evaluation data: {len(eval_bin)}")
+
+    # joint model over the combined labels
+    crf, train_seconds = fit_timed(X_train, [[t[3] for t in s] for s in train_bin])
+    predictions, predict_seconds = predict_timed(crf, X_eval)
+    preds = [f for sublist in predictions for f in sublist]
+    print(f"joint model: training {train_seconds:.1f}s, inference {predict_seconds:.2f}s")
+
+    rows = []
+    cost = {'joint': {'train_seconds': train_seconds, 'predict_seconds': predict_seconds}}
+    for j, entity in enumerate(targets):
+        true = [t[4 + j] for s in eval_bin for t in s]
+        rows.append({'entity': entity, 'model': 'joint', **scores(true, entity_labels(preds, entity))})
+
+    # per-entity models on the same split, for comparison
+    if args.compare:
+        cost['per_entity'] = {'train_seconds': 0, 'predict_seconds': 0}
+        for j, entity in enumerate(targets):
+            y_train = [[t[4 + j] for t in s] for s in train_bin]
+            entity_crf, seconds = fit_timed(X_train, y_train)
+            entity_predictions, entity_predict_seconds = predict_timed(entity_crf, X_eval)
+            cost['per_entity']['train_seconds'] += seconds
+            cost['per_entity']['predict_seconds'] += entity_predict_seconds
+            true = [t[4 + j] for s in eval_bin for t in s]
+            rows.append({'entity': entity, 'model': 'per_entity',
+                         **scores(true, [f for sublist in entity_predictions for f in sublist])})
+        print(f"per-entity models: training {cost['per_entity']['train_seconds']:.1f}s, "
+              f"inference {cost['per_entity']['predict_seconds']:.2f}s")
+
+    df = pd.DataFrame(rows)
+    with pd.option_context('display.float_format', '{:.4f}'.format, 'display.width', 200):
+        print(df.pivot(index='entity', columns='model', values=['f1_B', 'f1_I', 'f1_avg']).reindex(targets))
+
+    os.makedirs(args.outdir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(args.data))[0]
+    df.to_csv(os.path.join(args.outdir, f'joint_{name}.csv'), index=False)
+    with open(os.path.join(args.outdir, f'joint_{name}_cost.json'), 'w') as f:
+        json.dump(cost, f, indent=2)
+    with open(os.path.join(args.outdir, f'joint_{name}.pkl'), 'wb') as f:
+        pickle.dump(crf, f)
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--data', type=str, default='data/raw_ner_corpus.csv', help='Preprocessed NER subcorpus in csv.')
+    p.add_argument('--outdir', type=str, default='joint', help='Output directory for the model, per-entity metrics and timings.')
+    p.add_argument('--compare', action='store_true', help='Also train one model per entity on the same split and report both.')
+    args = p.parse_args()
+    main(args)
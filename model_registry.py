@@ -0,0 +1,232 @@
+import os
+import json
+import mmap
+import pickle
+import threading
+from collections import OrderedDict
+
+# registry over the best-performing model for each named entity in best_models/
+# metadata (config.json, tokenizer metadata, label maps) is read eagerly when the registry is created,
+# weights are only loaded when a model is first requested and are kept in an LRU cache bounded by a memory budget
+
+best_models_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'best_models')
+
+targets = ['NAME', 'LOCATION', 'NATION', 'MARKET', 'DATE', 'TIME', 'PRICE', 'GOD']
+
+# weight files in order of preference; safetensors are memory-mapped by transformers when loading
+
+transformer_weights = ['model.safetensors', 'pytorch_model.bin']
+
+
+
+class ModelEntry:
+    '''
+    Metadata for a single model directory in best_models/.
+
+    Attributes:
+        entity (str): The named entity the model tags, e.g. 'NAME'.
+        name (str): The directory name, e.g. 'name_raw_bert-base-ner'.
+        path (str): The full path to the model directory.
+        kind (str): 'crf' for pickled sklearn_crfsuite models, 'transformer' for fine-tuned token classifiers.
+        config (dict): The contents of config.json (empty for CRF models).
+        tokenizer_config (dict): The contents of tokenizer_config.json (empty for CRF models).
+        id2label (dict): Mapping of numeric ids to BIO labels.
+        weights_file (str | None): Path to the weight file, None if the weights are not present on disk.
+        size_estimate (int): Size of the weight file in bytes, used to budget memory before loading.
+    '''
+    def __init__(self, entity, name, path):
+        self.entity = entity
+        self.name = name
+        self.path = path
+        self.config = {}
+        self.tokenizer_config = {}
+        self.id2label = {0: 'O', 1: 'B', 2: 'I'}
+        self.weights_file = None
+
+        pickles = [f for f in os.listdir(path) if f.endswith('.pkl')]
+        if pickles:
+            self.kind = 'crf'
+            self.weights_file = os.path.join(path, pickles[0])
+        else:
+            self.kind = 'transformer'
+            with open(os.path.join(path, 'config.json'), encoding='utf-8') as f:
+                self.config = json.load(f)
+            tokenizer_config = os.path.join(path, 'tokenizer_config.json')
+            if os.path.exists(tokenizer_config):
+                with open(tokenizer_config, encoding='utf-8') as f:
+                    self.tokenizer_config = json.load(f)
+            self.id2label = {int(k): v for k, v in self.config.get('id2label', {}).items()} or self.id2label
+            for f in transformer_weights:
+                if os.path.exists(os.path.join(path, f)):
+                    self.weights_file = os.path.join(path, f)
+                    break
+
+        self.size_estimate = os.path.getsize(self.weights_file) if self.weights_file else 0
+
+    def __repr__(self):
+        status = 'available' if self.weights_file else 'weights missing'
+        return f"ModelEntry({self.entity}, {self.name}, {self.kind}, {status})"
+
+
+
+def _load_crf(entry):
+    '''
+    Unpickles a CRF model, reading the pickle through a read-only memory map rather than copying
+    the file into a bytes buffer first.
+    '''
+    with open(entry.weights_file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return pickle.loads(mm)
+
+
+
+def _load_transformer(entry):
+    '''
+    Loads a fine-tuned token classification model and its tokenizer from a model directory.
+    Returns a (model, tokenizer) tuple with the model in evaluation mode.
+    '''
+    from transformers import AutoModelForTokenClassification, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(entry.path)
+    model = AutoModelForTokenClassification.from_pretrained(entry.path, low_cpu_mem_usage=True)
+    model.eval()
+    return model, tokenizer
+
+
+
+def _loaded_size(entry, model):
+    '''
+    Returns the resident size in bytes of a loaded model: parameter and buffer memory for transformers,
+    the pickle size for CRF models.
+    '''
+    if entry.kind == 'transformer':
+        model = model[0]
+        tensors = list(model.parameters()) + list(model.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+    return entry.size_estimate
+
+
+
+class ModelRegistry:
+    '''
+    A lazily loading registry of the best-performing models, one per named entity.
+
+    Parameters:
+        models_dir (str): Directory containing one sub-directory per model. Defaults to best_models/.
+        memory_budget (int): Maximum number of bytes of loaded models to keep resident. When loading a
+        model would exceed the budget, the least recently used models are evicted first. A single model
+        larger than the budget is still loaded on its own.
+
+    Example:
+        registry = ModelRegistry(memory_budget=1024**3)
+        crf = registry.get('GOD') # sklearn_crfsuite.CRF
+        model, tokenizer = registry.get('NAME')
+    '''
+    def __init__(self, models_dir=best_models_dir, memory_budget=2 * 1024**3):
+        self.models_dir = os.path.realpath(models_dir)
+        self.memory_budget = memory_budget
+        self.entries = {}
+        self._cache = OrderedDict() # entity -> loaded model, least recently used first
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+        for name in sorted(os.listdir(self.models_dir)):
+            path = os.path.join(self.models_dir, name)
+            if not os.path.isdir(path):
+                continue
+            entity = name.split('_')[0].upper()
+            if entity in targets:
+                self.entries[entity] = ModelEntry(entity, name, path)
+
+    def __contains__(self, entity):
+        return entity in self.entries
+
+    def available(self):
+        '''
+        Returns the list of entities whose weights are present on disk.
+        '''
+        return [k for k, v in self.entries.items() if v.weights_file]
+
+    def loaded(self):
+        '''
+        Returns the list of entities currently resident, least recently used first.
+        '''
+        with self._lock:
+            return list(self._cache)
+
+    def memory_used(self):
+        '''
+        Returns the number of bytes currently used by resident models.
+        '''
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def get(self, entity):
+        '''
+        Returns the loaded model for an entity, loading it if it is not resident.
+
+        Parameters:
+            entity (str): One of 'NAME', 'LOCATION', 'NATION', 'MARKET', 'DATE', 'TIME', 'PRICE', 'GOD'.
+
+        Returns:
+            sklearn_crfsuite.CRF for CRF models, or a (model, tokenizer) tuple for transformer models.
+
+        Raises:
+            KeyError: If there is no model for the entity.
+            FileNotFoundError: If the model's weights are not present on disk.
+        '''
+        with self._lock:
+            if entity in self._cache:
+                self._cache.move_to_end(entity)
+                return self._cache[entity]
+
+            entry = self.entries[entity]
+            if entry.weights_file is None:
+                raise FileNotFoundError(f"No weights found in {entry.path}. The pytorch_model.bin files are available separately.")
+
+            self._make_room(entry.size_estimate)
+            model = _load_crf(entry) if entry.kind == 'crf' else _load_transformer(entry)
+            self._cache[entity] = model
+            self._sizes[entity] = _loaded_size(entry, model)
+            self._make_room(0, keep=entity)
+            return model
+
+    def warm(self, entities=None):
+        '''
+        Loads models ahead of the first request so that they are resident when needed.
+        Entities whose weights are missing are skipped. Returns the list of entities loaded.
+
+        Parameters:
+            entities (list): Entities to load. Defaults to all available entities.
+        '''
+        entities = self.available() if entities is None else entities
+        warmed = []
+        for entity in entities:
+            if self.entries[entity].weights_file:
+                self.get(entity)
+                warmed.append(entity)
+        return warmed
+
+    def evict(self, entity):
+        '''
+        Removes a model from the cache if it is resident.
+        '''
+        with self._lock:
+            self._cache.pop(entity, None)
+            self._sizes.pop(entity, None)
+
+    def clear(self):
+        '''
+        Removes all models from the cache.
+        '''
+        with self._lock:
+            self._cache.clear()
+            self._sizes.clear()
+
+    def _make_room(self, incoming, keep=None):
+        # evict least recently used models until the incoming model fits in the budget
+        for entity in list(self._cache):
+            if sum(self._sizes.values()) + incoming <= self.memory_budget:
+                break
+            if entity != keep:
+                self.evict(entity)
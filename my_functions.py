@@ -4,6 +4,8 @@ import pandas as pd
 from collections import Counter
 from itertools import islice
 from string import punctuation
+import re
+from create_corpus_vard.cleaning import replacer # shared with the corpus scripts
 
 
 
@@ -282,76 +284,91 @@ def O_checker(list_of_lists):
 
 
 
-def replacer(word):
+# spaCy entity types kept by the spaCy baseline; all other tokens are labelled 'O'
+spacy_entity_types = ('PERSON', 'GPE', 'FAC', 'ORG', 'LOC', 'NORP', 'DATE', 'MONEY')
+
+
+
+def word_offsets(line):
     '''
-    Replaces extraneous characters present in a word with specified replacements.
+    Returns the character offsets of the words of a line, enumerated as line.split() enumerates them.
 
     Parameters:
-        word (str): The input word that may contain extraneous characters.
+        line (str): A line of a letter.
 
     Returns:
-        str: The word with extraneous characters replaced as follows:
-            - Replaces '_', '/', '[', and ']' with an empty string ''.
-            - Replaces '&amp;' with '&' (replaces HTML-encoded ampersand).
+        list: A list of (start, end) tuples, one per word.
     '''
-    chars = "_/[]"
-    for char in chars:
-        word = word.replace(char, '')
-    word = word.replace('&amp;', '&')
-    return word
+    return [match.span() for match in re.finditer(r'\S+', line)]
 
 
 
-def get_tokens(tokens):
+def align_tokens(tokens, offsets):
     '''
-    A generator function to reconcile spaCy NER with the original enumeration of
-    the letters in order to preserve true label alignment.
+    Reconciles spaCy tokens with the original enumeration of the words of a line by character offset
+    in order to preserve true label alignment, in one linear merge over the tokens and words.
 
-    The function handles cases where only possessive noun forms and punctuation present a
-    problem with aligning labels with word enumeration, so they are treated as exceptions.
+    A word split into several tokens by spaCy takes the label of its first token that is not
+    possessive 's or punctuation, so that 'London,' or "Jones's" take the label of 'London' or 'Jones'.
 
     Parameters:
-        tokens (iterable): An iterable of tuples representing tokens and their types.
-        Each tuple contains three elements: (word, token_type, next_token).
-
-    Yields:
-        tuple: A tuple containing the next token and its corresponding token type.
-
-    Example:
-         token_data = [
-             ('This', 'O', 'is'),
-             ('a', 'O', 'sample'),
-             ('text', 'B', 'with'),
-             ('an', 'I', 'exception'),
-             ("'s", 'O', 'and'),
-             ('punctuation', 'O', '.')
-         ]
-         token_generator = get_tokens(token_data)
-         next(token_generator)  # Output: ('This', 'O')
-         next(token_generator)  # Output: ('is', 'O')
-         next(token_generator)  # Output: ('a', 'O')
-         next(token_generator)  # Output: ('sample', 'O')
-         next(token_generator)  # Output: ('text', 'B')
-         next(token_generator)  # Output: ('with', 'I')
-         next(token_generator)  # Output: ('an', 'O')
-         next(token_generator)  # Output: ('exception', 'I')
-         next(token_generator)  # Output: ("'s", 'O')
-         next(token_generator)  # Output: ('and', 'O')
-         next(token_generator)  # Output: ('punctuation', 'O')
-         next(token_generator)  # Raises StopIteration
-    '''
-    it = iter(tokens)
-    _, token_type, next_token = next(it)
-    word = yield
-    while True:
-        if next_token == word:
-            word = yield next_token, token_type
-            _, token_type, next_token = next(it)
-        else:
-            _, new_tt, tmp = next(it)
-            next_token += tmp
-            if tmp != "'s" and tmp not in punctuation:
-                token_type = new_tt
+        tokens (list): A list of (start, end, label, text) tuples, one per spaCy token, in order.
+        offsets (list): The (start, end) offsets of the words, as returned by word_offsets().
+
+    Returns:
+        tuple: A list with one label per word, and a list of misalignments as (reason, detail) tuples:
+            ('token', start) for a token that does not fall within a single word, and
+            ('word', word index) for a word that no token falls within, which is labelled 'O'.
+    '''
+    labels = [None] * len(offsets)
+    content = [False] * len(offsets) # whether the label of a word comes from a token other than 's or punctuation
+    misalignments = []
+    w = 0
+    for start, end, label, text in tokens:
+        if text.isspace():
+            continue
+        while w < len(offsets) and offsets[w][1] <= start:
+            w += 1
+        if w == len(offsets) or start < offsets[w][0] or end > offsets[w][1]:
+            misalignments.append(('token', start))
+            continue
+        is_content = text != "'s" and text not in punctuation
+        if labels[w] is None or (is_content and not content[w]):
+            labels[w] = label
+            content[w] = is_content
+    for i, label in enumerate(labels):
+        if label is None:
+            misalignments.append(('word', i))
+            labels[i] = 'O'
+    return labels, misalignments
+
+
+
+def spacy_word_labels(nlp, lines, n_process=1, batch_size=1000, entity_types=spacy_entity_types):
+    '''
+    Runs spaCy NER over lines with nlp.pipe and reconciles its labels with the original enumeration of the words.
+
+    Parameters:
+        nlp (spacy.language.Language): The spaCy pipeline.
+        lines (list): A list of lines (str), each enumerated as line.split().
+        n_process (int): Number of processes for nlp.pipe.
+        batch_size (int): Number of lines per nlp.pipe batch.
+        entity_types (tuple): spaCy entity types to keep, labelled e.g. 'PERSON-B'; all other tokens are labelled 'O'.
+
+    Returns:
+        tuple: A list with one list of labels per line, and a list of misalignments as
+        (line index, reason, detail) tuples, as described in align_tokens().
+    '''
+    word_labels = []
+    misalignments = []
+    for i, (line, doc) in enumerate(zip(lines, nlp.pipe(lines, n_process=n_process, batch_size=batch_size))):
+        tokens = [(token.idx, token.idx + len(token.text),
+                   f'{token.ent_type_}-{token.ent_iob_}' if token.ent_type_ in entity_types else 'O', token.text)
+                  for token in doc]
+        labels, line_misalignments = align_tokens(tokens, word_offsets(line))
+        word_labels.append(labels)
+        misalignments.extend((i, reason, detail) for reason, detail in line_misalignments)
+    return word_labels, misalignments
 
 
 
@@ -432,4 +449,115 @@ def predict_labels(data, lex_dict):
                     predicted_sentence.append((word, 'I'))          
         predicted_data.append(predicted_sentence)
         
-    return predicted_data 
\ No newline at end of file
+    return predicted_data
+
+
+
+def tokenize_word(word):
+    '''
+    Tokenizes a corpus word in the same way as preprocessing.py, so that new text matches the
+    tokens the CRF and transformer models were trained on.
+
+    Parameters:
+        word (str): A word from a letter line, e.g. 'London,'.
+
+    Returns:
+        list: The tokens of the word. Sequences of '.' are converted to '.', and trailing punctuation
+        is split into a new token, e.g. ['London', ','].
+    '''
+    word = re.sub(r'\.{1,}', '.', word)
+    if len(word) > 1 and word[-1] in punctuation:
+        return [word[:-1], word[-1]]
+    return [word]
+
+
+
+def word2features(sent, i):
+    '''
+    Constructs the CRF feature dict for the token at index i of a sentence (line).
+
+    Parameters:
+        sent (list): A list of tuples (word, label, POS) representing one line.
+        i (int): The index of the token in the line.
+
+    Returns:
+        dict: The features of the token and of its neighbouring tokens, as used by the CRF models.
+    '''
+    word = sent[i][0]
+    postag = sent[i][2]
+    features = {
+        'bias': 1.0,
+        'word[-4:]': word[-4:],
+        'word[-3:]': word[-3:],
+        'word[-2:]': word[-2:],
+        'word[-1:]': word[-1:],
+        'word.lower()': word.lower(),
+        'word.isupper()': word.isupper(),
+        'word.istitle()': word.istitle(),
+        'word.isdigit()': word.isdigit(),
+        'postag': postag,
+        'postag[:2]': postag[:2]}
+
+    if i > 0:
+        word1 = sent[i-1][0]
+        postag1 = sent[i-1][2]
+        features.update({
+            '-1:word.lower()': word1.lower(),
+            '-1:word.isupper()': word1.isupper(),
+            '-1:word.istitle()': word1.istitle(),
+            '-1:postag[:2]': postag1[:2]})
+    else:
+        features['BOS'] = True
+
+    if i < len(sent)-1:
+        word1 = sent[i+1][0]
+        postag1 = sent[i+1][2]
+        features.update({
+            '+1:word.lower()': word1.lower(),
+            '+1:word.isupper()': word1.isupper(),
+            '+1:word.istitle()': word1.istitle(),
+            '+1:postag[:2]': postag1[:2]})
+    else:
+        features['EOS'] = True
+
+    return features
+
+
+
+def sent2features(sent):
+    '''
+    Constructs the CRF features for every token in a sentence (line) of (word, label, POS) tuples.
+    '''
+    return [word2features(sent, i) for i in range(len(sent))]
+
+
+
+def sent2labels(sent):
+    '''
+    Returns the labels of a sentence (line) of (word, label, POS) tuples.
+    '''
+    return [label for token, label, pos in sent]
+
+
+
+def sent2tokens(sent):
+    '''
+    Returns the tokens of a sentence (line) of (word, label, POS) tuples.
+    '''
+    return [token for token, label, pos in sent]
+
+
+
+def entity_labels(labels, entity):
+    '''
+    Projects combined labels (as in the 'labels' column, e.g. 'NAME-B') onto the BIO labels of a single entity,
+    so that a joint model can be evaluated against the per-entity models.
+
+    Parameters:
+        labels (list): A list of combined labels, e.g. ['NAME-B', 'NAME-I', 'DATE-B', 'O'].
+        entity (str): The entity, e.g. 'NAME'.
+
+    Returns:
+        list: The BIO labels of the entity, e.g. ['B', 'I', 'O', 'O'] for 'NAME'.
+    '''
+    return [label[-1] if label[:-2] == entity else 'O' for label in labels]
@@ -0,0 +1,184 @@
+import os
+import json
+import random
+import argparse
+import pandas as pd
+from datasets import Dataset, DatasetDict, load_from_disk
+from transformers import AutoTokenizer
+from my_functions import get_distribution, splitter
+
+# dataset build stage for the neural notebooks
+# each (subcorpus, tokenizer) pair is tokenized once, without padding, and saved to disk as an Arrow dataset,
+# which datasets memory-maps when it is loaded again; the tokenization is shared by all entities, so the dataset
+# holds the aligned label column of every entity and a fine-tune only selects the column of its entity
+
+# usage in a notebook, in place of the data preprocessing and tokenize_and_align_labels cells:
+#   splits = load_entity_dataset(data_file, "dslim/bert-base-NER", 'NAME')
+#   trainer = Trainer(..., train_dataset=splits['train'], eval_dataset=splits['eval'],
+#                     data_collator=DataCollatorForTokenClassification(tokenizer=tokenizer))
+# padding is left to DataCollatorForTokenClassification, which pads each batch to its longest line
+
+# the cache is rebuilt when the subcorpus file, the tokenizer or max_length change
+
+cache_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'dataset_cache')
+
+targets = ['NAME', 'LOCATION', 'NATION', 'MARKET', 'DATE', 'TIME', 'PRICE', 'GOD']
+
+# the label ids of the fine-tuned models in best_models/
+label2id = {'O': 0, 'B': 1, 'I': 2}
+id2label = {v: k for k, v in label2id.items()}
+
+
+
+def read_lines(data_file):
+    '''
+    Reads a preprocessed NER subcorpus into one row per line, with the words of the line
+    and the numeric BIO labels of every entity.
+
+    Parameters:
+        data_file (str): Path to a csv file written by preprocessing.py.
+
+    Returns:
+        dict: Columns 'tokens' and 'tags_<ENTITY>' for each entity in targets, one list per line.
+    '''
+    df = pd.read_csv(data_file).astype(str)
+    for t in targets:
+        df[t] = df[t].map(label2id)
+    lines = df.groupby(df['word_id'].str.endswith('.0').cumsum())[['word'] + targets].agg(list)
+    columns = {'tokens': lines['word'].tolist()}
+    for t in targets:
+        columns[f'tags_{t}'] = lines[t].tolist()
+    return columns
+
+
+
+def tokenize_and_align_labels(examples, tokenizer, max_length):
+    '''
+    Tokenizes a batch of lines without padding and aligns the labels of every entity with the subtokens,
+    as tokenize_and_align_labels in the neural notebooks does for a single entity:
+    only the first subtoken of a word is labelled, all other subtokens and special tokens get -100.
+    word_ids holds the index of the word of each subtoken, -1 for special tokens.
+    '''
+    tokenized_inputs = tokenizer(examples['tokens'], truncation=True, is_split_into_words=True, max_length=max_length)
+
+    word_ids_column = []
+    first_subtoken = []
+    for i in range(len(examples['tokens'])):
+        word_ids = tokenized_inputs.word_ids(batch_index=i)
+        previous_word_idx = None
+        first = []
+        for word_idx in word_ids:
+            first.append(word_idx if word_idx is not None and word_idx != previous_word_idx else None)
+            previous_word_idx = word_idx
+        word_ids_column.append([w if w is not None else -1 for w in word_ids])
+        first_subtoken.append(first)
+
+    tokenized_inputs['word_ids'] = word_ids_column
+    for t in targets:
+        tokenized_inputs[f'labels_{t}'] = [[tags[w] if w is not None else -100 for w in first]
+                                           for tags, first in zip(examples[f'tags_{t}'], first_subtoken)]
+    return tokenized_inputs
+
+
+
+def dataset_path(data_file, tokenizer_name, cache_dir=cache_dir):
+    subcorpus = os.path.splitext(os.path.basename(data_file))[0]
+    return os.path.join(cache_dir, subcorpus, tokenizer_name.replace('/', '__'))
+
+
+
+def build_dataset(data_file, tokenizer_name, cache_dir=cache_dir, max_length=512, rebuild=False):
+    '''
+    Returns the tokenized dataset of a (subcorpus, tokenizer) pair, building and caching it on first use.
+
+    Parameters:
+        data_file (str): Path to a csv file written by preprocessing.py.
+        tokenizer_name (str): Name or path of the tokenizer, e.g. "dslim/bert-base-NER".
+        cache_dir (str): Directory of the dataset cache.
+        max_length (int): Lines are truncated to this number of subtokens, as in the neural notebooks.
+        rebuild (bool): Rebuild the dataset even if it is cached.
+
+    Returns:
+        datasets.Dataset: One row per line with the columns tokens, tags_<ENTITY>, input_ids, attention_mask
+        (and token_type_ids, depending on the tokenizer), word_ids and labels_<ENTITY>.
+    '''
+    path = dataset_path(data_file, tokenizer_name, cache_dir)
+    stat = os.stat(data_file)
+    build = {'data_file': os.path.realpath(data_file), 'size': stat.st_size, 'mtime': stat.st_mtime,
+             'tokenizer': tokenizer_name, 'max_length': max_length}
+    build_file = os.path.join(path, 'build.json')
+    if not rebuild and os.path.exists(build_file):
+        with open(build_file) as f:
+            if json.load(f) == build:
+                return load_from_disk(path)
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    dataset = Dataset.from_dict(read_lines(data_file))
+    dataset = dataset.map(tokenize_and_align_labels, batched=True,
+                          fn_kwargs={'tokenizer': tokenizer, 'max_length': max_length})
+    dataset.save_to_disk(path)
+    with open(build_file, 'w') as f:
+        json.dump(build, f, indent=2)
+    # reload so that the returned dataset is memory-mapped from the cache
+    return load_from_disk(path)
+
+
+
+def split_indices(dataset, entity, seed=42):
+    '''
+    Shuffles and splits the lines into 80% training, 10% evaluation and 10% testing data, stratified on the
+    'B' labels of an entity with get_distribution and splitter as in the notebooks.
+
+    Returns:
+        tuple: (train, eval, test) lists of row indices into the dataset.
+    '''
+    data = [[(id2label[tag], id2label[tag], i) for tag in tags] for i, tags in enumerate(dataset[f'tags_{entity}'])]
+    random.seed(seed)
+    random.shuffle(data)
+    train_bin, test = splitter(data, 0.8, get_distribution(data))
+    test_bin, eval_bin = splitter(test, 0.5, get_distribution(test))
+    return tuple([line[0][2] for line in split] for split in (train_bin, eval_bin, test_bin))
+
+
+
+def load_entity_dataset(data_file, tokenizer_name, entity, cache_dir=cache_dir, max_length=512, seed=42):
+    '''
+    Returns the train, eval and test splits of the cached dataset for one entity, with the entity's
+    columns renamed to 'labels' (subtoken level) and 'ner_tags' (word level) and those of other entities removed.
+
+    Parameters:
+        data_file (str): Path to a csv file written by preprocessing.py.
+        tokenizer_name (str): Name or path of the tokenizer.
+        entity (str): The entity to fine-tune on, e.g. 'NAME'.
+        cache_dir (str): Directory of the dataset cache.
+        max_length (int): Maximum number of subtokens per line.
+        seed (int): Seed for shuffling the lines before splitting.
+
+    Returns:
+        datasets.DatasetDict: 'train', 'eval' and 'test' splits.
+    '''
+    dataset = build_dataset(data_file, tokenizer_name, cache_dir, max_length)
+    train_rows, eval_rows, test_rows = split_indices(dataset, entity, seed)
+    dataset = dataset.remove_columns([f'{c}_{t}' for c in ('labels', 'tags') for t in targets if t != entity])
+    dataset = dataset.rename_columns({f'labels_{entity}': 'labels', f'tags_{entity}': 'ner_tags'})
+    return DatasetDict({'train': dataset.select(train_rows), 'eval': dataset.select(eval_rows),
+                        'test': dataset.select(test_rows)})
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--data', type=str, nargs='+', default=['data/raw_ner_corpus.csv'], help='Preprocessed NER subcorpora in csv.')
+    p.add_argument('--tokenizers', type=str, nargs='+',
+                   default=['dslim/bert-base-NER', 'dbmdz/bert-base-historic-multilingual-cased', 'emanjavacas/MacBERTh'],
+                   help='Tokenizers to build datasets for.')
+    p.add_argument('--cache_dir', type=str, default=cache_dir, help='Directory of the dataset cache.')
+    p.add_argument('--max_length', type=int, default=512, help='Maximum number of subtokens per line.')
+    p.add_argument('--rebuild', action='store_true', help='Rebuild cached datasets.')
+    args = p.parse_args()
+
+    for data_file in args.data:
+        for tokenizer_name in args.tokenizers:
+            dataset = build_dataset(data_file, tokenizer_name, args.cache_dir, args.max_length, args.rebuild)
+            print(f"{os.path.basename(data_file)}, {tokenizer_name}: {dataset.num_rows} lines, "
+                  f"{sum(len(ids) for ids in dataset['input_ids'])} subtokens")
@@ -0,0 +1,155 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from my_functions import get_distribution, sent2features, sent2labels
+from joint_crf import split, new_crf, scores
+
+# sampling stage for training sets with rare entities (GOD, MARKET, NATION)
+# the undersampling and combined sampling of the CRF notebooks build new lists of lines before every fit:
+# positive sequence undersampling keeps only the lines with an entity, and combined sampling does the same over the
+# training lines of two subcorpora
+# here the lines are never copied: a LineSampler holds the entity count of every line (from get_distribution) and
+# whether it has any entity label, and draws an array of line indices per epoch
+# fit_crf passes generators over the indices to crfsuite, which reads the lines one at a time, and cpu_finetune.py
+# gives the indices of each epoch to the train dataloader (EpochSampler)
+
+# strategies:
+#   none         every line once
+#   undersample  every positive line, and a seeded random share (negative_keep) of the lines without an entity;
+#                negative_keep=0 is the positive sequence undersampling of the notebooks
+#   oversample   every line, with the positive lines repeated oversample times on average; the positive lines that
+#                get the extra copy of a fractional oversample are drawn in proportion to their entity counts
+#   combined     undersample the negative lines and oversample the positive lines
+# for combined sampling over two subcorpora as in the notebooks, pass the training lines of both
+
+# the indices of an epoch depend only on the seed and the epoch, so a run can be reproduced or resumed
+
+# example:
+#   python sampling.py --entity GOD --strategies none undersample combined --negative_keep 0.1 --oversample 2
+
+strategies = ['none', 'undersample', 'oversample', 'combined']
+
+
+
+def line_statistics(data):
+    '''
+    Returns the number of 'B' labels of each line, from get_distribution, and whether each line has any
+    entity label, as two arrays.
+
+    Parameters:
+        data (list): A list of lines, each a list of tuples whose second element is the label.
+    '''
+    counts = np.fromiter(get_distribution(data).values(), dtype=np.int64, count=len(data))
+    positive = np.fromiter((any(t[1] != 'O' for t in s) for s in data), dtype=bool, count=len(data))
+    return counts, positive
+
+
+
+class LineSampler:
+    '''
+    Seeded over- and undersampling of lines as arrays of line indices.
+
+    Parameters:
+        counts (np.ndarray): The number of 'B' labels of each line.
+        positive (np.ndarray): Whether each line has an entity label.
+        strategy (str): One of 'none', 'undersample', 'oversample' and 'combined'.
+        negative_keep (float): Share of the lines without an entity kept when undersampling.
+        oversample (float): Average number of times a positive line is used when oversampling.
+        seed (int): Seed of the draws.
+
+    Example:
+        sampler = LineSampler(*line_statistics(train_bin), 'combined', negative_keep=0.1, oversample=2)
+        fit_crf(crf, train_bin, sampler)
+    '''
+    def __init__(self, counts, positive, strategy='combined', negative_keep=0.0, oversample=1.0, seed=42):
+        if strategy not in strategies:
+            raise ValueError(f"unknown sampling strategy '{strategy}', choose from {strategies}")
+        self.counts = np.asarray(counts)
+        self.positives = np.flatnonzero(positive)
+        self.negatives = np.flatnonzero(~np.asarray(positive, dtype=bool))
+        self.strategy = strategy
+        self.negative_keep = negative_keep if strategy in ('undersample', 'combined') else 1.0
+        self.oversample = oversample if strategy in ('oversample', 'combined') else 1.0
+        self.seed = seed
+
+    def indices(self, epoch=0):
+        '''
+        Returns the shuffled array of line indices of an epoch.
+        '''
+        rng = np.random.default_rng([self.seed, epoch])
+        negatives = self.negatives
+        if self.negative_keep < 1.0:
+            negatives = rng.choice(negatives, size=round(self.negative_keep * len(negatives)), replace=False)
+        copies, fraction = divmod(self.oversample, 1.0)
+        positives = np.tile(self.positives, int(copies))
+        extra = round(fraction * len(self.positives))
+        if extra:
+            weights = np.maximum(self.counts[self.positives], 1).astype(float)
+            positives = np.concatenate([positives, rng.choice(self.positives, size=extra, replace=False,
+                                                              p=weights / weights.sum())])
+        indices = np.concatenate([positives, negatives])
+        rng.shuffle(indices)
+        return indices
+
+    def summary(self, epoch=0):
+        '''
+        Returns the number of lines, the share of positive lines and the number of entities of an epoch.
+        '''
+        indices = self.indices(epoch)
+        positive = np.isin(indices, self.positives)
+        return {'lines': len(indices), 'positive_share': float(positive.mean()) if len(indices) else 0.0,
+                'entities': int(self.counts[indices].sum())}
+
+
+
+def fit_crf(crf, data, sampler, epoch=0):
+    '''
+    Fits a CRF on the lines of an epoch of a sampler; the features of each line are generated as crfsuite reads it.
+    '''
+    indices = sampler.indices(epoch)
+    crf.fit((sent2features(data[i]) for i in indices), (sent2labels(data[i]) for i in indices))
+    return crf
+
+
+
+def main(args):
+    df = pd.read_csv(args.data).astype(str)
+    data = [list(zip(g['word'], g[args.entity], g['POS'])) for k, g in
+            df.groupby(df['word_id'].str.endswith('.0').cumsum())]
+    train_bin, eval_bin, test_bin = split(data)
+    train_extended = train_bin + eval_bin # as in the undersampling and combined sampling sections of the notebooks
+    counts, positive = line_statistics(train_extended)
+    true = [t[1] for s in test_bin for t in s]
+
+    rows = []
+    for strategy in args.strategies:
+        sampler = LineSampler(counts, positive, strategy, args.negative_keep, args.oversample, args.seed)
+        start = time.perf_counter()
+        for epoch in range(args.epochs):
+            sampler.indices(epoch)
+        draw_ms = (time.perf_counter() - start) / args.epochs * 1000
+        start = time.perf_counter()
+        crf = fit_crf(new_crf(), train_extended, sampler)
+        fit_seconds = time.perf_counter() - start
+        preds = [l for line in crf.predict([sent2features(s) for s in test_bin]) for l in line]
+        rows.append({'strategy': strategy, **sampler.summary(), 'draw_ms': draw_ms, 'fit_seconds': fit_seconds,
+                     **scores(true, preds)})
+
+    with pd.option_context('display.float_format', '{:.4f}'.format, 'display.width', 200):
+        print(pd.DataFrame(rows)[['strategy', 'lines', 'positive_share', 'entities', 'draw_ms', 'fit_seconds',
+                                  'precision_B', 'recall_B', 'f1_B', 'f1_avg']].to_string(index=False))
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--entity', type=str, required=True, help="Entity to train on, e.g. 'GOD'.")
+    p.add_argument('--data', type=str, default='data/raw_ner_corpus.csv', help='Preprocessed NER subcorpus in csv.')
+    p.add_argument('--strategies', type=str, nargs='+', default=strategies, choices=strategies, help='Sampling strategies to compare.')
+    p.add_argument('--negative_keep', type=float, default=0.0, help='Share of the lines without an entity kept when undersampling.')
+    p.add_argument('--oversample', type=float, default=2.0, help='Average number of times a positive line is used when oversampling.')
+    p.add_argument('--seed', type=int, default=42, help='Seed of the draws.')
+    p.add_argument('--epochs', type=int, default=10, help='Number of epochs of indices drawn to time the sampler.')
+    args = p.parse_args()
+    main(args)
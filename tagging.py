@@ -0,0 +1,258 @@
+import os
+import threading
+from lxml import etree
+from my_functions import replacer, tokenize_word, sent2features, entity_labels
+
+# functions for tagging new letter text with the models in best_models/
+# letter lines are split into words exactly as in create_corpus.py, so that every word keeps its corpus word_id,
+# and words are tokenized as in preprocessing.py, so that the models see the tokens they were trained on
+# every word receives the label predicted for its first token
+
+targets = ['NAME', 'LOCATION', 'NATION', 'MARKET', 'DATE', 'TIME', 'PRICE', 'GOD']
+
+# POS tags are generated with spaCy at the token level, as in preprocessing.py
+# the tags are cached since they only depend on the token
+
+_nlp = None
+_pos_cache = {}
+_pos_lock = threading.Lock()
+
+
+
+def get_pos_tags(tokens):
+    '''
+    Returns the spaCy POS tag of each token, tagging every token on its own as in preprocessing.py.
+    Tokens that have not been seen before are tagged in a single nlp.pipe batch.
+
+    Parameters:
+        tokens (list): A list of tokens.
+
+    Returns:
+        list: The POS tag of each token, 'UNKN' for tokens spaCy returns no tokens for.
+    '''
+    global _nlp
+    with _pos_lock:
+        unseen = list({t for t in tokens if t not in _pos_cache})
+        if unseen:
+            if _nlp is None:
+                import spacy
+                _nlp = spacy.load('en_core_web_sm')
+            for token, doc in zip(unseen, _nlp.pipe(unseen, batch_size=1000)):
+                _pos_cache[token] = doc[0].pos_ if doc else 'UNKN'
+    return [_pos_cache[t] for t in tokens]
+
+
+
+def prepare_line(line):
+    '''
+    Splits a letter line into words and tokens.
+
+    Parameters:
+        line (str): A line of letter text.
+
+    Returns:
+        tuple: (words, tokens, first_token), where words is the list of words as enumerated in the corpus,
+        tokens is the list of model tokens for the line, and first_token holds the index in tokens of the
+        first token of each word (None for empty words, which are dropped during preprocessing).
+    '''
+    words = [replacer(word) for word in line.split(' ')]
+    tokens = []
+    first_token = []
+    for word in words:
+        if word == '':
+            first_token.append(None)
+            continue
+        first_token.append(len(tokens))
+        tokens.extend(tokenize_word(word))
+    return words, tokens, first_token
+
+
+
+def corpus_lines(master_dir, skip_annotated=False):
+    '''
+    Reads the letters in the master corpus and splits their lines into tokens.
+
+    Parameters:
+        master_dir (str): Path to the master_corpus directory.
+        skip_annotated (bool): Leave out the letters with any entity label.
+
+    Returns:
+        list: One list of (word_id, token) tuples per line; empty words are dropped and trailing punctuation
+        is split off with a word_id ending in '.1', as in preprocessing.py.
+    '''
+    lines = []
+    for file in sorted(os.listdir(master_dir)):
+        if not file.endswith('.xml'):
+            continue
+        words = etree.parse(os.path.join(master_dir, file)).getroot().findall('.//word')
+        if skip_annotated and any(tag in word.attrib for word in words for tag in targets):
+            continue
+        line = None
+        current = None
+        for word in words:
+            word_id = word.get('word_id')
+            line_id = word_id.rsplit('.', 1)[0]
+            if line_id != current:
+                current = line_id
+                line = []
+                lines.append(line)
+            for i, token in enumerate(tokenize_word(word.text or '')):
+                if token:
+                    line.append((word_id if i == 0 else f'{word_id}.{i}', token))
+    return [line for line in lines if line]
+
+
+
+def crf_predict(crf, token_lines):
+    '''
+    Predicts BIO labels for lines of tokens with a CRF model.
+
+    Parameters:
+        crf (sklearn_crfsuite.CRF): A trained CRF model.
+        token_lines (list): A list of lists of tokens.
+
+    Returns:
+        list: A list of lists of BIO labels, one per token.
+    '''
+    flat = [t for tokens in token_lines for t in tokens]
+    pos = iter(get_pos_tags(flat))
+    sents = [[(t, 'O', next(pos)) for t in tokens] for tokens in token_lines]
+    return crf.predict([sent2features(s) for s in sents])
+
+
+
+def crf_marginals(crf, token_lines):
+    '''
+    Returns the marginal probabilities of the labels of a CRF model for lines of tokens.
+
+    Parameters:
+        crf (sklearn_crfsuite.CRF): A trained CRF model.
+        token_lines (list): A list of lists of tokens.
+
+    Returns:
+        tuple: The list of labels, and a list of arrays of shape (tokens, labels), one per line.
+    '''
+    import numpy as np
+
+    flat = [t for tokens in token_lines for t in tokens]
+    pos = iter(get_pos_tags(flat))
+    sents = [[(t, 'O', next(pos)) for t in tokens] for tokens in token_lines]
+    labels = list(crf.classes_)
+    marginals = crf.predict_marginals([sent2features(s) for s in sents])
+    return labels, [np.array([[token[l] for l in labels] for token in line]).reshape(len(line), len(labels))
+                    for line in marginals]
+
+
+
+def transformer_marginals(model, tokenizer, token_lines, batch_size=32, max_length=512):
+    '''
+    Returns the softmax probabilities of the labels of a fine-tuned token classification model for lines of tokens.
+    Lines are passed to the model pre-split into words and padded per batch only; each token receives
+    the probabilities of its first subtoken, matching tokenize_and_align_labels in the neural notebooks.
+
+    Parameters:
+        model (transformers.PreTrainedModel): A fine-tuned token classification model.
+        tokenizer (transformers.PreTrainedTokenizer): The model's tokenizer.
+        token_lines (list): A list of lists of tokens.
+        batch_size (int): The number of lines per forward pass.
+        max_length (int): The maximum sequence length; tokens beyond it are given probability 1 for 'O'.
+
+    Returns:
+        tuple: The list of labels, and a list of arrays of shape (tokens, labels), one per line.
+    '''
+    import numpy as np
+    import torch
+
+    labels = [model.config.id2label[i] for i in range(len(model.config.id2label))]
+    outside = np.eye(len(labels))[labels.index('O') if 'O' in labels else 0]
+    # sort by length so that each batch is padded to similar lengths, then restore the order
+    order = sorted(range(len(token_lines)), key=lambda i: len(token_lines[i]))
+    results = [None] * len(token_lines)
+    for start in range(0, len(order), batch_size):
+        batch = [token_lines[i] for i in order[start:start + batch_size]]
+        non_empty = [tokens if tokens else [''] for tokens in batch]
+        inputs = tokenizer(non_empty, is_split_into_words=True, truncation=True, max_length=max_length,
+                           padding=True, return_tensors='pt')
+        with torch.no_grad():
+            probabilities = torch.softmax(model(**inputs).logits, dim=2).numpy()
+        for b, tokens in enumerate(batch):
+            line = np.tile(outside, (len(tokens), 1))
+            previous_word_idx = None
+            for position, word_idx in enumerate(inputs.word_ids(batch_index=b)):
+                if word_idx is not None and word_idx != previous_word_idx and word_idx < len(tokens):
+                    line[word_idx] = probabilities[b, position]
+                previous_word_idx = word_idx
+            results[order[start + b]] = line
+    return labels, results
+
+
+
+def transformer_predict(model, tokenizer, token_lines, batch_size=32, max_length=512):
+    '''
+    Predicts BIO labels for lines of tokens with a fine-tuned token classification model, as the label with
+    the highest probability in transformer_marginals().
+
+    Parameters:
+        model (transformers.PreTrainedModel): A fine-tuned token classification model.
+        tokenizer (transformers.PreTrainedTokenizer): The model's tokenizer.
+        token_lines (list): A list of lists of tokens.
+        batch_size (int): The number of lines per forward pass.
+        max_length (int): The maximum sequence length; tokens beyond it are labelled 'O'.
+
+    Returns:
+        list: A list of lists of BIO labels, one per token.
+    '''
+    labels, marginals = transformer_marginals(model, tokenizer, token_lines, batch_size, max_length)
+    return [[labels[i] for i in line.argmax(axis=1)] for line in marginals]
+
+
+
+def tag_lines(registry, lines, entities=None):
+    '''
+    Tags letter lines with the best-performing model for each entity.
+
+    Parameters:
+        registry (model_registry.ModelRegistry): The registry from which to load models.
+        lines (list): A list of letter lines (str).
+        entities (list): The entities to tag. Defaults to all entities whose weights are available.
+
+    Returns:
+        tuple: (words, labels), where words is a list of lists of words per line and labels is a dict
+        mapping each entity to a list of lists of BIO labels, one per word.
+    '''
+    entities = registry.available() if entities is None else entities
+    prepared = [prepare_line(line) for line in lines]
+    token_lines = [tokens for _, tokens, _ in prepared]
+
+    labels = {}
+    for entity in entities:
+        model = registry.get(entity)
+        if registry.entries[entity].kind == 'crf':
+            token_labels = crf_predict(model, token_lines)
+        else:
+            token_labels = transformer_predict(model[0], model[1], token_lines)
+        labels[entity] = [[tl[i] if i is not None else 'O' for i in first_token]
+                          for (_, _, first_token), tl in zip(prepared, token_labels)]
+
+    return [words for words, _, _ in prepared], labels
+
+
+
+def tag_lines_joint(crf, lines, entities=targets):
+    '''
+    Tags letter lines for all entities in a single pass with a joint CRF model trained by joint_crf.py.
+
+    Parameters:
+        crf (sklearn_crfsuite.CRF): A CRF model trained on the combined labels, e.g. 'NAME-B'.
+        lines (list): A list of letter lines (str).
+        entities (list): The entities to return labels for.
+
+    Returns:
+        tuple: (words, labels), as returned by tag_lines().
+    '''
+    prepared = [prepare_line(line) for line in lines]
+    token_labels = crf_predict(crf, [tokens for _, tokens, _ in prepared])
+    word_labels = [[tl[i] if i is not None else 'O' for i in first_token]
+                   for (_, _, first_token), tl in zip(prepared, token_labels)]
+    labels = {entity: [entity_labels(line, entity) for line in word_labels] for entity in entities}
+    return [words for words, _, _ in prepared], labels
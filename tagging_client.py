@@ -0,0 +1,78 @@
+import asyncio
+import argparse
+import json
+import time
+
+# load-testing client for tagging_service.py
+# sends the letters in letters.json to the service from a number of concurrent connections and reports
+# throughput and latency percentiles
+
+p = argparse.ArgumentParser()
+p.add_argument('--host', type=str, default='127.0.0.1', help='Host of the tagging service.')
+p.add_argument('--port', type=int, default=8000, help='Port of the tagging service.')
+p.add_argument('--json_file', type=str, default='raw_data/letters.json', help='Path to json file containing letters.')
+p.add_argument('--requests', type=int, default=200, help='Total number of requests to send; letters are reused in order.')
+p.add_argument('--concurrency', type=int, default=16, help='Number of concurrent connections.')
+args = p.parse_args()
+
+
+
+async def post(reader, writer, body):
+    writer.write((f"POST /tag HTTP/1.1\r\nHost: {args.host}\r\nContent-Type: application/json\r\n"
+                  f"Content-Length: {len(body)}\r\n\r\n").encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        k, v = line.decode('latin-1').split(':', 1)
+        headers[k.strip().lower()] = v.strip()
+    response = await reader.readexactly(int(headers['content-length']))
+    return status, response
+
+
+
+async def worker(queue, latencies, counts):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    while True:
+        try:
+            letter = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+        body = json.dumps({'_id': letter['_id'], 'text': letter['text']}).encode('utf-8')
+        start = time.perf_counter()
+        status, response = await post(reader, writer, body)
+        latencies.append(time.perf_counter() - start)
+        if status == 200:
+            counts['words'] += sum(len(f['words']) for f in json.loads(response)['letters'])
+        else:
+            counts['errors'] += 1
+            print(f"{letter['_id']}: {status} {response.decode('utf-8')}")
+    writer.close()
+
+
+
+async def main():
+    with open(args.json_file) as json_file:
+        letters = json.load(json_file)
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(letters[i % len(letters)])
+
+    latencies = []
+    counts = {'words': 0, 'errors': 0}
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(queue, latencies, counts) for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    percentile = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    print(f"requests: {len(latencies)}, errors: {counts['errors']}, concurrency: {args.concurrency}")
+    print(f"throughput: {len(latencies) / elapsed:.1f} requests/s, {counts['words'] / elapsed:.0f} words/s")
+    print(f"latency: p50 {percentile(0.5):.1f}ms, p95 {percentile(0.95):.1f}ms, p99 {percentile(0.99):.1f}ms")
+
+
+
+asyncio.run(main())
@@ -0,0 +1,257 @@
+import asyncio
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from model_registry import ModelRegistry, best_models_dir
+from tagging import tag_lines, targets
+
+# local HTTP service for tagging newly transcribed letters with the models in best_models/
+
+# POST /tag accepts a json body in one of the following forms:
+#   {"text": "letter text, one line per newline"}
+#   {"_id": "SB_J_1", "text": ["line", "line", ...]}     (one entry of letters.json)
+#   [{"_id": "SB_J_1", "text": [...]}, ...]                (letters.json)
+# and returns per-word BIO labels for every entity whose model weights are available
+# GET /health returns the models in the registry and the models currently loaded
+
+# concurrent requests are gathered into micro-batches within a small latency window and
+# tagged together in a pool of worker threads, so that the models see batches of lines rather than single letters
+
+
+
+class MicroBatcher:
+    '''
+    Gathers lines from concurrent requests into batches and tags them in a worker pool.
+
+    Parameters:
+        registry (model_registry.ModelRegistry): The registry from which to load models.
+        window (float): Seconds to wait for further requests after the first request of a batch arrives.
+        max_lines (int): Maximum number of lines in a batch; a full batch is dispatched immediately.
+        workers (int): Number of worker threads, i.e. the number of batches tagged concurrently.
+    '''
+    def __init__(self, registry, window=0.01, max_lines=256, workers=2):
+        self.registry = registry
+        self.window = window
+        self.max_lines = max_lines
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = asyncio.Semaphore(workers)
+        self.queue = asyncio.Queue()
+        self.batches = 0
+
+    async def submit(self, lines):
+        '''
+        Queues lines for tagging and waits for the result.
+        Returns (words, labels) as returned by tagging.tag_lines for the submitted lines.
+        '''
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((lines, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.window
+            while size < self.max_lines:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            await self.slots.acquire()
+            asyncio.create_task(self._dispatch(batch))
+
+    async def _dispatch(self, batch):
+        loop = asyncio.get_running_loop()
+        lines = [line for item_lines, _ in batch for line in item_lines]
+        try:
+            words, labels = await loop.run_in_executor(self.pool, tag_lines, self.registry, lines)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.slots.release()
+        self.batches += 1
+
+        # split the batch back into the lines of each request
+        start = 0
+        for item_lines, future in batch:
+            end = start + len(item_lines)
+            result = (words[start:end], {k: v[start:end] for k, v in labels.items()})
+            if not future.done():
+                future.set_result(result)
+            start = end
+
+
+
+def parse_letters(payload):
+    '''
+    Normalises a request payload to a list of letters of the form {'_id': str | None, 'text': [lines]}.
+
+    Raises:
+        ValueError: If the payload is not in one of the accepted forms.
+    '''
+    letters = payload if isinstance(payload, list) else [payload]
+    parsed = []
+    for letter in letters:
+        if not isinstance(letter, dict) or 'text' not in letter:
+            raise ValueError("Each letter must be an object with a 'text' field.")
+        text = letter['text']
+        if isinstance(text, str):
+            text = text.split('\n')
+        if not isinstance(text, list) or not all(isinstance(line, str) for line in text):
+            raise ValueError("'text' must be a string or a list of strings.")
+        parsed.append({'_id': letter.get('_id'), 'text': text})
+    return parsed
+
+
+
+def format_letter(letter, words, labels):
+    '''
+    Formats the tagged lines of a letter as a list of words with their word_id and a BIO label per entity.
+    word_id follows the corpus enumeration '{letter_id}.{line}.{word}'.
+    '''
+    prefix = f"{letter['_id']}." if letter['_id'] is not None else ''
+    output = []
+    for ln, line_words in enumerate(words):
+        for wn, word in enumerate(line_words):
+            entry = {'word_id': f'{prefix}{ln}.{wn}', 'word': word}
+            for entity in labels:
+                entry[entity] = labels[entity][ln][wn]
+            output.append(entry)
+    return {'_id': letter['_id'], 'words': output}
+
+
+
+async def handle_tag(batcher, body):
+    letters = parse_letters(json.loads(body))
+    lines = [line for letter in letters for line in letter['text']]
+    words, labels = await batcher.submit(lines)
+
+    results = []
+    start = 0
+    for letter in letters:
+        end = start + len(letter['text'])
+        results.append(format_letter(letter, words[start:end], {k: v[start:end] for k, v in labels.items()}))
+        start = end
+
+    unavailable = [t for t in targets if t not in labels]
+    return {'letters': results, 'unavailable': unavailable}
+
+
+
+async def read_request(reader):
+    '''
+    Reads a single HTTP/1.1 request. Returns (method, path, headers, body), or None if the connection was closed.
+    Raises ValueError for a malformed request line, header or Content-Length.
+    '''
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    parts = request_line.decode('latin-1').split(' ', 2)
+    if len(parts) != 3:
+        raise ValueError(f"malformed request line {request_line.decode('latin-1').strip()!r}")
+    method, path, _ = parts
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if b':' not in line:
+            raise ValueError(f"malformed header {line.decode('latin-1').strip()!r}")
+        k, v = line.decode('latin-1').split(':', 1)
+        headers[k.strip().lower()] = v.strip()
+    length = headers.get('content-length', '0')
+    if not length.isdigit():
+        raise ValueError(f"invalid Content-Length {length!r}")
+    body = await reader.readexactly(int(length))
+    return method, path, headers, body
+
+
+
+def write_response(writer, status, payload, keep_alive):
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+    body = json.dumps(payload).encode('utf-8')
+    head = (f"HTTP/1.1 {status} {reasons[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode('latin-1') + body)
+
+
+
+async def handle_connection(batcher, reader, writer):
+    try:
+        while True:
+            # a malformed request is answered with 400 and the connection is closed, as the next request cannot be found
+            method, path, keep_alive = '-', '-', False
+            start = time.perf_counter()
+            try:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', 'keep-alive').lower() != 'close'
+                start = time.perf_counter()
+                if method == 'POST' and path == '/tag':
+                    status, payload = 200, await handle_tag(batcher, body)
+                elif method == 'GET' and path == '/health':
+                    registry = batcher.registry
+                    status, payload = 200, {'models': {k: v.name for k, v in registry.entries.items()},
+                                            'available': registry.available(),
+                                            'loaded': registry.loaded(),
+                                            'batches': batcher.batches}
+                else:
+                    status, payload = 404, {'error': f'{method} {path} not found'}
+            except (ValueError, UnicodeDecodeError) as e:
+                status, payload = 400, {'error': str(e)}
+            except Exception as e:
+                status, payload = 500, {'error': repr(e)}
+            write_response(writer, status, payload, keep_alive)
+            await writer.drain()
+            print(f"{method} {path} {status} {(time.perf_counter() - start) * 1000:.1f}ms")
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+
+
+async def serve(args):
+    registry = ModelRegistry(args.models_dir, memory_budget=int(args.memory_budget * 1024**3))
+    if args.warm:
+        print(f"Loading models: {registry.warm()}")
+    batcher = MicroBatcher(registry, window=args.batch_window_ms / 1000, max_lines=args.max_batch_lines, workers=args.workers)
+    batcher_task = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(lambda r, w: handle_connection(batcher, r, w), args.host, args.port)
+    print(f"Serving on http://{args.host}:{args.port} (models available for {registry.available()})")
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--host', type=str, default='127.0.0.1', help='Host to bind to.')
+    p.add_argument('--port', type=int, default=8000, help='Port to bind to.')
+    p.add_argument('--models_dir', type=str, default=best_models_dir, help='Directory of best-performing models.')
+    p.add_argument('--memory_budget', type=float, default=2.0, help='Memory budget for loaded models in GB.')
+    p.add_argument('--warm', action='store_true', help='Load all available models before serving.')
+    p.add_argument('--batch_window_ms', type=float, default=10.0, help='Latency window for gathering requests into a batch.')
+    p.add_argument('--max_batch_lines', type=int, default=256, help='Maximum number of lines in a batch.')
+    p.add_argument('--workers', type=int, default=2, help='Number of worker threads tagging batches.')
+    args = p.parse_args()
+    asyncio.run(serve(args))